@@ -25,16 +25,27 @@
 """Command-line tool for working with Android Verified Boot images."""
 
 import argparse
+import array
+import atexit
+import base64
 import binascii
 import bisect
+import collections
+import concurrent.futures
+import contextlib
+import errno
 import hashlib
 import json
 import math
+import mmap
+import multiprocessing
 import os
+import random
 import struct
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 
 # Keep in sync with libavb/avb_version.h.
@@ -51,6 +62,36 @@ AVB_VBMETA_IMAGE_FLAGS_HASHTREE_DISABLED = 1
 # Configuration for enabling logging of calls to avbtool.
 AVB_INVOCATION_LOGFILE = os.environ.get('AVB_INVOCATION_LOGFILE')
 
+# Configuration for caching the chunk table of Android sparse images
+# between invocations. If set, this is the directory chunk indexes are
+# stored in. A relative path is interpreted relative to the directory
+# of each image, e.g. '.' stores the index next to the image.
+AVB_SPARSE_INDEX_CACHE = os.environ.get('AVB_SPARSE_INDEX_CACHE')
+
+# Configuration for logging hits and misses of the chunk index cache.
+AVB_SPARSE_INDEX_CACHE_LOGFILE = os.environ.get(
+    'AVB_SPARSE_INDEX_CACHE_LOGFILE')
+
+# Configuration for reading non-sparse images through a memory mapping
+# instead of buffered reads. Set to '0' to disable.
+AVB_IMAGE_MMAP = os.environ.get('AVB_IMAGE_MMAP', '1') != '0'
+
+# Configuration for finding holes in non-sparse images with
+# SEEK_DATA/SEEK_HOLE so they're not read. Set to '0' to disable.
+AVB_IMAGE_SEEK_HOLES = os.environ.get('AVB_IMAGE_SEEK_HOLES', '1') != '0'
+
+# Configuration for logging how many bytes of image data footer
+# operations read.
+AVB_IO_STATS_LOGFILE = os.environ.get('AVB_IO_STATS_LOGFILE')
+
+# Configuration for checking vbmeta signatures with openssl(1) instead
+# of in-process. Set to '1' to enable.
+AVB_VERIFY_WITH_OPENSSL = os.environ.get('AVB_VERIFY_WITH_OPENSSL') == '1'
+
+# Configuration for signing in-process instead of with openssl(1) when
+# no signing helper is used. Set to '1' to enable.
+AVB_SIGN_IN_PROCESS = os.environ.get('AVB_SIGN_IN_PROCESS') == '1'
+
 
 class AvbError(Exception):
   """Application-specific errors.
@@ -246,11 +287,8 @@ def encode_long(num_bits, value):
   Returns:
     A bytearray() with the encoded long.
   """
-  ret = bytearray()
-  for bit_pos in range(num_bits, 0, -8):
-    octet = (value >> (bit_pos - 8)) & 0xff
-    ret.extend(struct.pack('!B', octet))
-  return ret
+  return bytearray((value & ((1 << num_bits) - 1)).to_bytes(num_bits // 8,
+                                                             'big'))
 
 
 def decode_long(blob):
@@ -267,11 +305,7 @@ def decode_long(blob):
   Returns:
     The decoded value.
   """
-  ret = 0
-  for b in bytearray(blob):
-    ret *= 256
-    ret += b
-  return ret
+  return int.from_bytes(blob, 'big')
 
 
 def egcd(a, b):
@@ -335,9 +369,341 @@ def parse_number(string):
   return int(string, 0)
 
 
+def parse_block_ranges(string):
+  """Parse a string as a list of block ranges.
+
+  The string is a comma-separated list of block numbers and inclusive
+  ranges of block numbers, e.g. "3,10-20". This is suitable for use in
+  the |type| parameter of |ArgumentParser|'s add_argument() function.
+
+  Arguments:
+    string: The string to parse.
+
+  Returns:
+    A sorted list of the block numbers without duplicates.
+
+  Raises:
+    ValueError: If the string could not be parsed.
+  """
+  blocks = set()
+  for token in string.split(','):
+    first, _, last = token.partition('-')
+    first = parse_number(first)
+    last = parse_number(last) if last else first
+    if first < 0 or last < first:
+      raise ValueError('Invalid block range: {}'.format(token))
+    blocks.update(range(first, last + 1))
+  return sorted(blocks)
+
+
+def check_num_jobs(jobs):
+  """Checks a number of threads or processes to use.
+
+  Arguments:
+    jobs: The number of jobs or 0 to use one per CPU.
+
+  Raises:
+    AvbError: If |jobs| is negative.
+  """
+  if jobs < 0:
+    raise AvbError('Number of jobs must be 0 or greater, got {}.'
+                   .format(jobs))
+
+
+# DER tags used in RSA key files.
+DER_TAG_INTEGER = 0x02
+DER_TAG_BIT_STRING = 0x03
+DER_TAG_OCTET_STRING = 0x04
+DER_TAG_OBJECT_IDENTIFIER = 0x06
+DER_TAG_SEQUENCE = 0x30
+
+# The DER encoded object identifier of rsaEncryption, 1.2.840.113549.1.1.1.
+DER_OID_RSA_ENCRYPTION = b'\x2a\x86\x48\x86\xf7\x0d\x01\x01\x01'
+
+
+def der_decode_elements(data):
+  """Decodes consecutive DER encoded elements.
+
+  Only what's needed to parse RSA keys is supported, i.e. single byte
+  tags and definite lengths.
+
+  Arguments:
+    data: The DER encoded elements as bytes, e.g. the contents of a
+      SEQUENCE.
+
+  Returns:
+    A list with a tuple (tag, contents) for each element.
+
+  Raises:
+    ValueError: If |data| isn't valid DER.
+  """
+  elements = []
+  offset = 0
+  while offset < len(data):
+    if offset + 2 > len(data):
+      raise ValueError('Truncated DER element.')
+    tag = data[offset]
+    length = data[offset + 1]
+    offset += 2
+    if tag & 0x1f == 0x1f:
+      raise ValueError('Unsupported DER tag.')
+    if length & 0x80:
+      num_bytes = length & 0x7f
+      if not 0 < num_bytes <= 8 or offset + num_bytes > len(data):
+        raise ValueError('Invalid DER length.')
+      length = int.from_bytes(data[offset:offset + num_bytes], 'big')
+      offset += num_bytes
+    if offset + length > len(data):
+      raise ValueError('Truncated DER element.')
+    elements.append((tag, data[offset:offset + length]))
+    offset += length
+  return elements
+
+
+def der_decode_sequence(data):
+  """Decodes the elements of a DER encoded SEQUENCE.
+
+  Arguments:
+    data: The DER encoded SEQUENCE as bytes.
+
+  Returns:
+    A list with a tuple (tag, contents) for each element.
+
+  Raises:
+    ValueError: If |data| isn't a single DER encoded SEQUENCE.
+  """
+  elements = der_decode_elements(data)
+  if len(elements) != 1 or elements[0][0] != DER_TAG_SEQUENCE:
+    raise ValueError('Expected a DER SEQUENCE.')
+  return der_decode_elements(elements[0][1])
+
+
+def parse_rsa_key(data):
+  """Parses an RSA key file.
+
+  The key may be a PKCS#1 RSAPrivateKey or RSAPublicKey, a PKCS#8
+  PrivateKeyInfo or a SubjectPublicKeyInfo, either DER or PEM encoded.
+  Encrypted keys aren't supported.
+
+  Arguments:
+    data: The contents of the key file as bytes.
+
+  Returns:
+    A tuple with the modulus, the public exponent and, for private keys,
+    a tuple with the private exponent, the two primes, the exponents
+    modulo each prime minus one and the inverse of the second prime
+    modulo the first one, as in RSAPrivateKey. For public keys the last
+    element is None.
+
+  Raises:
+    ValueError: If the key couldn't be parsed.
+  """
+  if b'-----BEGIN ' in data:
+    for block in data.split(b'-----BEGIN ')[1:]:
+      label, _, rest = block.partition(b'-----')
+      if label not in (b'RSA PRIVATE KEY', b'PRIVATE KEY',
+                       b'RSA PUBLIC KEY', b'PUBLIC KEY'):
+        continue
+      body, found, _ = rest.partition(b'-----END ' + label + b'-----')
+      if not found or b':' in body:
+        # Headers are only used by encrypted keys.
+        raise ValueError('Unsupported PEM block.')
+      try:
+        return parse_rsa_key(base64.b64decode(body))
+      except binascii.Error as e:
+        raise ValueError('Invalid PEM block: {}'.format(e)) from e
+    raise ValueError('No RSA key found.')
+
+  elements = der_decode_sequence(data)
+  tags = [tag for (tag, _) in elements]
+  if tags[:2] == [DER_TAG_SEQUENCE, DER_TAG_BIT_STRING]:
+    # SubjectPublicKeyInfo, the BIT STRING holds an RSAPublicKey.
+    algorithm = der_decode_elements(elements[0][1])
+    public_key = elements[1][1]
+    if (not algorithm or algorithm[0] != (DER_TAG_OBJECT_IDENTIFIER,
+                                          DER_OID_RSA_ENCRYPTION) or
+        public_key[:1] != b'\0'):
+      raise ValueError('Not an RSA public key.')
+    elements = der_decode_sequence(public_key[1:])
+    tags = [tag for (tag, _) in elements]
+  elif tags[:3] == [DER_TAG_INTEGER, DER_TAG_SEQUENCE, DER_TAG_OCTET_STRING]:
+    # PrivateKeyInfo, the OCTET STRING holds an RSAPrivateKey.
+    algorithm = der_decode_elements(elements[1][1])
+    if not algorithm or algorithm[0] != (DER_TAG_OBJECT_IDENTIFIER,
+                                         DER_OID_RSA_ENCRYPTION):
+      raise ValueError('Not an RSA private key.')
+    elements = der_decode_sequence(elements[2][1])
+    tags = [tag for (tag, _) in elements]
+
+  if set(tags) != {DER_TAG_INTEGER}:
+    raise ValueError('Not an RSA key.')
+  numbers = [int.from_bytes(contents, 'big', signed=True)
+             for (_, contents) in elements]
+  if len(numbers) == 2:
+    # RSAPublicKey: modulus, publicExponent.
+    modulus, exponent = numbers
+    private_numbers = None
+  elif len(numbers) >= 9:
+    # RSAPrivateKey: version, modulus, publicExponent, privateExponent,
+    # prime1, prime2, exponent1, exponent2, coefficient.
+    modulus, exponent = numbers[1:3]
+    private_numbers = tuple(numbers[3:9])
+  else:
+    raise ValueError('Not an RSA key.')
+  if modulus <= 0 or exponent <= 0:
+    raise ValueError('Invalid RSA key.')
+  return modulus, exponent, private_numbers
+
+
+class PersistentSigningHelper(object):
+  """A long-lived signing helper process.
+
+  Unlike |signing_helper|, which is started once per signature, a
+  persistent signing helper is started once and kept running for all
+  signatures made by this process. Requests are written to its stdin
+  and responses read from its stdout. Every message is a sequence of
+  fields, each encoded as a 32-bit big-endian length followed by that
+  many bytes.
+
+  A request consists of three fields: the algorithm name (e.g.
+  'SHA256_RSA4096'), the key path and the data to sign, i.e. the
+  padding followed by the digest. A response consists of two fields: a
+  status and a payload. If the status is 'OK' the payload is the raw
+  signature, otherwise it's an error message. The helper should exit
+  when its stdin is closed.
+
+  Attributes:
+    program: The path to the helper program.
+  """
+
+  # Running helpers, keyed on program.
+  _helpers = {}
+
+  _lock = threading.Lock()
+
+  def __init__(self, program):
+    """Starts the helper.
+
+    Arguments:
+      program: The path to the helper program.
+
+    Raises:
+      AvbError: If the helper could not be started.
+    """
+    self.program = program
+    try:
+      self._process = subprocess.Popen([program], stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE)
+    except OSError as e:
+      raise AvbError('Error starting signing helper {}: {}'
+                     .format(program, e)) from e
+
+  @classmethod
+  def get(cls, program):
+    """Gets the running helper for |program|, starting it if needed.
+
+    Arguments:
+      program: The path to the helper program.
+
+    Returns:
+      A PersistentSigningHelper instance.
+    """
+    with cls._lock:
+      helper = cls._helpers.get(program)
+      if helper is None:
+        if not cls._helpers:
+          atexit.register(cls.close_all)
+        helper = PersistentSigningHelper(program)
+        cls._helpers[program] = helper
+      return helper
+
+  @classmethod
+  def close_all(cls):
+    """Stops all running helpers."""
+    with cls._lock:
+      helpers = list(cls._helpers.values())
+      cls._helpers.clear()
+    for helper in helpers:
+      helper.close()
+
+  def sign(self, algorithm_name, key_path, data):
+    """Asks the helper to sign |data|.
+
+    Arguments:
+      algorithm_name: The algorithm name as per the ALGORITHMS dict.
+      key_path: The key path passed to the helper.
+      data: The padding and digest to sign as bytes.
+
+    Returns:
+      The signature as bytes.
+
+    Raises:
+      AvbError: If the helper failed or reported an error.
+    """
+    with self._lock:
+      try:
+        for field in (algorithm_name.encode('utf-8'),
+                      key_path.encode('utf-8'), bytes(data)):
+          self._process.stdin.write(struct.pack('!I', len(field)))
+          self._process.stdin.write(field)
+        self._process.stdin.flush()
+        status = self._read_field()
+        payload = self._read_field()
+      except (OSError, ValueError) as e:
+        self._abandon()
+        raise AvbError('Error signing: signing helper {} failed: {}'
+                       .format(self.program, e)) from e
+    if status != b'OK':
+      raise AvbError('Error signing: {}'.format(
+          payload.decode('utf-8', errors='replace')))
+    return payload
+
+  def _read_field(self):
+    """Reads a length-prefixed field from the helper's stdout.
+
+    Returns:
+      The field as bytes.
+
+    Raises:
+      ValueError: If the helper's stdout ended early.
+    """
+    header = self._process.stdout.read(4)
+    if len(header) != 4:
+      raise ValueError('unexpected end of output')
+    (length,) = struct.unpack('!I', header)
+    field = self._process.stdout.read(length)
+    if len(field) != length:
+      raise ValueError('unexpected end of output')
+    return field
+
+  def _abandon(self):
+    """Stops a helper which failed, so the next request starts a new one."""
+    if PersistentSigningHelper._helpers.get(self.program) is self:
+      del PersistentSigningHelper._helpers[self.program]
+    self._process.kill()
+    self._process.wait()
+
+  def close(self):
+    """Closes the helper's stdin and waits for it to exit."""
+    try:
+      self._process.stdin.close()
+    except OSError:
+      pass
+    self._process.wait()
+
+
 class RSAPublicKey(object):
   """Data structure used for a RSA public key.
 
+  Keys are parsed in-process if possible, see parse_rsa_key(), and with
+  openssl(1) otherwise. Parsed keys are cached for the lifetime of the
+  process, keyed on the path, size, modification time, inode and device
+  of the key file, and so are their encodings. The |key_cache_hits| and
+  |key_cache_misses| class attributes count lookups in the cache.
+
+  If the file holds a private key, sign() can use it to sign in-process
+  instead of with openssl(1).
+
   Attributes:
     exponent: The key exponent.
     modulus: The key modulus.
@@ -347,12 +713,72 @@ class RSAPublicKey(object):
 
   MODULUS_PREFIX = b'modulus='
 
+  # Parsed keys, see __init__(), and encoded keys, see encode().
+  _key_cache = {}
+  _encoded_key_cache = {}
+  key_cache_hits = 0
+  key_cache_misses = 0
+
   def __init__(self, key_path):
     """Loads and parses an RSA key from either a private or public key file.
 
     Arguments:
       key_path: The path to a key file.
 
+    Raises:
+      AvbError: If RSA key parameters could not be read from file.
+    """
+    self.key_path = key_path
+    cache_key = None
+    try:
+      st = os.stat(key_path)
+      cache_key = (os.path.abspath(key_path), st.st_size, st.st_mtime_ns,
+                   st.st_ino, st.st_dev)
+    except OSError:
+      # Let _load_key() report the error.
+      pass
+    key = RSAPublicKey._key_cache.get(cache_key)
+    if key is None:
+      RSAPublicKey.key_cache_misses += 1
+      key = self._load_key(key_path)
+      if cache_key is not None:
+        RSAPublicKey._key_cache[cache_key] = key
+    else:
+      RSAPublicKey.key_cache_hits += 1
+    (self.modulus, self.exponent, self._private_numbers) = key
+    # The number of bits is derived from the modulus by rounding up to
+    # the nearest power of 2.
+    self.num_bits = round_to_pow2(self.modulus.bit_length())
+
+  def _load_key(self, key_path):
+    """Loads an RSA key from a file.
+
+    Arguments:
+      key_path: The path to a key file.
+
+    Returns:
+      A tuple as returned by parse_rsa_key().
+
+    Raises:
+      AvbError: If RSA key parameters could not be read from file.
+    """
+    try:
+      with open(key_path, 'rb') as f:
+        return parse_rsa_key(f.read())
+    except (OSError, ValueError):
+      # E.g. an encrypted key, let openssl(1) deal with it.
+      pass
+    return self._load_key_with_openssl(key_path), 65537, None
+
+  def _load_key_with_openssl(self, key_path):
+    """Gets the modulus of an RSA key with openssl(1).
+
+    Arguments:
+      key_path: The path to a key file.
+
+    Returns:
+      The modulus.
+
     Raises:
       AvbError: If RSA key parameters could not be read from file.
     """
@@ -388,13 +814,8 @@ class RSAPublicKey(object):
 
     modulus_hexstr = pout[len(self.MODULUS_PREFIX):]
 
-    # The exponent is assumed to always be 65537 and the number of
-    # bits can be derived from the modulus by rounding up to the
-    # nearest power of 2.
-    self.key_path = key_path
-    self.modulus = int(modulus_hexstr, 16)
-    self.num_bits = round_to_pow2(int(math.ceil(math.log(self.modulus, 2))))
-    self.exponent = 65537
+    # The exponent is assumed to always be 65537.
+    return int(modulus_hexstr, 16)
 
   def encode(self):
     """Encodes the public RSA key in |AvbRSAPublicKeyHeader| format.
@@ -410,6 +831,10 @@ class RSAPublicKey(object):
     """
     if self.exponent != 65537:
       raise AvbError('Only RSA keys with exponent 65537 are supported.')
+    cache_key = (self.num_bits, self.modulus)
+    encoded = RSAPublicKey._encoded_key_cache.get(cache_key)
+    if encoded is not None:
+      return encoded
     ret = bytearray()
     # Calculate n0inv = -1/n[0] (mod 2^32)
     b = 2 ** 32
@@ -420,27 +845,46 @@ class RSAPublicKey(object):
     ret.extend(struct.pack('!II', self.num_bits, n0inv))
     ret.extend(encode_long(self.num_bits, self.modulus))
     ret.extend(encode_long(self.num_bits, rrmodn))
-    return bytes(ret)
+    encoded = bytes(ret)
+    RSAPublicKey._encoded_key_cache[cache_key] = encoded
+    return encoded
 
   def sign(self, algorithm_name, data_to_sign, signing_helper=None,
-           signing_helper_with_files=None):
+           signing_helper_with_files=None, in_process=None,
+           signing_helper_persistent=None):
     """Sign given data using |signing_helper| or openssl.
 
-    openssl is used if neither the parameters signing_helper nor
-    signing_helper_with_files are given.
+    openssl is used if none of the parameters signing_helper,
+    signing_helper_with_files and signing_helper_persistent are given. If
+    the private key was parsed, the data can be signed in-process instead,
+    which is also done if openssl fails, e.g. because it's not installed.
 
     Arguments:
       algorithm_name: The algorithm name as per the ALGORITHMS dict.
       data_to_sign: Data to sign as bytes or bytearray.
       signing_helper: Program which signs a hash and returns the signature.
       signing_helper_with_files: Same as signing_helper but uses files instead.
+      in_process: True to sign in-process instead of with openssl, False
+        to not do so or None to use |AVB_SIGN_IN_PROCESS|.
+      signing_helper_persistent: Program which is started once and signs
+        all hashes, see PersistentSigningHelper.
 
     Returns:
       The signature as bytes.
 
     Raises:
-      AvbError: If an error occurred during signing.
+      AvbError: If an error occurred during signing or more than one
+        signing helper is given.
     """
+    helpers = [helper for helper in (signing_helper,
+                                     signing_helper_with_files,
+                                     signing_helper_persistent)
+               if helper is not None]
+    if len(helpers) > 1:
+      raise AvbError('Only one of --signing_helper, '
+                     '--signing_helper_with_files and '
+                     '--signing_helper_persistent can be used.')
+
     # Checks requested algorithm for validity.
     algorithm = ALGORITHMS.get(algorithm_name)
     if not algorithm:
@@ -460,8 +904,13 @@ class RSAPublicKey(object):
 
     # Calculates the signature.
     padding_and_hash = algorithm.padding + digest
+    if in_process is None:
+      in_process = AVB_SIGN_IN_PROCESS
     p = None
-    if signing_helper_with_files is not None:
+    if signing_helper_persistent is not None:
+      helper = PersistentSigningHelper.get(signing_helper_persistent)
+      signature = helper.sign(algorithm_name, self.key_path, padding_and_hash)
+    elif signing_helper_with_files is not None:
       with tempfile.NamedTemporaryFile() as signing_file:
         signing_file.write(padding_and_hash)
         signing_file.flush()
@@ -472,28 +921,89 @@ class RSAPublicKey(object):
           raise AvbError('Error signing')
         signing_file.seek(0)
         signature = signing_file.read()
-    else:
-      if signing_helper is not None:
-        p = subprocess.Popen(
-            [signing_helper, algorithm_name, self.key_path],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-      else:
-        p = subprocess.Popen(
-            ['openssl', 'rsautl', '-sign', '-inkey', self.key_path, '-raw'],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
+    elif signing_helper is not None:
+      p = subprocess.Popen(
+          [signing_helper, algorithm_name, self.key_path],
+          stdin=subprocess.PIPE,
+          stdout=subprocess.PIPE,
+          stderr=subprocess.PIPE)
       (pout, perr) = p.communicate(padding_and_hash)
       retcode = p.wait()
       if retcode != 0:
         raise AvbError('Error signing: {}'.format(perr))
       signature = pout
+    elif in_process and self._private_numbers is not None:
+      signature = self._sign_raw(padding_and_hash)
+    else:
+      signature = self._sign_with_openssl(padding_and_hash)
     if len(signature) != algorithm.signature_num_bytes:
       raise AvbError('Error signing: Invalid length of signature')
     return signature
 
+  def _sign_with_openssl(self, data):
+    """Signs data with openssl(1) without any padding.
+
+    If openssl fails and the private key was parsed, the data is signed
+    in-process instead.
+
+    Arguments:
+      data: The data to sign, e.g. the padded digest, as bytes.
+
+    Returns:
+      The signature as bytes.
+
+    Raises:
+      AvbError: If an error occurred during signing.
+    """
+    try:
+      p = subprocess.Popen(
+          ['openssl', 'rsautl', '-sign', '-inkey', self.key_path, '-raw'],
+          stdin=subprocess.PIPE,
+          stdout=subprocess.PIPE,
+          stderr=subprocess.PIPE)
+      (pout, perr) = p.communicate(data)
+      if p.wait() == 0:
+        return pout
+      error = perr
+    except OSError as e:
+      error = e
+    if self._private_numbers is not None:
+      # E.g. an openssl release without the rsautl command.
+      return self._sign_raw(data)
+    raise AvbError('Error signing: {}'.format(error))
+
+  def _sign_raw(self, data):
+    """Signs data with the private key without any padding.
+
+    This gives the same result as 'openssl rsautl -sign -raw'. The
+    Chinese remainder theorem is used to speed up the exponentiation
+    and the signature is checked with the public key before it's
+    returned.
+
+    Arguments:
+      data: The data to sign, e.g. the padded digest, as bytes.
+
+    Returns:
+      The signature as bytes.
+
+    Raises:
+      AvbError: If the data can't be signed or the signature is wrong.
+    """
+    (private_exponent, prime1, prime2, exponent1, exponent2,
+     coefficient) = self._private_numbers
+    message = decode_long(data)
+    if message >= self.modulus:
+      raise AvbError('Error signing: Data too large for modulus')
+    if prime1 * prime2 == self.modulus:
+      s1 = pow(message, exponent1, prime1)
+      s2 = pow(message, exponent2, prime2)
+      signature = s2 + (coefficient * (s1 - s2) % prime1) * prime2
+    else:
+      signature = pow(message, private_exponent, self.modulus)
+    if pow(signature, self.exponent, self.modulus) != message:
+      raise AvbError('Error signing: Signature verification failed')
+    return signature.to_bytes((self.modulus.bit_length() + 7) // 8, 'big')
+
 
 def lookup_algorithm_by_type(alg_type):
   """Looks up algorithm by type.
@@ -533,13 +1043,15 @@ def lookup_hash_size_by_type(alg_type):
   raise AvbError('Unsupported algorithm type {}'.format(alg_type))
 
 
-def verify_vbmeta_signature(vbmeta_header, vbmeta_blob):
+def verify_vbmeta_signature(vbmeta_header, vbmeta_blob, use_openssl=None):
   """Checks that signature in a vbmeta blob was made by the embedded public key.
 
   Arguments:
     vbmeta_header: A AvbVBMetaHeader.
     vbmeta_blob: The whole vbmeta blob, including the header as bytes or
         bytearray.
+    use_openssl: True to check the signature with openssl(1), False to
+        check it in-process or None to use |AVB_VERIFY_WITH_OPENSSL|.
 
   Returns:
     True if the signature is valid and corresponds to the embedded
@@ -589,6 +1101,43 @@ def verify_vbmeta_signature(vbmeta_header, vbmeta_blob):
   modulus = decode_long(modulus_blob)
   exponent = 65537
 
+  # Signatures openssl(1) can't decrypt are rejected up front so both
+  # ways of checking give the same result for them.
+  sig = decode_long(sig_blob)
+  if len(sig_blob) != num_bits // 8 or sig >= modulus:
+    sys.stderr.write('Signature not correct\n')
+    return False
+
+  if use_openssl is None:
+    use_openssl = AVB_VERIFY_WITH_OPENSSL
+  if use_openssl:
+    return verify_rsa_signature_with_openssl(modulus, exponent, sig_blob,
+                                             padding_and_digest)
+
+  # Raw RSA, just like avb_rsa_verify() in libavb/avb_rsa.c.
+  if encode_long(num_bits, pow(sig, exponent, modulus)) != padding_and_digest:
+    sys.stderr.write('Signature not correct\n')
+    return False
+  return True
+
+
+def verify_rsa_signature_with_openssl(modulus, exponent, sig_blob,
+                                      padding_and_digest):
+  """Checks a raw RSA signature using openssl(1).
+
+  Arguments:
+    modulus: The modulus of the public key.
+    exponent: The public exponent.
+    sig_blob: The signature as bytes.
+    padding_and_digest: The expected padded digest as bytes.
+
+  Returns:
+    True if the signature is valid.
+
+  Raises:
+    AvbError: If there errors calling out to openssl command during
+        signature verification.
+  """
   # We used to have this:
   #
   #  import Crypto.PublicKey.RSA
@@ -725,13 +1274,32 @@ class ImageHandler(object):
   tell(), and read() methods. For writing, only truncation
   (truncate()) and appending is supported (append_raw() and
   append_dont_care()). Additionally, data can only be written in units
-  of the block size.
+  of the block size. A series of writes can be wrapped in
+  append_transaction() so the sparse header is only rewritten once.
+
+  The chunk table of a sparse image can optionally be cached on disk
+  (see |AVB_SPARSE_INDEX_CACHE|) so opening the same unmodified image
+  again doesn't have to scan all chunks. The |index_cache_hits| and
+  |index_cache_misses| class attributes count lookups in this cache.
+
+  Non-sparse images are by default memory-mapped (see |AVB_IMAGE_MMAP|)
+  and read_view() returns slices of the mapping without copying. If
+  the file can't be mapped, buffered reads are used instead.
+
+  Holes in non-sparse images, i.e. ranges of a sparse file on the host
+  file system which have no data allocated, are found with
+  SEEK_DATA/SEEK_HOLE (see |AVB_IMAGE_SEEK_HOLES|). They're reported
+  as zero extents by iter_extents() and filled with zeroes by read()
+  without reading them, just like DONT_CARE chunks.
 
   Attributes:
     filename: Name of file.
     is_sparse: Whether the file being operated on is sparse.
     block_size: The block size, typically 4096.
     image_size: The size of the unsparsified file.
+    bytes_read: Number of bytes of image data read from the file so
+      far. FILL and DONT_CARE data and holes are not counted as they
+      aren't read.
   """
   # See system/core/libsparse/sparse_format.h for details.
   MAGIC = 0xed26ff3a
@@ -742,12 +1310,55 @@ class ImageHandler(object):
   NUM_CHUNKS_AND_BLOCKS_FORMAT = '<II'
   NUM_CHUNKS_AND_BLOCKS_OFFSET = 16
 
-  def __init__(self, image_filename, read_only=False):
+  # Size of the windows chunk headers are read through when scanning.
+  SCAN_WINDOW_SIZE = 64 * 1024
+
+  # Size of the pre-built buffers FILL and DONT_CARE data is copied from
+  # by readinto(). Must be a multiple of four.
+  PATTERN_BUFFER_SIZE = 64 * 1024
+  MAX_PATTERN_BUFFERS = 16
+
+  # Types of extents returned by iter_extents().
+  EXTENT_RAW = 0
+  EXTENT_FILL = 1
+  EXTENT_ZERO = 2
+
+  # Maximum size of a single raw extent returned by iter_extents().
+  MAX_RAW_EXTENT_SIZE = 1024 * 1024
+
+  # Format of the header of chunk index cache files. It's followed by
+  # the chunk table arrays in native byte order.
+  INDEX_MAGIC = b'AVBSPIDX'
+  INDEX_VERSION = 1
+  INDEX_HEADER_FORMAT = ('<8s'   # magic
+                         'L'     # version
+                         'L'     # non-zero if little-endian
+                         '4Q'    # size, mtime (ns), inode and device of file
+                         'L'     # block size
+                         'L'     # total_blocks from sparse header
+                         'L'     # total_chunks from sparse header
+                         'Q'     # number of entries in chunk table
+                         'Q')    # offset where sparse data end
+  INDEX_ENTRY_SIZE = 2 + 3 * 8 + 4
+
+  # Number of lookups in the chunk index cache, see _load_chunk_index().
+  index_cache_hits = 0
+  index_cache_misses = 0
+
+  def __init__(self, image_filename, read_only=False, index_cache_dir=None,
+               use_mmap=None, seek_holes=None):
     """Initializes an image handler.
 
     Arguments:
       image_filename: The name of the file to operate on.
       read_only: True if file is only opened for read-only operations.
+      index_cache_dir: Directory to cache the chunk table of sparse images
+          in or None to use |AVB_SPARSE_INDEX_CACHE|. A relative path is
+          relative to the directory of the image.
+      use_mmap: True to read non-sparse images through a memory mapping,
+          False to use buffered reads or None to use |AVB_IMAGE_MMAP|.
+      seek_holes: True to skip holes in non-sparse images, False to read
+          them or None to use |AVB_IMAGE_SEEK_HOLES|.
 
     Raises:
       ValueError: If data in the file is invalid.
@@ -757,13 +1368,38 @@ class ImageHandler(object):
     self._num_total_chunks = 0
     self._file_pos = 0
     self._read_only = read_only
+    self._transaction_depth = 0
+    self._header_dirty = False
+    if index_cache_dir is None:
+      index_cache_dir = AVB_SPARSE_INDEX_CACHE
+    self._index_path = None
+    if index_cache_dir:
+      self._index_path = self._get_index_path(index_cache_dir)
+    self._index_stale = False
+    if use_mmap is None:
+      use_mmap = AVB_IMAGE_MMAP
+    self._use_mmap = use_mmap
+    self._mmap = None
+    self._mmap_view = None
+    if seek_holes is None:
+      seek_holes = AVB_IMAGE_SEEK_HOLES
+    self._seek_holes = seek_holes and hasattr(os, 'SEEK_DATA')
+    self._data_starts = None
+    self._data_ends = None
+    # Guards creating the mapping and finding the data ranges, which
+    # happens lazily, possibly from several reading threads at once.
+    self._lazy_init_lock = threading.Lock()
+    self._pattern_buffers = {}
+    self.bytes_read = 0
+    self._bytes_read_lock = threading.Lock()
     self._read_header()
 
   def _read_header(self):
     """Initializes internal data structures used for reading file.
 
-    This may be called multiple times and is typically called after
-    modifying the file (e.g. appending, truncation).
+    This is called when the handler is constructed. Appends and
+    truncations keep the chunk table up to date without calling this
+    again.
 
     Raises:
       ValueError: If data in the file is invalid.
@@ -798,76 +1434,261 @@ class ImageHandler(object):
                        format(chunk_hdr_sz))
 
     self.block_size = block_size
+    if not self._load_chunk_index():
+      self._scan_chunks(file_hdr_sz)
+      self._save_chunk_index()
+    self.is_sparse = True
 
-    # Build an list of chunks by parsing the file.
-    self._chunks = []
+  def _get_index_path(self, index_cache_dir):
+    """Returns the path of the chunk index cache file for the image.
 
-    # Find the smallest offset where only "Don't care" chunks
-    # follow. This will be the size of the content in the sparse
-    # image.
-    offset = 0
-    output_offset = 0
-    for _ in range(1, self._num_total_chunks + 1):
-      chunk_offset = self._image.tell()
+    Arguments:
+      index_cache_dir: Directory to store the index in, a relative path is
+          relative to the directory of the image.
+
+    Returns:
+      The path of the index file.
+    """
+    abs_path = os.path.abspath(self.filename)
+    index_dir = os.path.join(os.path.dirname(abs_path), index_cache_dir)
+    path_digest = hashlib.sha1(abs_path.encode('utf-8')).hexdigest()
+    return os.path.join(index_dir, '{}.{}.avbidx'.format(
+        os.path.basename(abs_path), path_digest[0:16]))
+
+  def _get_index_key(self):
+    """Returns the values identifying the current contents of the file."""
+    st = os.fstat(self._image.fileno())
+    return (st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev)
+
+  def _log_index_lookup(self, hit):
+    """Counts a lookup in the chunk index cache.
+
+    Arguments:
+      hit: True if the chunk table was loaded from the cache.
+    """
+    if hit:
+      ImageHandler.index_cache_hits += 1
+    else:
+      ImageHandler.index_cache_misses += 1
+    if AVB_SPARSE_INDEX_CACHE_LOGFILE:
+      with open(AVB_SPARSE_INDEX_CACHE_LOGFILE, 'a') as log:
+        log.write('{} {}\n'.format('hit' if hit else 'miss', self._index_path))
+
+  def _load_chunk_index(self):
+    """Loads the chunk table from the chunk index cache.
+
+    The index is only used if it was written for a file with the same
+    size, modification time, inode and device as well as the same sparse
+    header values as the file being opened.
+
+    Returns:
+      True if the chunk table was loaded, False otherwise.
+    """
+    if not self._index_path:
+      return False
+    try:
+      with open(self._index_path, 'rb') as f:
+        index_data = f.read()
+    except OSError:
+      self._log_index_lookup(False)
+      return False
+
+    header_size = struct.calcsize(self.INDEX_HEADER_FORMAT)
+    try:
+      (magic, version, little_endian, size, mtime_ns, ino, dev, block_size,
+       num_total_blocks, num_total_chunks, num_entries,
+       sparse_end) = struct.unpack(self.INDEX_HEADER_FORMAT,
+                                   index_data[0:header_size])
+    except struct.error:
+      magic = None
+    if (magic != self.INDEX_MAGIC or version != self.INDEX_VERSION or
+        bool(little_endian) != (sys.byteorder == 'little') or
+        (size, mtime_ns, ino, dev) != self._get_index_key() or
+        block_size != self.block_size or
+        num_total_blocks != self._num_total_blocks or
+        num_total_chunks != self._num_total_chunks or
+        len(index_data) != header_size + num_entries * self.INDEX_ENTRY_SIZE):
+      self._log_index_lookup(False)
+      return False
+
+    o = header_size
+    self._chunk_types = array.array('H')
+    self._chunk_types.frombytes(index_data[o:o + num_entries * 2])
+    o += num_entries * 2
+    self._chunk_offsets = array.array('Q')
+    self._chunk_offsets.frombytes(index_data[o:o + num_entries * 8])
+    o += num_entries * 8
+    self._chunk_output_offsets = array.array('Q')
+    self._chunk_output_offsets.frombytes(index_data[o:o + num_entries * 8])
+    o += num_entries * 8
+    self._chunk_output_sizes = array.array('Q')
+    self._chunk_output_sizes.frombytes(index_data[o:o + num_entries * 8])
+    o += num_entries * 8
+    self._chunk_fill_data = bytearray(index_data[o:o + num_entries * 4])
+    self._sparse_end = sparse_end
+    self.image_size = 0
+    if num_entries > 0:
+      self.image_size = (self._chunk_output_offsets[-1] +
+                         self._chunk_output_sizes[-1])
+    self._log_index_lookup(True)
+    return True
+
+  def _save_chunk_index(self):
+    """Stores the chunk table in the chunk index cache, if enabled.
+
+    Failure to write the index is not an error, the chunk table is just
+    scanned again next time.
+    """
+    if not self._index_path:
+      return
+    (size, mtime_ns, ino, dev) = self._get_index_key()
+    header = struct.pack(self.INDEX_HEADER_FORMAT, self.INDEX_MAGIC,
+                         self.INDEX_VERSION, sys.byteorder == 'little',
+                         size, mtime_ns, ino, dev, self.block_size,
+                         self._num_total_blocks, self._num_total_chunks,
+                         len(self._chunk_types), self._sparse_end)
+    tmp_path = '{}.{}.tmp'.format(self._index_path, os.getpid())
+    try:
+      os.makedirs(os.path.dirname(self._index_path), exist_ok=True)
+      with open(tmp_path, 'wb') as f:
+        f.write(header)
+        f.write(self._chunk_types.tobytes())
+        f.write(self._chunk_offsets.tobytes())
+        f.write(self._chunk_output_offsets.tobytes())
+        f.write(self._chunk_output_sizes.tobytes())
+        f.write(self._chunk_fill_data)
+      # Atomically replace the index so concurrent readers never see a
+      # partially written file.
+      os.replace(tmp_path, self._index_path)
+      self._index_stale = False
+    except OSError:
+      try:
+        os.unlink(tmp_path)
+      except OSError:
+        pass
+
+  def _invalidate_chunk_index(self):
+    """Removes the cached chunk index since the file is being modified.
+
+    The index is written again the next time the file is flushed.
+    """
+    if not self._index_path or self._index_stale:
+      return
+    self._index_stale = True
+    try:
+      os.unlink(self._index_path)
+    except OSError:
+      pass
+
+  def _scan_chunks(self, chunks_offset):
+    """Builds the chunk table by scanning all chunk headers.
+
+    Chunk headers are decoded from large buffered windows of the file
+    so runs of FILL and DONT_CARE chunks (and small RAW chunks) don't
+    cost a read and a seek each. The table is stored in compact
+    parallel arrays instead of one object per chunk:
+
+      _chunk_types: Chunk type of each chunk.
+      _chunk_offsets: Offset in the sparse file where the chunk begins.
+      _chunk_output_offsets: Offset in de-sparsified file of the chunk.
+      _chunk_output_sizes: Number of bytes in output.
+      _chunk_fill_data: Four bytes of fill data per chunk (all zeroes
+          unless the chunk is TYPE_FILL).
+
+    CRC32 chunks are validated but not added to the table.
+
+    Arguments:
+      chunks_offset: Offset in the sparse file where the first chunk begins.
 
-      header_bin = self._image.read(struct.calcsize(ImageChunk.FORMAT))
-      (chunk_type, _, chunk_sz, total_sz) = struct.unpack(ImageChunk.FORMAT,
-                                                          header_bin)
-      data_sz = total_sz - struct.calcsize(ImageChunk.FORMAT)
+    Raises:
+      ValueError: If data in the file is invalid.
+    """
+    self._chunk_types = array.array('H')
+    self._chunk_offsets = array.array('Q')
+    self._chunk_output_offsets = array.array('Q')
+    self._chunk_output_sizes = array.array('Q')
+    self._chunk_fill_data = bytearray()
+
+    file_size = self.image_size
+    chunk_struct = struct.Struct(ImageChunk.FORMAT)
+    chunk_hdr_sz = chunk_struct.size
+    block_size = self.block_size
+
+    # Local aliases, this loop runs once per chunk.
+    unpack_from = chunk_struct.unpack_from
+    add_type = self._chunk_types.append
+    add_offset = self._chunk_offsets.append
+    add_output_offset = self._chunk_output_offsets.append
+    add_output_size = self._chunk_output_sizes.append
+    add_fill_data = self._chunk_fill_data.extend
+    no_fill_data = b'\0' * 4
+
+    window = b''
+    window_offset = 0
+    chunk_offset = chunks_offset
+    output_offset = 0
+    for _ in range(self._num_total_chunks):
+      pos = chunk_offset - window_offset
+      if pos < 0 or pos + chunk_hdr_sz + 4 > len(window):
+        # The header (and possibly fill data) isn't fully in the current
+        # window, read a new one starting at the header.
+        self._image.seek(chunk_offset)
+        window = self._image.read(self.SCAN_WINDOW_SIZE)
+        window_offset = chunk_offset
+        pos = 0
+        if len(window) < chunk_hdr_sz:
+          raise ValueError('Chunk header at offset {} is truncated.'
+                           .format(chunk_offset))
+      (chunk_type, _, chunk_sz, total_sz) = unpack_from(window, pos)
+      data_sz = total_sz - chunk_hdr_sz
+      output_size = chunk_sz * block_size
 
       if chunk_type == ImageChunk.TYPE_RAW:
-        if data_sz != (chunk_sz * self.block_size):
+        if data_sz != output_size:
           raise ValueError('Raw chunk input size ({}) does not match output '
                            'size ({})'.
-                           format(data_sz, chunk_sz*self.block_size))
-        self._chunks.append(ImageChunk(ImageChunk.TYPE_RAW,
-                                       chunk_offset,
-                                       output_offset,
-                                       chunk_sz*self.block_size,
-                                       self._image.tell(),
-                                       None))
-        self._image.seek(data_sz, os.SEEK_CUR)
-
+                           format(data_sz, output_size))
+        add_fill_data(no_fill_data)
       elif chunk_type == ImageChunk.TYPE_FILL:
         if data_sz != 4:
           raise ValueError('Fill chunk should have 4 bytes of fill, but this '
                            'has {}'.format(data_sz))
-        fill_data = self._image.read(4)
-        self._chunks.append(ImageChunk(ImageChunk.TYPE_FILL,
-                                       chunk_offset,
-                                       output_offset,
-                                       chunk_sz*self.block_size,
-                                       None,
-                                       fill_data))
+        fill_data = window[pos + chunk_hdr_sz:pos + chunk_hdr_sz + 4]
+        if len(fill_data) != 4:
+          raise ValueError('Fill chunk at offset {} is truncated.'
+                           .format(chunk_offset))
+        add_fill_data(fill_data)
       elif chunk_type == ImageChunk.TYPE_DONT_CARE:
         if data_sz != 0:
           raise ValueError('Don\'t care chunk input size is non-zero ({})'.
                            format(data_sz))
-        self._chunks.append(ImageChunk(ImageChunk.TYPE_DONT_CARE,
-                                       chunk_offset,
-                                       output_offset,
-                                       chunk_sz*self.block_size,
-                                       None,
-                                       None))
+        add_fill_data(no_fill_data)
       elif chunk_type == ImageChunk.TYPE_CRC32:
         if data_sz != 4:
           raise ValueError('CRC32 chunk should have 4 bytes of CRC, but '
                            'this has {}'.format(data_sz))
-        self._image.read(4)
+        chunk_offset += total_sz
+        continue
       else:
         raise ValueError('Unknown chunk type {}'.format(chunk_type))
 
-      offset += chunk_sz
-      output_offset += chunk_sz*self.block_size
+      add_type(chunk_type)
+      add_offset(chunk_offset)
+      add_output_offset(output_offset)
+      add_output_size(output_size)
+      chunk_offset += total_sz
+      output_offset += output_size
 
     # Record where sparse data end.
-    self._sparse_end = self._image.tell()
+    self._sparse_end = chunk_offset
 
     # Now that we've traversed all chunks, sanity check.
-    if self._num_total_blocks != offset:
+    num_blocks = output_offset // block_size
+    if self._num_total_blocks != num_blocks:
       raise ValueError('The header said we should have {} output blocks, '
-                       'but we saw {}'.format(self._num_total_blocks, offset))
-    junk_len = len(self._image.read())
+                       'but we saw {}'.format(self._num_total_blocks,
+                                              num_blocks))
+    junk_len = file_size - self._sparse_end
     if junk_len > 0:
       raise ValueError('There were {} bytes of extra data at the end of the '
                        'file.'.format(junk_len))
@@ -875,11 +1696,6 @@ class ImageHandler(object):
     # Assign |image_size|.
     self.image_size = output_offset
 
-    # This is used when bisecting in read() to find the initial slice.
-    self._chunk_output_offsets = [i.output_offset for i in self._chunks]
-
-    self.is_sparse = True
-
   def _update_chunks_and_blocks(self):
     """Helper function to update the image header.
 
@@ -887,11 +1703,75 @@ class ImageHandler(object):
     will be set to value of the |_num_total_blocks| and
     |_num_total_chunks| attributes.
 
+    If an append transaction is in progress the update is deferred
+    until the transaction is committed.
     """
+    self._invalidate_chunk_index()
+    self._header_dirty = True
+    if self._transaction_depth == 0:
+      self._write_chunks_and_blocks()
+
+  def _write_chunks_and_blocks(self):
+    """Writes a pending update of the image header, if any."""
+    if not self._header_dirty:
+      return
     self._image.seek(self.NUM_CHUNKS_AND_BLOCKS_OFFSET, os.SEEK_SET)
     self._image.write(struct.pack(self.NUM_CHUNKS_AND_BLOCKS_FORMAT,
                                   self._num_total_blocks,
                                   self._num_total_chunks))
+    self._header_dirty = False
+
+  def _add_appended_chunk(self, chunk_type, output_size, data_sz, fill_data):
+    """Records a chunk just written at |_sparse_end| in the chunk table.
+
+    This keeps the in-memory chunk table in sync with the file without
+    having to parse all chunks again.
+
+    Arguments:
+      chunk_type: One of TYPE_RAW, TYPE_FILL, or TYPE_DONT_CARE.
+      output_size: Number of bytes in output.
+      data_sz: Number of bytes following the chunk header in the file.
+      fill_data: Blob with data to fill if TYPE_FILL otherwise None.
+    """
+    self._chunk_types.append(chunk_type)
+    self._chunk_offsets.append(self._sparse_end)
+    self._chunk_output_offsets.append(self.image_size)
+    self._chunk_output_sizes.append(output_size)
+    self._chunk_fill_data.extend(fill_data or b'\0' * 4)
+    self._sparse_end += struct.calcsize(ImageChunk.FORMAT) + data_sz
+    self.image_size += output_size
+
+  @contextlib.contextmanager
+  def append_transaction(self):
+    """Batches header updates for a series of appends and truncations.
+
+    While the transaction is open, the |total_chunks| and |total_blocks|
+    fields in the sparse header are only tracked in memory. They are
+    written out once when the outermost transaction is committed, even
+    if an exception is raised. Transactions may be nested.
+
+    Yields:
+      This ImageHandler.
+    """
+    self._transaction_depth += 1
+    try:
+      yield self
+    finally:
+      self._transaction_depth -= 1
+      if self._transaction_depth == 0:
+        self.flush()
+
+  def flush(self):
+    """Writes out any pending header update and flushes the file.
+
+    This must be called before the file is accessed by other means,
+    e.g. by an external program, while an append transaction is open.
+    """
+    self._write_chunks_and_blocks()
+    if not self._read_only:
+      self._image.flush()
+    if self._index_stale and self.is_sparse:
+      self._save_chunk_index()
 
   def append_dont_care(self, num_bytes):
     """Appends a DONT_CARE chunk to the sparse file.
@@ -910,12 +1790,13 @@ class ImageHandler(object):
       raise OSError('ImageHandler is in read-only mode.')
 
     if not self.is_sparse:
+      self._drop_mapping()
       self._image.seek(0, os.SEEK_END)
+      self.image_size = self._image.tell() + num_bytes
       # This is more efficient that writing NUL bytes since it'll add
       # a hole on file systems that support sparse files (native
       # sparse, not Android sparse).
-      self._image.truncate(self._image.tell() + num_bytes)
-      self._read_header()
+      self._image.truncate(self.image_size)
       return
 
     self._num_total_chunks += 1
@@ -928,7 +1809,7 @@ class ImageHandler(object):
                                   0,  # Reserved
                                   num_bytes // self.block_size,
                                   struct.calcsize(ImageChunk.FORMAT)))
-    self._read_header()
+    self._add_appended_chunk(ImageChunk.TYPE_DONT_CARE, num_bytes, 0, None)
 
   def append_raw(self, data, multiple_block_size=True):
     """Appends a RAW chunk to the sparse file.
@@ -951,11 +1832,16 @@ class ImageHandler(object):
       raise OSError('ImageHandler is in read-only mode.')
 
     if not self.is_sparse:
+      self._drop_mapping()
       self._image.seek(0, os.SEEK_END)
       self._image.write(data)
-      self._read_header()
+      self.image_size = self._image.tell()
       return
 
+    if len(data) % self.block_size != 0:
+      raise ValueError('Raw chunk input size ({}) is not a multiple of the '
+                       'block size ({})'.format(len(data), self.block_size))
+
     self._num_total_chunks += 1
     self._num_total_blocks += len(data) // self.block_size
     self._update_chunks_and_blocks()
@@ -968,7 +1854,7 @@ class ImageHandler(object):
                                   len(data) +
                                   struct.calcsize(ImageChunk.FORMAT)))
     self._image.write(data)
-    self._read_header()
+    self._add_appended_chunk(ImageChunk.TYPE_RAW, len(data), len(data), None)
 
   def append_fill(self, fill_data, size):
     """Appends a fill chunk to the sparse file.
@@ -990,9 +1876,10 @@ class ImageHandler(object):
       raise OSError('ImageHandler is in read-only mode.')
 
     if not self.is_sparse:
+      self._drop_mapping()
       self._image.seek(0, os.SEEK_END)
       self._image.write(fill_data * (size//4))
-      self._read_header()
+      self.image_size = self._image.tell()
       return
 
     self._num_total_chunks += 1
@@ -1006,7 +1893,7 @@ class ImageHandler(object):
                                   size // self.block_size,
                                   4 + struct.calcsize(ImageChunk.FORMAT)))
     self._image.write(fill_data)
-    self._read_header()
+    self._add_appended_chunk(ImageChunk.TYPE_FILL, size, 4, fill_data)
 
   def seek(self, offset):
     """Sets the cursor position for reading from unsparsified file.
@@ -1036,49 +1923,405 @@ class ImageHandler(object):
     Returns:
       The data as bytes.
     """
-    if not self.is_sparse:
-      self._image.seek(self._file_pos)
-      data = self._image.read(size)
+    if not self.is_sparse and not self._has_holes(self._file_pos, size):
+      mapping = self._get_mapping()
+      if mapping is not None:
+        start = min(self._file_pos, len(mapping))
+        data = bytes(mapping[start:start + size])
+      else:
+        self._image.seek(self._file_pos)
+        data = self._image.read(size)
       self._file_pos += len(data)
+      self._count_read(len(data))
       return data
 
-    # Iterate over all chunks.
-    chunk_idx = bisect.bisect_right(self._chunk_output_offsets,
-                                    self._file_pos) - 1
-    data = bytearray()
-    to_go = size
-    while to_go > 0:
-      chunk = self._chunks[chunk_idx]
-      chunk_pos_offset = self._file_pos - chunk.output_offset
-      chunk_pos_to_go = min(chunk.output_size - chunk_pos_offset, to_go)
-
-      if chunk.chunk_type == ImageChunk.TYPE_RAW:
-        self._image.seek(chunk.input_offset + chunk_pos_offset)
-        data.extend(self._image.read(chunk_pos_to_go))
-      elif chunk.chunk_type == ImageChunk.TYPE_FILL:
-        all_data = chunk.fill_data*(chunk_pos_to_go // len(chunk.fill_data) + 2)
-        offset_mod = chunk_pos_offset % len(chunk.fill_data)
-        data.extend(all_data[offset_mod:(offset_mod + chunk_pos_to_go)])
-      else:
-        assert chunk.chunk_type == ImageChunk.TYPE_DONT_CARE
-        data.extend(b'\0' * chunk_pos_to_go)
+    data = bytearray(max(min(size, self.image_size - self._file_pos), 0))
+    self.readinto(data)
+    return bytes(data)
 
-      to_go -= chunk_pos_to_go
-      self._file_pos += chunk_pos_to_go
-      chunk_idx += 1
-      # Generate partial read in case of EOF.
-      if chunk_idx >= len(self._chunks):
-        break
+  def readinto(self, buffer):
+    """Reads data from the unsparsified file into a buffer.
 
-    return bytes(data)
+    Reads up to len(buffer) bytes directly into |buffer| without
+    allocating intermediate objects. Fewer bytes are read if the end of
+    the file is encountered.
 
-  def tell(self):
-    """Returns the file cursor position for reading from unsparsified file.
+    The file cursor for reading is advanced by the number of bytes
+    read.
+
+    Arguments:
+      buffer: A writable bytes-like object, e.g. a bytearray or a
+          memoryview of one.
 
     Returns:
-      The file cursor position for reading.
+      The number of bytes read.
     """
-    return self._file_pos
+    view = memoryview(buffer)
+    if view.format != 'B' or view.ndim != 1:
+      view = view.cast('B')
+    if not self.is_sparse and self._has_holes(self._file_pos, len(view)):
+      num_read = 0
+      for (extent_type, _, extent_size, data) in (
+          self.iter_extents(self._file_pos, len(view))):
+        dest = view[num_read:num_read + extent_size]
+        if extent_type == self.EXTENT_RAW:
+          dest[:] = data
+        else:
+          self._copy_pattern(dest, b'\0\0\0\0', 0)
+        num_read += extent_size
+      self._file_pos += num_read
+      return num_read
+    if not self.is_sparse:
+      mapping = self._get_mapping()
+      if mapping is not None:
+        start = min(self._file_pos, len(mapping))
+        num_read = min(len(view), len(mapping) - start)
+        view[:num_read] = mapping[start:start + num_read]
+      else:
+        self._image.seek(self._file_pos)
+        num_read = self._image.readinto(view)
+      self._file_pos += num_read
+      self._count_read(num_read)
+      return num_read
+
+    size = min(len(view), self.image_size - self._file_pos)
+    if size <= 0:
+      return 0
+    output_offsets = self._chunk_output_offsets
+    chunk_idx = bisect.bisect_right(output_offsets, self._file_pos) - 1
+    chunk_pos_offset = self._file_pos - output_offsets[chunk_idx]
+    pos = 0
+    while pos < size:
+      chunk_type = self._chunk_types[chunk_idx]
+      chunk_pos_to_go = min(
+          self._chunk_output_sizes[chunk_idx] - chunk_pos_offset, size - pos)
+      if chunk_pos_to_go == len(view):
+        dest = view
+      else:
+        dest = view[pos:pos + chunk_pos_to_go]
+
+      if chunk_type == ImageChunk.TYPE_RAW:
+        self._image.seek(self._chunk_offsets[chunk_idx] +
+                         struct.calcsize(ImageChunk.FORMAT) + chunk_pos_offset)
+        self._count_read(self._image.readinto(dest))
+      elif chunk_type == ImageChunk.TYPE_FILL:
+        fill_data = bytes(self._chunk_fill_data[chunk_idx * 4:
+                                                chunk_idx * 4 + 4])
+        self._copy_pattern(dest, fill_data, chunk_pos_offset % 4)
+      else:
+        assert chunk_type == ImageChunk.TYPE_DONT_CARE
+        self._copy_pattern(dest, b'\0\0\0\0', 0)
+
+      pos += chunk_pos_to_go
+      chunk_idx += 1
+      chunk_pos_offset = 0
+
+    self._file_pos += size
+    return size
+
+  def _count_read(self, num_bytes):
+    """Adds to |bytes_read|, safe to call from several threads."""
+    with self._bytes_read_lock:
+      self.bytes_read += num_bytes
+
+  def log_io_stats(self, operation):
+    """Logs |bytes_read| to |AVB_IO_STATS_LOGFILE|, if set.
+
+    Arguments:
+      operation: Name of the operation the image was opened for.
+    """
+    if AVB_IO_STATS_LOGFILE:
+      with open(AVB_IO_STATS_LOGFILE, 'a') as log:
+        log.write('{} {} bytes_read={} image_size={}\n'.format(
+            operation, self.filename, self.bytes_read, self.image_size))
+
+  def _copy_pattern(self, dest, fill_data, phase):
+    """Fills a buffer with a repeated four byte pattern.
+
+    Arguments:
+      dest: A writable memoryview to fill.
+      fill_data: The four byte pattern as bytes.
+      phase: Offset into the pattern the first byte of |dest| is at.
+    """
+    pattern = self._pattern_buffers.get(fill_data)
+    if pattern is None:
+      if len(self._pattern_buffers) >= self.MAX_PATTERN_BUFFERS:
+        self._pattern_buffers.clear()
+      pattern = memoryview(fill_data * (self.PATTERN_BUFFER_SIZE // 4 + 1))
+      self._pattern_buffers[fill_data] = pattern
+    size = len(dest)
+    if size <= self.PATTERN_BUFFER_SIZE:
+      dest[:] = pattern[phase:phase + size]
+      return
+    src = pattern[phase:phase + self.PATTERN_BUFFER_SIZE]
+    for offset in range(0, size, self.PATTERN_BUFFER_SIZE):
+      num_bytes = min(self.PATTERN_BUFFER_SIZE, size - offset)
+      dest[offset:offset + num_bytes] = src[:num_bytes]
+
+  def read_view(self, size):
+    """Reads data from the unsparsified file, avoiding copies if possible.
+
+    This is like read() but returns a memoryview. For memory-mapped
+    images the view references the mapping directly, so it must not be
+    used after the image has been modified.
+
+    Arguments:
+      size: Number of bytes to read.
+
+    Returns:
+      The data as a memoryview.
+    """
+    if not self.is_sparse and not self._has_holes(self._file_pos, size):
+      mapping = self._get_mapping()
+      if mapping is not None:
+        start = min(self._file_pos, len(mapping))
+        end = min(start + size, len(mapping))
+        self._file_pos += end - start
+        self._count_read(end - start)
+        return mapping[start:end]
+    data = bytearray(max(min(size, self.image_size - self._file_pos), 0))
+    self.readinto(data)
+    return memoryview(data)
+
+  def _get_mapping(self):
+    """Returns a read-only memory mapping of a non-sparse image.
+
+    The mapping is created on first use and dropped by _drop_mapping()
+    whenever the file is modified.
+
+    Returns:
+      A memoryview of the mapping or None if memory mapping is disabled
+      or the file can't be mapped, e.g. because it's empty.
+    """
+    if self._mmap is None and self._use_mmap:
+      with self._lazy_init_lock:
+        if self._mmap is None and self._use_mmap:
+          if not self._read_only:
+            self._image.flush()
+          try:
+            mapping = mmap.mmap(self._image.fileno(), 0,
+                                access=mmap.ACCESS_READ)
+            # The view is set first so threads which don't take the
+            # lock never see the mapping without it.
+            self._mmap_view = memoryview(mapping)
+            self._mmap = mapping
+          except ValueError:
+            # Empty files can't be mapped, try again once data is
+            # appended.
+            pass
+          except OSError:
+            self._use_mmap = False
+    return self._mmap_view
+
+  def _drop_mapping(self):
+    """Releases the memory mapping of the image, if any.
+
+    The data ranges found by _get_data_ranges() are dropped as well.
+    """
+    self._data_starts = None
+    self._data_ends = None
+    if self._mmap is not None:
+      self._mmap_view.release()
+      self._mmap_view = None
+      try:
+        self._mmap.close()
+      except BufferError:
+        # Views returned by read_view() are still around, the mapping
+        # goes away together with the last of them.
+        pass
+      self._mmap = None
+
+  def _release_mapped_pages(self, offset, size):
+    """Unmaps pages of the memory mapping which were read.
+
+    This keeps the resident set of a process reading a large image
+    through the mapping small. The data stays in the page cache and is
+    mapped again if it's accessed later, so views of the range remain
+    valid.
+
+    Arguments:
+      offset: Offset of the range.
+      size: Size of the range.
+    """
+    if self._mmap is not None and hasattr(mmap, 'MADV_DONTNEED'):
+      start = offset - offset % mmap.PAGESIZE
+      self._mmap.madvise(mmap.MADV_DONTNEED, start, offset + size - start)
+
+  def _get_data_ranges(self):
+    """Returns the ranges of a non-sparse image which aren't holes.
+
+    The ranges are found with SEEK_DATA/SEEK_HOLE on first use and
+    dropped by _drop_mapping() whenever the file is modified. On file
+    systems without support for holes the whole file is one range.
+
+    Returns:
+      A tuple of two lists with the start and end offsets of the ranges
+      or None if holes aren't looked for.
+    """
+    if self._data_starts is None and self._seek_holes:
+      with self._lazy_init_lock:
+        if self._data_starts is None and self._seek_holes:
+          self._find_data_ranges()
+    if self._data_starts is None:
+      return None
+    return self._data_starts, self._data_ends
+
+  def _find_data_ranges(self):
+    """Finds the data ranges for _get_data_ranges().
+
+    Must be called with |_lazy_init_lock| held.
+    """
+    if not self._read_only:
+      self._image.flush()
+    fd = self._image.fileno()
+    # The file offset is shared with |_image|, so it must be restored.
+    saved_pos = os.lseek(fd, 0, os.SEEK_CUR)
+    starts = []
+    ends = []
+    pos = 0
+    try:
+      while pos < self.image_size:
+        try:
+          pos = os.lseek(fd, pos, os.SEEK_DATA)
+        except OSError as e:
+          if e.errno != errno.ENXIO:
+            raise
+          # There's only a hole up to the end of the file.
+          break
+        starts.append(pos)
+        pos = os.lseek(fd, pos, os.SEEK_HOLE)
+        ends.append(pos)
+    except OSError:
+      self._seek_holes = False
+      return
+    finally:
+      os.lseek(fd, saved_pos, os.SEEK_SET)
+    # |_data_starts| is checked without the lock, so it's set last.
+    self._data_ends = ends
+    self._data_starts = starts
+
+  def _has_holes(self, offset, size):
+    """Checks whether a range of a non-sparse image overlaps a hole.
+
+    Arguments:
+      offset: Offset of the range.
+      size: Size of the range.
+
+    Returns:
+      True if part of the range is a hole.
+    """
+    end = min(offset + size, self.image_size)
+    if end <= offset:
+      return False
+    ranges = self._get_data_ranges()
+    if ranges is None:
+      return False
+    starts, ends = ranges
+    idx = bisect.bisect_right(starts, offset) - 1
+    return idx < 0 or ends[idx] < end
+
+  def iter_extents(self, offset, size, max_raw_size=None):
+    """Iterates over the content of a range of the unsparsified file.
+
+    Unlike read(), this exposes the structure of sparse images so
+    callers can handle runs of repeated data without expanding them.
+    Zero-filled FILL chunks and holes of non-sparse images are reported
+    as zero extents. Adjacent
+    extents may have the same type. The range is clamped to the size
+    of the image and the read cursor is not changed.
+
+    Data is read with positional reads, so several iterators over
+    different ranges may be used from different threads as long as the
+    image isn't modified meanwhile.
+
+    Arguments:
+      offset: Offset of the range in the unsparsified file.
+      size: Size of the range.
+      max_raw_size: Maximum size of raw extents or None to use
+          |MAX_RAW_EXTENT_SIZE|. Larger runs of raw data are split.
+
+    Yields:
+      Tuples (extent_type, extent_offset, extent_size, data). For
+      |EXTENT_RAW| |data| is a memoryview with the data, for
+      |EXTENT_FILL| it's the four byte pattern as bytes, rotated so the
+      extent starts with its first byte, and for |EXTENT_ZERO| it's None.
+    """
+    if max_raw_size is None:
+      max_raw_size = self.MAX_RAW_EXTENT_SIZE
+    pos = offset
+    end = min(offset + size, self.image_size)
+    if not self._read_only:
+      self._image.flush()
+    fd = self._image.fileno()
+
+    if not self.is_sparse:
+      mapping = self._get_mapping()
+      ranges = self._get_data_ranges()
+      while pos < end:
+        data_end = end
+        if ranges is not None:
+          starts, ends = ranges
+          idx = bisect.bisect_right(starts, pos) - 1
+          if idx < 0 or ends[idx] <= pos:
+            hole_end = end
+            if idx + 1 < len(starts):
+              hole_end = min(starts[idx + 1], end)
+            yield self.EXTENT_ZERO, pos, hole_end - pos, None
+            pos = hole_end
+            continue
+          data_end = min(ends[idx], end)
+        num_bytes = min(max_raw_size, data_end - pos)
+        if mapping is not None:
+          data = mapping[pos:pos + num_bytes]
+        else:
+          data = memoryview(os.pread(fd, num_bytes, pos))
+        self._count_read(len(data))
+        yield self.EXTENT_RAW, pos, len(data), data
+        if mapping is not None:
+          self._release_mapped_pages(pos, num_bytes)
+        pos += num_bytes
+      return
+
+    chunk_idx = bisect.bisect_right(self._chunk_output_offsets, pos) - 1
+    while pos < end:
+      chunk_type = self._chunk_types[chunk_idx]
+      chunk_pos_offset = pos - self._chunk_output_offsets[chunk_idx]
+      extent_end = min(self._chunk_output_offsets[chunk_idx] +
+                       self._chunk_output_sizes[chunk_idx], end)
+
+      if chunk_type == ImageChunk.TYPE_RAW:
+        data_offset = (self._chunk_offsets[chunk_idx] +
+                       struct.calcsize(ImageChunk.FORMAT) + chunk_pos_offset)
+        while pos < extent_end:
+          num_bytes = min(max_raw_size, extent_end - pos)
+          data = memoryview(os.pread(fd, num_bytes, data_offset))
+          self._count_read(len(data))
+          yield self.EXTENT_RAW, pos, num_bytes, data
+          data_offset += num_bytes
+          pos += num_bytes
+      elif chunk_type == ImageChunk.TYPE_FILL:
+        fill_data = bytes(self._chunk_fill_data[chunk_idx * 4:
+                                                chunk_idx * 4 + 4])
+        if fill_data == b'\0\0\0\0':
+          yield self.EXTENT_ZERO, pos, extent_end - pos, None
+        else:
+          phase = chunk_pos_offset % 4
+          yield (self.EXTENT_FILL, pos, extent_end - pos,
+                 fill_data[phase:] + fill_data[:phase])
+      else:
+        assert chunk_type == ImageChunk.TYPE_DONT_CARE
+        yield self.EXTENT_ZERO, pos, extent_end - pos, None
+
+      pos = extent_end
+      chunk_idx += 1
+
+  def tell(self):
+    """Returns the file cursor position for reading from unsparsified file.
+
+    Returns:
+      The file cursor position for reading.
+    """
+    return self._file_pos
 
   def truncate(self, size):
     """Truncates the unsparsified file.
@@ -1094,8 +2337,9 @@ class ImageHandler(object):
       raise OSError('ImageHandler is in read-only mode.')
 
     if not self.is_sparse:
+      self._drop_mapping()
       self._image.truncate(size)
-      self._read_header()
+      self.image_size = size
       return
 
     if size % self.block_size != 0:
@@ -1108,48 +2352,55 @@ class ImageHandler(object):
 
     if size < self.image_size:
       chunk_idx = bisect.bisect_right(self._chunk_output_offsets, size) - 1
-      chunk = self._chunks[chunk_idx]
-      if chunk.output_offset != size:
+      chunk_type = self._chunk_types[chunk_idx]
+      chunk_offset = self._chunk_offsets[chunk_idx]
+      chunk_output_offset = self._chunk_output_offsets[chunk_idx]
+      if chunk_output_offset != size:
         # Truncation in the middle of a trunk - need to keep the chunk
         # and modify it.
         chunk_idx_for_update = chunk_idx + 1
-        num_to_keep = size - chunk.output_offset
+        num_to_keep = size - chunk_output_offset
         assert num_to_keep % self.block_size == 0
-        if chunk.chunk_type == ImageChunk.TYPE_RAW:
-          truncate_at = (chunk.chunk_offset +
+        if chunk_type == ImageChunk.TYPE_RAW:
+          truncate_at = (chunk_offset +
                          struct.calcsize(ImageChunk.FORMAT) + num_to_keep)
           data_sz = num_to_keep
-        elif chunk.chunk_type == ImageChunk.TYPE_FILL:
-          truncate_at = (chunk.chunk_offset +
+        elif chunk_type == ImageChunk.TYPE_FILL:
+          truncate_at = (chunk_offset +
                          struct.calcsize(ImageChunk.FORMAT) + 4)
           data_sz = 4
         else:
-          assert chunk.chunk_type == ImageChunk.TYPE_DONT_CARE
-          truncate_at = chunk.chunk_offset + struct.calcsize(ImageChunk.FORMAT)
+          assert chunk_type == ImageChunk.TYPE_DONT_CARE
+          truncate_at = chunk_offset + struct.calcsize(ImageChunk.FORMAT)
           data_sz = 0
         chunk_sz = num_to_keep // self.block_size
         total_sz = data_sz + struct.calcsize(ImageChunk.FORMAT)
-        self._image.seek(chunk.chunk_offset)
+        self._image.seek(chunk_offset)
         self._image.write(struct.pack(ImageChunk.FORMAT,
-                                      chunk.chunk_type,
+                                      chunk_type,
                                       0,  # Reserved
                                       chunk_sz,
                                       total_sz))
-        chunk.output_size = num_to_keep
+        self._chunk_output_sizes[chunk_idx] = num_to_keep
       else:
         # Truncation at trunk boundary.
-        truncate_at = chunk.chunk_offset
+        truncate_at = chunk_offset
         chunk_idx_for_update = chunk_idx
 
       self._num_total_chunks = chunk_idx_for_update
-      self._num_total_blocks = 0
-      for i in range(0, chunk_idx_for_update):
-        self._num_total_blocks += self._chunks[i].output_size // self.block_size
+      self._num_total_blocks = size // self.block_size
       self._update_chunks_and_blocks()
       self._image.truncate(truncate_at)
 
-      # We've modified the file so re-read all data.
-      self._read_header()
+      # Drop the chunks we cut off from the chunk table instead of
+      # re-reading all data.
+      del self._chunk_types[chunk_idx_for_update:]
+      del self._chunk_offsets[chunk_idx_for_update:]
+      del self._chunk_output_offsets[chunk_idx_for_update:]
+      del self._chunk_output_sizes[chunk_idx_for_update:]
+      del self._chunk_fill_data[chunk_idx_for_update * 4:]
+      self._sparse_end = truncate_at
+      self.image_size = size
     else:
       # Truncating to grow - just add a DONT_CARE section.
       self.append_dont_care(size - self.image_size)
@@ -1216,7 +2467,8 @@ class AvbDescriptor(object):
     return bytearray(ret)
 
   def verify(self, image_dir, image_ext, expected_chain_partitions_map,
-             image_containing_descriptor, accept_zeroed_hashtree):
+             image_containing_descriptor, accept_zeroed_hashtree,
+             hashtree_options=None):
     """Verifies contents of the descriptor - used in verify_image sub-command.
 
     Arguments:
@@ -1227,13 +2479,15 @@ class AvbDescriptor(object):
       image_containing_descriptor: The image the descriptor is in.
       accept_zeroed_hashtree: If True, don't fail if hashtree or FEC data is
           zeroed out.
+      hashtree_options: None or a HashtreeVerifyOptions, only used by
+          hashtree descriptors.
 
     Returns:
       True if the descriptor verifies, False otherwise.
     """
     # Deletes unused parameters to prevent pylint warning unused-argument.
     del image_dir, image_ext, expected_chain_partitions_map
-    del image_containing_descriptor, accept_zeroed_hashtree
+    del image_containing_descriptor, accept_zeroed_hashtree, hashtree_options
 
     # Nothing to do.
     return True
@@ -1322,7 +2576,8 @@ class AvbPropertyDescriptor(AvbDescriptor):
     return ret
 
   def verify(self, image_dir, image_ext, expected_chain_partitions_map,
-             image_containing_descriptor, accept_zeroed_hashtree):
+             image_containing_descriptor, accept_zeroed_hashtree,
+             hashtree_options=None):
     """Verifies contents of the descriptor - used in verify_image sub-command.
 
     Arguments:
@@ -1333,10 +2588,16 @@ class AvbPropertyDescriptor(AvbDescriptor):
       image_containing_descriptor: The image the descriptor is in.
       accept_zeroed_hashtree: If True, don't fail if hashtree or FEC data is
           zeroed out.
+      hashtree_options: None or a HashtreeVerifyOptions, only used by
+          hashtree descriptors.
 
     Returns:
       True if the descriptor verifies, False otherwise.
     """
+    # Deletes unused parameters to prevent pylint warning unused-argument.
+    del image_dir, image_ext, expected_chain_partitions_map
+    del image_containing_descriptor, accept_zeroed_hashtree, hashtree_options
+
     # Nothing to do.
     return True
 
@@ -1496,7 +2757,8 @@ class AvbHashtreeDescriptor(AvbDescriptor):
     return ret
 
   def verify(self, image_dir, image_ext, expected_chain_partitions_map,
-             image_containing_descriptor, accept_zeroed_hashtree):
+             image_containing_descriptor, accept_zeroed_hashtree,
+             hashtree_options=None):
     """Verifies contents of the descriptor - used in verify_image sub-command.
 
     Arguments:
@@ -1507,52 +2769,131 @@ class AvbHashtreeDescriptor(AvbDescriptor):
       image_containing_descriptor: The image the descriptor is in.
       accept_zeroed_hashtree: If True, don't fail if hashtree or FEC data is
           zeroed out.
+      hashtree_options: None or a HashtreeVerifyOptions, only used by
+          hashtree descriptors.
 
     Returns:
       True if the descriptor verifies, False otherwise.
     """
+    options = hashtree_options or HashtreeVerifyOptions()
     if not self.partition_name:
       image_filename = image_containing_descriptor.filename
       image = image_containing_descriptor
     else:
       image_filename = os.path.join(image_dir, self.partition_name + image_ext)
       image = ImageHandler(image_filename, read_only=True)
-    # Generate the hashtree and checks that it matches what's in the file.
     digest_size = self._hashtree_digest_size()
     digest_padding = round_to_pow2(digest_size) - digest_size
     (hash_level_offsets, tree_size) = calc_hash_level_offsets(
         self.image_size, self.data_block_size, digest_size + digest_padding)
-    root_digest, hash_tree = generate_hash_tree(image, self.image_size,
-                                                self.data_block_size,
-                                                self.hash_algorithm, self.salt,
-                                                digest_padding,
-                                                hash_level_offsets,
-                                                tree_size)
-    # The root digest must match unless it is not embedded in the descriptor.
-    if self.root_digest and root_digest != self.root_digest:
-      sys.stderr.write('hashtree of {} does not match descriptor\n'.
-                       format(image_filename))
-      return False
-    # ... also check that the on-disk hashtree matches
     image.seek(self.tree_offset)
-    hash_tree_ondisk = image.read(self.tree_size)
+    hash_tree_ondisk = image.read_view(self.tree_size)
     is_zeroed = (self.tree_size == 0) or (hash_tree_ondisk[0:8] == b'ZeRoHaSH')
-    if is_zeroed and accept_zeroed_hashtree:
-      print('{}: skipping verification since hashtree is zeroed and '
-            '--accept_zeroed_hashtree was given'
-            .format(self.partition_name))
+    if is_zeroed or len(hash_tree_ondisk) != tree_size:
+      # Without a usable on-disk hashtree, generate the hashtree and check
+      # that it matches what's in the file.
+      root_digest, hash_tree = generate_hash_tree(image, self.image_size,
+                                                  self.data_block_size,
+                                                  self.hash_algorithm,
+                                                  self.salt, digest_padding,
+                                                  hash_level_offsets,
+                                                  tree_size, options.jobs)
+      # The root digest must match unless it is not embedded in the
+      # descriptor.
+      if self.root_digest and root_digest != self.root_digest:
+        sys.stderr.write('hashtree of {} does not match descriptor\n'.
+                         format(image_filename))
+        return False
+      if is_zeroed and accept_zeroed_hashtree:
+        print('{}: skipping verification since hashtree is zeroed and '
+              '--accept_zeroed_hashtree was given'
+              .format(self.partition_name))
+      else:
+        if hash_tree != hash_tree_ondisk:
+          sys.stderr.write('hashtree of {} contains invalid data\n'.
+                           format(image_filename))
+          return False
+        print('{}: Successfully verified {} hashtree of {} for image of {} '
+              'bytes'.format(self.partition_name, self.hash_algorithm,
+                             image.filename, self.image_size))
     else:
-      if hash_tree != hash_tree_ondisk:
+      # Check the on-disk hashtree against the root digest, unless it is
+      # not embedded in the descriptor, and the data against the
+      # hashtree, one window at a time.
+      num_data_blocks = ((self.image_size + self.data_block_size - 1) //
+                         self.data_block_size)
+      sample_blocks = None
+      if options.sample is not None:
+        sample_blocks = options.sample.pick(num_data_blocks)
+      (bad_data_blocks, bad_tree_blocks, num_unchecked,
+       complete) = verify_hash_tree(image, self.image_size,
+                                    self.data_block_size, self.hash_algorithm,
+                                    self.salt, digest_padding,
+                                    hash_level_offsets, hash_tree_ondisk,
+                                    self.root_digest or None,
+                                    options.fail_fast, options.jobs,
+                                    sample_blocks)
+      bad_block_report = options.bad_block_report
+      if bad_block_report is not None:
+        bad_block_report.append({
+            'name': self.partition_name,
+            'image': image_filename,
+            'block_size': self.data_block_size,
+            'bad_data_blocks': [
+                {'first_block': first, 'num_blocks': count,
+                 'offset': first * self.data_block_size,
+                 'size': count * self.data_block_size}
+                for first, count in get_ranges(bad_data_blocks)],
+            'bad_hashtree_blocks': [
+                {'offset': self.tree_offset + offset,
+                 'size': self.data_block_size}
+                for offset in bad_tree_blocks],
+            'unchecked_blocks': num_unchecked,
+            'complete': complete})
+        if sample_blocks is not None:
+          bad_block_report[-1]['sampled_blocks'] = len(sample_blocks)
+          bad_block_report[-1]['sample_seed'] = options.sample.seed
+      # Corrupted data changes the root digest, a corrupted hashtree only
+      # the on-disk hashtree.
+      if bad_data_blocks and self.root_digest:
+        sys.stderr.write('hashtree of {} does not match descriptor\n'.
+                         format(image_filename))
+        return False
+      if bad_data_blocks or bad_tree_blocks:
         sys.stderr.write('hashtree of {} contains invalid data\n'.
                          format(image_filename))
         return False
-      print('{}: Successfully verified {} hashtree of {} for image of {} bytes'
-            .format(self.partition_name, self.hash_algorithm, image.filename,
-                    self.image_size))
-    # TODO(zeuthen): we could also verify that the FEC stored in the image is
-    # correct but this a) currently requires the 'fec' binary; and b) takes a
-    # long time; and c) is not strictly needed for verification purposes as
-    # we've already verified the root hash.
+      if sample_blocks is not None:
+        print('{}: Successfully verified {} hashtree of {} for {} of {} data '
+              'blocks ({:.2%}) sampled with seed {}'
+              .format(self.partition_name, self.hash_algorithm,
+                      image.filename, len(sample_blocks), num_data_blocks,
+                      len(sample_blocks) / num_data_blocks,
+                      options.sample.seed))
+      else:
+        print('{}: Successfully verified {} hashtree of {} for image of {} '
+              'bytes'.format(self.partition_name, self.hash_algorithm,
+                             image.filename, self.image_size))
+    # FEC data is not strictly needed for verification purposes as we've
+    # already verified the root hash, so it's only checked on request.
+    if options.check_fec and self.fec_num_roots:
+      image.seek(self.fec_offset)
+      fec_ondisk = image.read_view(self.fec_size)
+      if fec_ondisk[0:8] == b'ZeRoHaSH' and accept_zeroed_hashtree:
+        print('{}: skipping FEC check since FEC data is zeroed and '
+              '--accept_zeroed_hashtree was given'
+              .format(self.partition_name))
+        return True
+      fec_data = generate_fec_data(image, self.fec_num_roots, options.jobs,
+                                   self.fec_offset)
+      num_bad = count_bad_fec_codewords(fec_data, fec_ondisk,
+                                        self.fec_num_roots)
+      if num_bad:
+        sys.stderr.write('FEC data of {} is invalid for {} codewords\n'.
+                         format(image_filename, num_bad))
+        return False
+      print('{}: Successfully verified FEC data with {} roots of {}'
+            .format(self.partition_name, self.fec_num_roots, image.filename))
     return True
 
 
@@ -1664,7 +3005,8 @@ class AvbHashDescriptor(AvbDescriptor):
     return ret
 
   def verify(self, image_dir, image_ext, expected_chain_partitions_map,
-             image_containing_descriptor, accept_zeroed_hashtree):
+             image_containing_descriptor, accept_zeroed_hashtree,
+             hashtree_options=None):
     """Verifies contents of the descriptor - used in verify_image sub-command.
 
     Arguments:
@@ -1675,20 +3017,24 @@ class AvbHashDescriptor(AvbDescriptor):
       image_containing_descriptor: The image the descriptor is in.
       accept_zeroed_hashtree: If True, don't fail if hashtree or FEC data is
           zeroed out.
+      hashtree_options: None or a HashtreeVerifyOptions, only used by
+          hashtree descriptors.
 
     Returns:
       True if the descriptor verifies, False otherwise.
     """
+    # Deletes unused parameters to prevent pylint warning unused-argument.
+    del expected_chain_partitions_map, accept_zeroed_hashtree, hashtree_options
+
     if not self.partition_name:
       image_filename = image_containing_descriptor.filename
       image = image_containing_descriptor
     else:
       image_filename = os.path.join(image_dir, self.partition_name + image_ext)
       image = ImageHandler(image_filename, read_only=True)
-    data = image.read(self.image_size)
     ha = hashlib.new(self.hash_algorithm)
     ha.update(self.salt)
-    ha.update(data)
+    update_hasher_from_extents(ha, image.iter_extents(0, self.image_size))
     digest = ha.digest()
     # The digest must match unless there is no digest in the descriptor.
     if self.digest and digest != self.digest:
@@ -1777,7 +3123,8 @@ class AvbKernelCmdlineDescriptor(AvbDescriptor):
     return ret
 
   def verify(self, image_dir, image_ext, expected_chain_partitions_map,
-             image_containing_descriptor, accept_zeroed_hashtree):
+             image_containing_descriptor, accept_zeroed_hashtree,
+             hashtree_options=None):
     """Verifies contents of the descriptor - used in verify_image sub-command.
 
     Arguments:
@@ -1788,10 +3135,16 @@ class AvbKernelCmdlineDescriptor(AvbDescriptor):
       image_containing_descriptor: The image the descriptor is in.
       accept_zeroed_hashtree: If True, don't fail if hashtree or FEC data is
           zeroed out.
+      hashtree_options: None or a HashtreeVerifyOptions, only used by
+          hashtree descriptors.
 
     Returns:
       True if the descriptor verifies, False otherwise.
     """
+    # Deletes unused parameters to prevent pylint warning unused-argument.
+    del image_dir, image_ext, expected_chain_partitions_map
+    del image_containing_descriptor, accept_zeroed_hashtree, hashtree_options
+
     # Nothing to verify.
     return True
 
@@ -1886,7 +3239,8 @@ class AvbChainPartitionDescriptor(AvbDescriptor):
     return ret
 
   def verify(self, image_dir, image_ext, expected_chain_partitions_map,
-             image_containing_descriptor, accept_zeroed_hashtree):
+             image_containing_descriptor, accept_zeroed_hashtree,
+             hashtree_options=None):
     """Verifies contents of the descriptor - used in verify_image sub-command.
 
     Arguments:
@@ -1897,10 +3251,16 @@ class AvbChainPartitionDescriptor(AvbDescriptor):
       image_containing_descriptor: The image the descriptor is in.
       accept_zeroed_hashtree: If True, don't fail if hashtree or FEC data is
           zeroed out.
+      hashtree_options: None or a HashtreeVerifyOptions, only used by
+          hashtree descriptors.
 
     Returns:
       True if the descriptor verifies, False otherwise.
     """
+    # Deletes unused parameters to prevent pylint warning unused-argument.
+    del image_dir, image_ext, image_containing_descriptor
+    del accept_zeroed_hashtree, hashtree_options
+
     value = expected_chain_partitions_map.get(self.partition_name)
     if not value:
       sys.stderr.write('No expected chain partition for partition {}. Use '
@@ -2317,14 +3677,140 @@ class Avb(object):
     #
     # Applications can use these markers to detect that the hashtree and/or
     # FEC needs to be recomputed.
-    image.truncate(zero_ht_start_offset)
-    data_zeroed_firstblock = b'ZeRoHaSH' + b'\0' * (image.block_size - 8)
-    image.append_raw(data_zeroed_firstblock)
-    image.append_fill(b'\0\0\0\0', zero_ht_num_bytes - image.block_size)
-    if zero_fec_start_offset:
+    with image.append_transaction():
+      image.truncate(zero_ht_start_offset)
+      data_zeroed_firstblock = b'ZeRoHaSH' + b'\0' * (image.block_size - 8)
       image.append_raw(data_zeroed_firstblock)
-      image.append_fill(b'\0\0\0\0', zero_fec_num_bytes - image.block_size)
-    image.append_raw(data)
+      image.append_fill(b'\0\0\0\0', zero_ht_num_bytes - image.block_size)
+      if zero_fec_start_offset:
+        image.append_raw(data_zeroed_firstblock)
+        image.append_fill(b'\0\0\0\0', zero_fec_num_bytes - image.block_size)
+      image.append_raw(data)
+
+  def repair_image(self, image_filename, jobs=1):
+    """Implements the 'repair_image' command.
+
+    Corrupted blocks of the image data and hashtree are located with the
+    hashtree, starting from the root digest in the hashtree descriptor,
+    and rewritten from FEC data. Blocks below a corrupted hashtree block
+    are checked again once it is repaired. The vbmeta struct itself is
+    not verified, use 'verify_image' for that.
+
+    Arguments:
+      image_filename: File to repair.
+      jobs: Number of threads to hash data blocks with or 0 to use one
+          thread per CPU.
+
+    Raises:
+      AvbError: If the image can't be repaired.
+    """
+    check_num_jobs(jobs)
+    image = ImageHandler(image_filename)
+    (footer, _, descriptors, _) = self._parse_image(image)
+    if not footer:
+      raise AvbError('Given image does not have a footer.')
+
+    ht_desc = None
+    for desc in descriptors:
+      if isinstance(desc, AvbHashtreeDescriptor):
+        ht_desc = desc
+        break
+
+    if not ht_desc:
+      raise AvbError('No hashtree descriptor was found.')
+    if image.is_sparse:
+      raise AvbError('Repairing sparse images is not supported.')
+    if not ht_desc.root_digest:
+      raise AvbError('Hashtree descriptor has no root digest.')
+    if not ht_desc.fec_num_roots:
+      raise AvbError('Image has no FEC data.')
+    if ht_desc.tree_offset != ht_desc.image_size:
+      raise AvbError('Hash-tree must follow the image data.')
+
+    block_size = ht_desc.data_block_size
+    digest_size = len(ht_desc.root_digest)
+    digest_padding = round_to_pow2(digest_size) - digest_size
+    entry_size = digest_size + digest_padding
+    (hash_level_offsets, tree_size) = calc_hash_level_offsets(
+        ht_desc.image_size, block_size, entry_size)
+    hasher = create_avb_hashtree_hasher(ht_desc.hash_algorithm, ht_desc.salt)
+    num_data_blocks = (ht_desc.image_size + block_size - 1) // block_size
+
+    # The data is only hashed once. Afterwards only the digests of
+    # repaired blocks are updated.
+    data_digests = bytearray(round_to_multiple(num_data_blocks * entry_size,
+                                               block_size))
+    if ht_desc.image_size <= block_size:
+      image.seek(0)
+      block_hasher = hasher.copy()
+      block_hasher.update(image.read_view(ht_desc.image_size))
+      data_digests[:digest_size] = block_hasher.digest()
+    else:
+      hash_image_blocks(image, ht_desc.image_size, block_size, hasher,
+                        digest_padding, memoryview(data_digests), jobs)
+
+    num_repaired = 0
+    attempted = set()
+    fd = os.open(image_filename, os.O_RDWR)
+    try:
+      while True:
+        tree = os.pread(fd, tree_size, ht_desc.tree_offset)
+        bad_data_blocks, bad_tree_blocks, num_unchecked = (
+            find_corrupt_hashtree_blocks(
+                tree, data_digests, ht_desc.image_size, block_size, hasher,
+                digest_padding, hash_level_offsets, ht_desc.root_digest))
+        if not bad_data_blocks and not bad_tree_blocks:
+          break
+        print('{}: Found {} corrupted data blocks and {} corrupted hashtree '
+              'blocks, {} blocks not checked yet'
+              .format(ht_desc.partition_name, len(bad_data_blocks),
+                      len(bad_tree_blocks), num_unchecked))
+
+        # Erase all FEC blocks overlapping corrupted blocks.
+        regions = [(n * block_size, block_size) for n in bad_data_blocks]
+        regions.extend((ht_desc.tree_offset + offset, block_size)
+                       for offset in bad_tree_blocks)
+        fec_blocks = set()
+        for offset, size in regions:
+          fec_blocks.update(range(offset - offset % FEC_BLOCKSIZE,
+                                  offset + size, FEC_BLOCKSIZE))
+        if fec_blocks <= attempted:
+          raise AvbError('Repaired blocks still don\'t match the hashtree, '
+                         'either too many blocks are corrupted or so is the '
+                         'FEC data.')
+        attempted.update(fec_blocks)
+        failed = repair_fec_blocks(fd, ht_desc.fec_offset, ht_desc.fec_offset,
+                                   ht_desc.fec_num_roots, sorted(fec_blocks))
+        if failed:
+          raise AvbError('Too many corrupted blocks to repair {} blocks '
+                         'at offsets {}.'.format(
+                             len(failed), ', '.join(str(o) for o in failed)))
+        num_repaired += len(fec_blocks)
+
+        # Update the digests of the repaired data blocks.
+        data_blocks = set()
+        for offset in fec_blocks:
+          if offset < ht_desc.image_size:
+            data_blocks.update(range(
+                offset // block_size,
+                min((offset + FEC_BLOCKSIZE - 1) // block_size + 1,
+                    num_data_blocks)))
+        for block_num in data_blocks:
+          block_hasher = hasher.copy()
+          block_hasher.update(os.pread(fd, block_size, block_num * block_size))
+          data_digests[block_num * entry_size:
+                       block_num * entry_size + digest_size] = (
+                           block_hasher.digest())
+    finally:
+      os.close(fd)
+
+    if num_repaired:
+      print('{}: Successfully repaired {} blocks of {} bytes in {}'
+            .format(ht_desc.partition_name, num_repaired, FEC_BLOCKSIZE,
+                    image_filename))
+    else:
+      print('{}: No corrupted blocks found in {}'
+            .format(ht_desc.partition_name, image_filename))
 
   def resize_image(self, image_filename, partition_size):
     """Implements the 'resize_image' command.
@@ -2362,16 +3848,17 @@ class Avb(object):
     # Cut at the end of the vbmeta blob and insert a DONT_CARE chunk
     # with enough bytes such that the final Footer block is at the end
     # of partition_size.
-    image.truncate(vbmeta_end_offset)
-    image.append_dont_care(partition_size - vbmeta_end_offset -
-                           1 * image.block_size)
+    with image.append_transaction():
+      image.truncate(vbmeta_end_offset)
+      image.append_dont_care(partition_size - vbmeta_end_offset -
+                             1 * image.block_size)
 
-    # Just reuse the same footer - only difference is that we're
-    # writing it in a different place.
-    footer_blob = footer.encode()
-    footer_blob_with_padding = (b'\0' * (image.block_size - AvbFooter.SIZE) +
-                                footer_blob)
-    image.append_raw(footer_blob_with_padding)
+      # Just reuse the same footer - only difference is that we're
+      # writing it in a different place.
+      footer_blob = footer.encode()
+      footer_blob_with_padding = (b'\0' * (image.block_size - AvbFooter.SIZE)
+                                  + footer_blob)
+      image.append_raw(footer_blob_with_padding)
 
   def set_ab_metadata(self, misc_image, slot_data):
     """Implements the 'set_ab_metadata' command.
@@ -2492,7 +3979,9 @@ class Avb(object):
       print_atx_certificate(psk)
 
   def verify_image(self, image_filename, key_path, expected_chain_partitions,
-                   follow_chain_partitions, accept_zeroed_hashtree):
+                   follow_chain_partitions, accept_zeroed_hashtree, jobs=1,
+                   check_fec=False, fail_fast=False, bad_block_report=None,
+                   sample_size=None, sample_fraction=None, sample_seed=None):
     """Implements the 'verify_image' command.
 
     Arguments:
@@ -2505,6 +3994,60 @@ class Avb(object):
           the --expected_chain_partition option
       accept_zeroed_hashtree: If True, don't fail if hashtree or FEC data is
           zeroed out.
+      jobs: Number of threads to hash data blocks with or 0 to use one
+          thread per CPU.
+      check_fec: If True, also check that FEC data matches the image.
+      fail_fast: If True, stop verifying a hashtree at the first corrupted
+          block.
+      bad_block_report: None or file object to write the corrupted blocks
+          of verified hashtrees to as JSON. It's written even if
+          verification fails.
+      sample_size: If not None, only check this many randomly picked data
+          blocks of each hashtree. All levels of the hashtree itself are
+          still checked.
+      sample_fraction: If not None, only check this fraction of randomly
+          picked data blocks of each hashtree.
+      sample_seed: The seed to pick data blocks with or None to use a
+          random one. It's printed so the check can be repeated.
+
+    Raises:
+      AvbError: If verification of the image fails.
+    """
+    check_num_jobs(jobs)
+    sample = None
+    if sample_size is not None or sample_fraction is not None:
+      sample = BlockSample(sample_size, sample_fraction, sample_seed)
+      print('Sampling data blocks of hashtrees with seed {}'
+            .format(sample.seed))
+    hashtree_options = HashtreeVerifyOptions(jobs, check_fec, fail_fast,
+                                             sample=sample)
+    if bad_block_report:
+      hashtree_options.bad_block_report = []
+    try:
+      self._verify_image(image_filename, key_path, expected_chain_partitions,
+                         follow_chain_partitions, accept_zeroed_hashtree,
+                         hashtree_options)
+    finally:
+      if bad_block_report:
+        bad_block_report.write(json.dumps(
+            {'partitions': hashtree_options.bad_block_report}, indent=2))
+
+  def _verify_image(self, image_filename, key_path, expected_chain_partitions,
+                    follow_chain_partitions, accept_zeroed_hashtree,
+                    hashtree_options):
+    """Implementation of the 'verify_image' command.
+
+    Arguments:
+      image_filename: Image file to get information from (file object).
+      key_path: None or check that embedded public key matches key at given
+          path.
+      expected_chain_partitions: List of chain partitions to check or None.
+      follow_chain_partitions:
+          If True, will follows chain partitions even when not specified with
+          the --expected_chain_partition option
+      accept_zeroed_hashtree: If True, don't fail if hashtree or FEC data is
+          zeroed out.
+      hashtree_options: A HashtreeVerifyOptions for hashtree descriptors.
 
     Raises:
       AvbError: If verification of the image fails.
@@ -2537,29 +4080,7 @@ class Avb(object):
 
     image = ImageHandler(image_filename, read_only=True)
     (footer, header, descriptors, _) = self._parse_image(image)
-    offset = 0
-    if footer:
-      offset = footer.vbmeta_offset
-
-    image.seek(offset)
-    vbmeta_blob = image.read(header.SIZE
-                             + header.authentication_data_block_size
-                             + header.auxiliary_data_block_size)
-
-    alg_name, _ = lookup_algorithm_by_type(header.algorithm_type)
-    if not verify_vbmeta_signature(header, vbmeta_blob):
-      raise AvbError('Signature check failed for {} vbmeta struct {}'
-                     .format(alg_name, image_filename))
-
-    if key_blob:
-      # The embedded public key is in the auxiliary block at an offset.
-      key_offset = AvbVBMetaHeader.SIZE
-      key_offset += header.authentication_data_block_size
-      key_offset += header.public_key_offset
-      key_blob_in_vbmeta = vbmeta_blob[key_offset:key_offset
-                                       + header.public_key_size]
-      if key_blob != key_blob_in_vbmeta:
-        raise AvbError('Embedded public key does not match given key.')
+    alg_name = self._verify_vbmeta_signature(image, footer, header, key_blob)
 
     if footer:
       print('vbmeta: Successfully verified footer and {} vbmeta struct in {}'
@@ -2580,7 +4101,7 @@ class Avb(object):
               .format(desc.partition_name, desc.rollback_index_location,
                       hashlib.sha1(desc.public_key).hexdigest()))
       elif not desc.verify(image_dir, image_ext, expected_chain_partitions_map,
-                           image, accept_zeroed_hashtree):
+                           image, accept_zeroed_hashtree, hashtree_options):
         raise AvbError('Error verifying descriptor.')
       # Honor --follow_chain_partitions - add '--' to make the output more
       # readable.
@@ -2589,8 +4110,86 @@ class Avb(object):
         print('--')
         chained_image_filename = os.path.join(image_dir,
                                               desc.partition_name + image_ext)
-        self.verify_image(chained_image_filename, key_path, None, False,
-                          accept_zeroed_hashtree)
+        self._verify_image(chained_image_filename, key_path, None, False,
+                           accept_zeroed_hashtree, hashtree_options)
+
+  def _verify_vbmeta_signature(self, image, footer, header, key_blob):
+    """Verifies the signature of the vbmeta struct of an image.
+
+    Arguments:
+      image: The image, as an ImageHandler.
+      footer: The footer of the image or None.
+      header: The AvbVBMetaHeader of the image.
+      key_blob: None or the encoded public key the embedded one must match.
+
+    Returns:
+      The name of the signing algorithm.
+
+    Raises:
+      AvbError: If the signature or the public key don't match.
+    """
+    offset = 0
+    if footer:
+      offset = footer.vbmeta_offset
+
+    image.seek(offset)
+    vbmeta_blob = image.read(header.SIZE
+                             + header.authentication_data_block_size
+                             + header.auxiliary_data_block_size)
+
+    alg_name, _ = lookup_algorithm_by_type(header.algorithm_type)
+    if not verify_vbmeta_signature(header, vbmeta_blob):
+      raise AvbError('Signature check failed for {} vbmeta struct {}'
+                     .format(alg_name, image.filename))
+
+    if key_blob:
+      # The embedded public key is in the auxiliary block at an offset.
+      key_offset = AvbVBMetaHeader.SIZE
+      key_offset += header.authentication_data_block_size
+      key_offset += header.public_key_offset
+      key_blob_in_vbmeta = vbmeta_blob[key_offset:key_offset
+                                       + header.public_key_size]
+      if key_blob != key_blob_in_vbmeta:
+        raise AvbError('Embedded public key does not match given key.')
+    return alg_name
+
+  def open_verified_image(self, image_filename, key_path=None,
+                          tree_cache_size=None):
+    """Opens the data of an image with a hashtree footer for verified reads.
+
+    Only the vbmeta struct is verified here, the data and the hashtree
+    are verified block by block as they are read.
+
+    Arguments:
+      image_filename: Image file to read from.
+      key_path: None or check that embedded public key matches key at given
+          path.
+      tree_cache_size: Maximum number of verified hashtree blocks kept or
+          None for the default.
+
+    Returns:
+      A VerifiedImageReader for the data of the image.
+
+    Raises:
+      AvbError: If the image has no hashtree or its vbmeta struct doesn't
+          verify.
+    """
+    image = ImageHandler(image_filename, read_only=True)
+    (footer, header, descriptors, _) = self._parse_image(image)
+    if not footer:
+      raise AvbError('Given image does not have a footer.')
+    key_blob = None
+    if key_path:
+      key_blob = RSAPublicKey(key_path).encode()
+    self._verify_vbmeta_signature(image, footer, header, key_blob)
+    if tree_cache_size is None:
+      tree_cache_size = VERIFIED_TREE_CACHE_BLOCKS
+
+    for desc in descriptors:
+      if isinstance(desc, AvbHashtreeDescriptor):
+        return VerifiedImageReader(image, desc,
+                                   tree_cache_size=tree_cache_size)
+    raise AvbError('No hashtree descriptor was found.')
 
   def print_partition_digests(self, image_filename, output, as_json):
     """Implements the 'print_partition_digests' command.
@@ -2762,7 +4361,7 @@ class Avb(object):
     footer = None
     image.seek(image.image_size - AvbFooter.SIZE)
     try:
-      footer = AvbFooter(image.read(AvbFooter.SIZE))
+      footer = AvbFooter(image.read_view(AvbFooter.SIZE))
     except (LookupError, struct.error):
       # Nope, just seek back to the start.
       image.seek(0)
@@ -2772,7 +4371,7 @@ class Avb(object):
       vbmeta_offset = footer.vbmeta_offset
 
     image.seek(vbmeta_offset)
-    h = AvbVBMetaHeader(image.read(AvbVBMetaHeader.SIZE))
+    h = AvbVBMetaHeader(image.read_view(AvbVBMetaHeader.SIZE))
 
     auth_block_offset = vbmeta_offset + AvbVBMetaHeader.SIZE
     aux_block_offset = auth_block_offset + h.authentication_data_block_size
@@ -2919,7 +4518,7 @@ class Avb(object):
                         release_string,
                         append_to_release_string,
                         print_required_libavb_version,
-                        padding_size):
+                        padding_size, signing_helper_persistent=None):
     """Implements the 'make_vbmeta_image' command.
 
     Arguments:
@@ -2942,6 +4541,8 @@ class Avb(object):
       append_to_release_string: None or string to append.
       print_required_libavb_version: True to only print required libavb version.
       padding_size: If not 0, pads output so size is a multiple of the number.
+      signing_helper_persistent: Program which is started once and signs
+        all hashes.
 
     Raises:
       AvbError: If a chained partition is malformed.
@@ -2975,7 +4576,8 @@ class Avb(object):
         kernel_cmdlines, setup_rootfs_from_kernel, ht_desc_to_setup,
         include_descriptors_from_image, signing_helper,
         signing_helper_with_files, release_string,
-        append_to_release_string, tmp_header.required_libavb_version_minor)
+        append_to_release_string, tmp_header.required_libavb_version_minor,
+        signing_helper_persistent)
 
     # Write entire vbmeta blob (header, authentication, auxiliary).
     output.seek(0)
@@ -2997,7 +4599,8 @@ class Avb(object):
                             include_descriptors_from_image, signing_helper,
                             signing_helper_with_files,
                             release_string, append_to_release_string,
-                            required_libavb_version_minor):
+                            required_libavb_version_minor,
+                            signing_helper_persistent=None):
     """Generates a VBMeta blob.
 
     This blob contains the header (struct AvbVBMetaHeader), the
@@ -3031,6 +4634,8 @@ class Avb(object):
       release_string: None or avbtool release string.
       append_to_release_string: None or string to append.
       required_libavb_version_minor: Use at least this required minor version.
+      signing_helper_persistent: Program which is started once and signs
+        all hashes.
 
     Returns:
       The VBMeta blob as bytes.
@@ -3227,8 +4832,10 @@ class Avb(object):
       # Calculate the signature.
       rsa_key = RSAPublicKey(key_path)
       data_to_sign = header_data_blob + bytes(aux_data_blob)
-      binary_signature = rsa_key.sign(algorithm_name, data_to_sign,
-                                      signing_helper, signing_helper_with_files)
+      binary_signature = rsa_key.sign(
+          algorithm_name, data_to_sign, signing_helper,
+          signing_helper_with_files,
+          signing_helper_persistent=signing_helper_persistent)
 
     # Generate Authentication data block.
     auth_data_blob = bytearray()
@@ -3307,18 +4914,10 @@ class Avb(object):
                         len(vbmeta_blob))
       vbmeta_blob_with_padding = vbmeta_blob + b'\0' * padding_needed
 
-      # Append vbmeta blob and footer
-      image.append_raw(vbmeta_blob_with_padding)
-      vbmeta_end_offset = vbmeta_offset + len(vbmeta_blob_with_padding)
-
-      # Now insert a DONT_CARE chunk with enough bytes such that the
-      # final Footer block is at the end of partition_size..
-      image.append_dont_care(partition_size - vbmeta_end_offset -
-                             1 * image.block_size)
-
       # Generate the Footer that tells where the VBMeta footer
       # is. Also put enough padding in the front of the footer since
       # we'll write out an entire block.
+      vbmeta_end_offset = vbmeta_offset + len(vbmeta_blob_with_padding)
       footer = AvbFooter()
       footer.original_image_size = original_image_size
       footer.vbmeta_offset = vbmeta_offset
@@ -3326,7 +4925,15 @@ class Avb(object):
       footer_blob = footer.encode()
       footer_blob_with_padding = (b'\0' * (image.block_size - AvbFooter.SIZE) +
                                   footer_blob)
-      image.append_raw(footer_blob_with_padding)
+
+      # Append vbmeta blob, a DONT_CARE chunk with enough bytes such
+      # that the final Footer block is at the end of partition_size
+      # and the footer itself.
+      with image.append_transaction():
+        image.append_raw(vbmeta_blob_with_padding)
+        image.append_dont_care(partition_size - vbmeta_end_offset -
+                               1 * image.block_size)
+        image.append_raw(footer_blob_with_padding)
 
     except Exception as e:
       # Truncate back to original size, then re-raise.
@@ -3346,7 +4953,7 @@ class Avb(object):
                       release_string, append_to_release_string,
                       output_vbmeta_image, do_not_append_vbmeta_image,
                       print_required_libavb_version, use_persistent_digest,
-                      do_not_use_ab):
+                      do_not_use_ab, signing_helper_persistent=None):
     """Implementation of the add_hash_footer on unsparse images.
 
     Arguments:
@@ -3382,6 +4989,8 @@ class Avb(object):
       print_required_libavb_version: True to only print required libavb version.
       use_persistent_digest: Use a persistent digest on device.
       do_not_use_ab: This partition does not use A/B.
+      signing_helper_persistent: Program which is started once and signs
+        all hashes.
 
     Raises:
       AvbError: If an argument is incorrect of if adding of hash_footer failed.
@@ -3471,11 +5080,8 @@ class Avb(object):
         salt = b''
 
       hasher = hashlib.new(hash_algorithm, salt)
-      # TODO(zeuthen): might want to read this in chunks to avoid
-      # memory pressure, then again, this is only supposed to be used
-      # on kernel/initramfs partitions. Possible optimization.
-      image.seek(0)
-      hasher.update(image.read(image.image_size))
+      update_hasher_from_extents(hasher,
+                                 image.iter_extents(0, image.image_size))
       digest = hasher.digest()
 
       h_desc = AvbHashDescriptor()
@@ -3498,7 +5104,8 @@ class Avb(object):
           kernel_cmdlines, setup_rootfs_from_kernel, ht_desc_to_setup,
           include_descriptors_from_image, signing_helper,
           signing_helper_with_files, release_string,
-          append_to_release_string, required_libavb_version_minor)
+          append_to_release_string, required_libavb_version_minor,
+          signing_helper_persistent)
 
       # Write vbmeta blob, if requested.
       if output_vbmeta_image:
@@ -3524,14 +5131,8 @@ class Avb(object):
             len(vbmeta_blob))
         vbmeta_blob_with_padding = vbmeta_blob + b'\0' * padding_needed
 
-        image.append_raw(vbmeta_blob_with_padding)
         vbmeta_end_offset = vbmeta_offset + len(vbmeta_blob_with_padding)
 
-        # Now insert a DONT_CARE chunk with enough bytes such that the
-        # final Footer block is at the end of partition_size..
-        image.append_dont_care(partition_size - vbmeta_end_offset -
-                               1 * image.block_size)
-
         # Generate the Footer that tells where the VBMeta footer
         # is. Also put enough padding in the front of the footer since
         # we'll write out an entire block.
@@ -3542,29 +5143,114 @@ class Avb(object):
         footer_blob = footer.encode()
         footer_blob_with_padding = (
             b'\0' * (image.block_size - AvbFooter.SIZE) + footer_blob)
-        image.append_raw(footer_blob_with_padding)
+
+        # Append vbmeta blob, a DONT_CARE chunk with enough bytes such
+        # that the final Footer block is at the end of partition_size
+        # and the footer itself.
+        with image.append_transaction():
+          image.append_raw(vbmeta_blob_with_padding)
+          image.append_dont_care(partition_size - vbmeta_end_offset -
+                                 1 * image.block_size)
+          image.append_raw(footer_blob_with_padding)
     except Exception as e:
       # Truncate back to original size, then re-raise.
       image.truncate(original_image_size)
       raise AvbError('Adding hash_footer failed: {}.'.format(e)) from e
+    image.log_io_stats('add_hash_footer')
 
-  def add_hashtree_footer(self, image_filename, partition_size, partition_name,
-                          generate_fec, fec_num_roots, hash_algorithm,
-                          block_size, salt, chain_partitions, algorithm_name,
-                          key_path,
-                          public_key_metadata_path, rollback_index, flags,
-                          rollback_index_location,
-                          props, props_from_file, kernel_cmdlines,
-                          setup_rootfs_from_kernel,
-                          setup_as_rootfs_from_kernel,
-                          include_descriptors_from_image,
-                          calc_max_image_size, signing_helper,
-                          signing_helper_with_files,
+  def _load_hashtree(self, image):
+    """Reads the hashtree and FEC data of an image with a hashtree footer.
+
+    Arguments:
+      image: An ImageHandler with a hashtree footer.
+
+    Returns:
+      A tuple with the AvbHashtreeDescriptor, the hashtree as bytes and
+      the FEC data as a bytearray or None if there is no usable FEC data.
+
+    Raises:
+      AvbError: If the image has no usable hashtree.
+    """
+    (footer, _, descriptors, _) = self._parse_image(image)
+    if not footer:
+      raise AvbError('Given image does not have a footer.')
+    ht_desc = None
+    for desc in descriptors:
+      if isinstance(desc, AvbHashtreeDescriptor):
+        ht_desc = desc
+        break
+    if not ht_desc:
+      raise AvbError('No hashtree descriptor was found.')
+
+    image.seek(ht_desc.tree_offset)
+    tree = image.read(ht_desc.tree_size)
+    if len(tree) != ht_desc.tree_size or tree[0:8] == b'ZeRoHaSH':
+      raise AvbError('Hashtree of {} is zeroed or truncated.'
+                     .format(image.filename))
+    fec_data = None
+    if ht_desc.fec_num_roots:
+      image.seek(ht_desc.fec_offset)
+      fec_data = bytearray(image.read(ht_desc.fec_size))
+      if (len(fec_data) != ht_desc.fec_size or
+          fec_data[0:8] == b'ZeRoHaSH'):
+        fec_data = None
+    return ht_desc, tree, fec_data
+
+  def _check_hashtree_to_update(self, ht_desc, tree, hash_algorithm,
+                                block_size, salt, digest_padding,
+                                changed_blocks):
+    """Checks that a hashtree can be updated instead of generated.
+
+    Arguments:
+      ht_desc: The AvbHashtreeDescriptor of the hashtree.
+      tree: The hashtree.
+      hash_algorithm: Hash algorithm to use.
+      block_size: Block size to use.
+      salt: Salt to use as a hexadecimal string or None to keep the salt.
+      digest_padding: The padding for each digest.
+      changed_blocks: None or a sorted list of the changed data blocks.
+
+    Raises:
+      AvbError: If the hashtree can't be updated.
+    """
+    if (ht_desc.hash_algorithm != hash_algorithm or
+        ht_desc.data_block_size != block_size or
+        (salt is not None and binascii.unhexlify(salt) != ht_desc.salt)):
+      raise AvbError('The hashtree to update was generated with a different '
+                     'hash algorithm, block size or salt.')
+    num_data_blocks = (ht_desc.image_size + block_size - 1) // block_size
+    if changed_blocks and changed_blocks[-1] >= num_data_blocks:
+      raise AvbError('Changed block {} is outside of the image of {} blocks.'
+                     .format(changed_blocks[-1], num_data_blocks))
+    if ht_desc.tree_size:
+      hasher = create_avb_hashtree_hasher(hash_algorithm, ht_desc.salt)
+      (hash_level_offsets, _) = calc_hash_level_offsets(
+          ht_desc.image_size, block_size, hasher.digest_size + digest_padding)
+      if check_hash_tree(tree, ht_desc.image_size, block_size, hasher,
+                         digest_padding, hash_level_offsets,
+                         ht_desc.root_digest or None)[1]:
+        raise AvbError('The hashtree to update is corrupted.')
+
+  def add_hashtree_footer(self, image_filename, partition_size, partition_name,
+                          generate_fec, fec_num_roots, hash_algorithm,
+                          block_size, salt, chain_partitions, algorithm_name,
+                          key_path,
+                          public_key_metadata_path, rollback_index, flags,
+                          rollback_index_location,
+                          props, props_from_file, kernel_cmdlines,
+                          setup_rootfs_from_kernel,
+                          setup_as_rootfs_from_kernel,
+                          include_descriptors_from_image,
+                          calc_max_image_size, signing_helper,
+                          signing_helper_with_files,
                           release_string, append_to_release_string,
                           output_vbmeta_image, do_not_append_vbmeta_image,
                           print_required_libavb_version,
                           use_persistent_root_digest, do_not_use_ab,
-                          no_hashtree, check_at_most_once):
+                          no_hashtree, check_at_most_once, jobs=1,
+                          previous_image=None, changed_blocks=None,
+                          checkpoint_path=None, resume=False,
+                          signing_helper_persistent=None):
     """Implements the 'add_hashtree_footer' command.
 
     See https://gitlab.com/cryptsetup/cryptsetup/wikis/DMVerity for
@@ -3610,11 +5296,29 @@ class Avb(object):
       no_hashtree: Do not append hashtree. Set size in descriptor as zero.
       check_at_most_once: Set to verify data blocks only the first time they
         are read from the data device.
+      jobs: Number of threads to hash data blocks with and of processes
+        to generate FEC with or 0 to use one per CPU.
+      previous_image: None or file with a hashtree footer that only differs
+        from |image_filename| in some data blocks. Its hashtree and FEC
+        data are updated instead of being generated from scratch.
+      changed_blocks: None or a sorted list of the data blocks changed since
+        the hashtree was generated. If |previous_image| is None, the
+        hashtree footer already on |image_filename| is updated. If it's
+        not None but this is, changed blocks are found by comparing the
+        data of both images.
+      checkpoint_path: None or file to save the progress of generating the
+        hashtree and FEC data in, see HashtreeCheckpoint. It's removed once
+        the footer is added.
+      resume: If True, continue from the progress saved in
+        |checkpoint_path|, if it matches the image and the parameters.
+      signing_helper_persistent: Program which is started once and signs
+        all hashes.
 
     Raises:
       AvbError: If an argument is incorrect or adding the hashtree footer
           failed.
     """
+    check_num_jobs(jobs)
     required_libavb_version_minor = 0
     if use_persistent_root_digest or do_not_use_ab or check_at_most_once:
       required_libavb_version_minor = 1
@@ -3654,6 +5358,9 @@ class Avb(object):
       print('{}'.format(max_image_size))
       return
 
+    if resume and not checkpoint_path:
+      raise AvbError('--resume requires --checkpoint.')
+
     image = ImageHandler(image_filename)
 
     if partition_size > 0:
@@ -3666,6 +5373,22 @@ class Avb(object):
                      'block size {}.'.format(image.image_size,
                                              image.block_size))
 
+    # For an incremental update, load the hashtree and FEC data to update
+    # before the footer is truncated away.
+    previous = None
+    prev_ht_desc = None
+    if previous_image or changed_blocks is not None:
+      if no_hashtree:
+        raise AvbError('The hashtree can\'t be updated with --no_hashtree.')
+      previous = image
+      if previous_image:
+        previous = ImageHandler(previous_image, read_only=True)
+      prev_ht_desc, prev_tree, prev_fec = self._load_hashtree(previous)
+      # Check as much as possible before the footer is gone.
+      self._check_hashtree_to_update(prev_ht_desc, prev_tree, hash_algorithm,
+                                     block_size, salt, digest_padding,
+                                     changed_blocks)
+
     # If there's already a footer, truncate the image to its original
     # size. This way 'avbtool add_hashtree_footer' is idempotent
     # (modulo salts).
@@ -3703,6 +5426,12 @@ class Avb(object):
                          'size of {}.'.format(image.image_size, max_image_size,
                                               partition_size))
 
+      if prev_ht_desc and salt is None:
+        # Updating the hashtree only makes sense with the same salt.
+        salt = prev_ht_desc.salt.hex()
+      elif resume and salt is None and not use_persistent_root_digest:
+        # Resuming only makes sense with the same salt.
+        salt = HashtreeCheckpoint.read_salt(checkpoint_path)
       if salt:
         salt = binascii.unhexlify(salt)
       elif salt is None and not use_persistent_root_digest:
@@ -3727,20 +5456,93 @@ class Avb(object):
         padding_needed = image.block_size - (image.image_size%image.block_size)
         image.truncate(image.image_size + padding_needed)
 
-      # Generate the tree and add padding as needed.
+      # Generate the tree and add padding as needed. Unless the work is
+      # spread over several CPUs, FEC codes are generated in the same
+      # pass over the image. When updating a hashtree, only the parts
+      # for changed blocks are generated again.
       tree_offset = image.image_size
-      root_digest, hash_tree = generate_hash_tree(image, image.image_size,
-                                                  block_size,
-                                                  hash_algorithm, salt,
-                                                  digest_padding,
-                                                  hash_level_offsets,
-                                                  tree_size)
+      fec_data = None
+      fec_blocks = None
+      if jobs == 0:
+        jobs = os.cpu_count() or 1
+      checkpoint = None
+      if checkpoint_path and not prev_ht_desc and not no_hashtree:
+        checkpoint = HashtreeCheckpoint(
+            checkpoint_path, image, original_image_size, block_size,
+            hash_algorithm, salt, tree_size,
+            fec_num_roots if generate_fec else 0)
+        if resume and checkpoint.load():
+          # The image may have been padded before the checkpoint was saved.
+          original_image_size = checkpoint.original_image_size
+          print('Resuming from checkpoint {}: {} of {} data ranges hashed, '
+                '{} of {} FEC windows encoded'.format(
+                    checkpoint_path, sum(map(bool, checkpoint.hashed)),
+                    len(checkpoint.hashed),
+                    sum(map(bool, checkpoint.encoded)),
+                    len(checkpoint.encoded)))
+      if prev_ht_desc and tree_size:
+        if (prev_ht_desc.image_size != image.image_size or
+            prev_ht_desc.tree_offset != tree_offset or
+            prev_ht_desc.tree_size != tree_size):
+          raise AvbError('The hashtree to update was generated for an image '
+                         'of a different size.')
+        if changed_blocks is None:
+          changed_blocks = find_changed_blocks(image, previous,
+                                               image.image_size, block_size)
+        hasher = create_avb_hashtree_hasher(hash_algorithm, salt)
+        hash_tree = bytearray(prev_tree)
+        root_digest, changed_tree_blocks = update_hash_tree(
+            image, hash_tree, image.image_size, block_size, hasher,
+            digest_padding, hash_level_offsets, changed_blocks)
+
+        # FEC data can be updated if it covers the same data and tree.
+        fec_offset = tree_offset + round_to_multiple(tree_size,
+                                                     image.block_size)
+        if (generate_fec and prev_ht_desc.fec_num_roots == fec_num_roots and
+            prev_ht_desc.fec_offset == fec_offset and
+            prev_ht_desc.fec_size == calc_fec_data_size(
+                fec_offset, fec_num_roots) - FEC_BLOCKSIZE):
+          regions = [(n * block_size, block_size) for n in changed_blocks]
+          regions.extend((tree_offset + offset, block_size)
+                         for offset in changed_tree_blocks)
+          fec_blocks = set()
+          for offset, size in regions:
+            fec_blocks.update(range(offset - offset % FEC_BLOCKSIZE,
+                                    offset + size, FEC_BLOCKSIZE))
+      elif checkpoint is not None:
+        # The image isn't modified before the footer is added, so the
+        # checkpoint stays valid. FEC data is generated with the hashtree
+        # taken from memory.
+        root_digest, hash_tree = generate_hash_tree(
+            image, image.image_size, block_size, hash_algorithm, salt,
+            digest_padding, hash_level_offsets, tree_size, jobs, checkpoint)
+        if generate_fec:
+          checkpoint.save(force=True)
+          padded_tree = hash_tree
+          if len(hash_tree) % image.block_size:
+            padded_tree = hash_tree + b'\0' * (
+                image.block_size - len(hash_tree) % image.block_size)
+          fec_data = generate_fec_data(image, fec_num_roots, jobs,
+                                       hash_tree=padded_tree,
+                                       checkpoint=checkpoint)
+      elif (generate_fec and not no_hashtree and jobs == 1 and
+            image.image_size > block_size):
+        root_digest, hash_tree, fec_data = generate_hash_tree_and_fec_data(
+            image, block_size, hash_algorithm, salt, digest_padding,
+            hash_level_offsets, tree_size, fec_num_roots)
+      else:
+        root_digest, hash_tree = generate_hash_tree(image, image.image_size,
+                                                    block_size,
+                                                    hash_algorithm, salt,
+                                                    digest_padding,
+                                                    hash_level_offsets,
+                                                    tree_size, jobs)
 
       # Generate HashtreeDescriptor with details about the tree we
       # just generated.
       if no_hashtree:
         tree_size = 0
-        hash_tree = b''
+        hash_tree = bytearray()
       ht_desc = AvbHashtreeDescriptor()
       ht_desc.dm_verity_version = 1
       ht_desc.image_size = image.image_size
@@ -3758,20 +5560,27 @@ class Avb(object):
       if check_at_most_once:
         ht_desc.flags |= AvbHashtreeDescriptor.FLAGS_CHECK_AT_MOST_ONCE
 
-      # Write the hash tree
+      # Write the hash tree. It is padded in place, which is a no-op
+      # unless the hashtree block size is smaller than the one of the
+      # image.
       padding_needed = (round_to_multiple(len(hash_tree), image.block_size) -
                         len(hash_tree))
-      hash_tree_with_padding = hash_tree + b'\0' * padding_needed
-      if len(hash_tree_with_padding) > 0:
-        image.append_raw(hash_tree_with_padding)
-      len_hashtree_and_fec = len(hash_tree_with_padding)
+      if padding_needed > 0:
+        hash_tree.extend(b'\0' * padding_needed)
+      if hash_tree:
+        image.append_raw(hash_tree)
+      len_hashtree_and_fec = len(hash_tree)
+      del hash_tree
 
       # Generate FEC codes, if requested.
       if generate_fec:
         if no_hashtree:
           fec_data = b''
-        else:
-          fec_data = generate_fec_data(image_filename, fec_num_roots)
+        elif fec_blocks is not None:
+          fec_data = update_fec_data(image, fec_num_roots, prev_fec,
+                                     fec_blocks)
+        elif fec_data is None:
+          fec_data = generate_fec_data(image, fec_num_roots, jobs)
         padding_needed = (round_to_multiple(len(fec_data), image.block_size) -
                           len(fec_data))
         fec_data_with_padding = fec_data + b'\0' * padding_needed
@@ -3796,7 +5605,8 @@ class Avb(object):
           kernel_cmdlines, setup_rootfs_from_kernel, ht_desc_to_setup,
           include_descriptors_from_image, signing_helper,
           signing_helper_with_files, release_string,
-          append_to_release_string, required_libavb_version_minor)
+          append_to_release_string, required_libavb_version_minor,
+          signing_helper_persistent)
       padding_needed = (round_to_multiple(len(vbmeta_blob), image.block_size) -
                         len(vbmeta_blob))
       vbmeta_blob_with_padding = vbmeta_blob + b'\0' * padding_needed
@@ -3807,14 +5617,6 @@ class Avb(object):
 
       # Append vbmeta blob and footer, unless requested not to.
       if not do_not_append_vbmeta_image:
-        image.append_raw(vbmeta_blob_with_padding)
-
-        # Now insert a DONT_CARE chunk with enough bytes such that the
-        # final Footer block is at the end of partition_size..
-        if partition_size > 0:
-          image.append_dont_care(partition_size - image.image_size -
-                                 1 * image.block_size)
-
         # Generate the Footer that tells where the VBMeta footer
         # is. Also put enough padding in the front of the footer since
         # we'll write out an entire block.
@@ -3825,17 +5627,31 @@ class Avb(object):
         footer_blob = footer.encode()
         footer_blob_with_padding = (
             b'\0' * (image.block_size - AvbFooter.SIZE) + footer_blob)
-        image.append_raw(footer_blob_with_padding)
+
+        with image.append_transaction():
+          image.append_raw(vbmeta_blob_with_padding)
+
+          # Now insert a DONT_CARE chunk with enough bytes such that the
+          # final Footer block is at the end of partition_size..
+          if partition_size > 0:
+            image.append_dont_care(partition_size - image.image_size -
+                                   1 * image.block_size)
+
+          image.append_raw(footer_blob_with_padding)
 
     except Exception as e:
       # Truncate back to original size, then re-raise.
       image.truncate(original_image_size)
       raise AvbError('Adding hashtree_footer failed: {}.'.format(e)) from e
+    if checkpoint is not None:
+      checkpoint.remove()
+    image.log_io_stats('add_hashtree_footer')
 
   def make_atx_certificate(self, output, authority_key_path, subject_key_path,
                            subject_key_version, subject,
                            is_intermediate_authority, usage, signing_helper,
-                           signing_helper_with_files):
+                           signing_helper_with_files,
+                           signing_helper_persistent=None):
     """Implements the 'make_atx_certificate' command.
 
     Android Things certificates are required for Android Things public key
@@ -3859,6 +5675,8 @@ class Avb(object):
       usage: If not empty, overrides the cert usage with a hash of this value.
       signing_helper: Program which signs a hash and returns the signature.
       signing_helper_with_files: Same as signing_helper but uses files instead.
+      signing_helper_persistent: Program which is started once and signs
+        all hashes.
 
     Raises:
       AvbError: If there an error during signing.
@@ -3883,8 +5701,10 @@ class Avb(object):
     if authority_key_path:
       rsa_key = RSAPublicKey(authority_key_path)
       algorithm_name = 'SHA512_RSA4096'
-      signature = rsa_key.sign(algorithm_name, signed_data, signing_helper,
-                               signing_helper_with_files)
+      signature = rsa_key.sign(
+          algorithm_name, signed_data, signing_helper,
+          signing_helper_with_files,
+          signing_helper_persistent=signing_helper_persistent)
     output.write(signed_data)
     output.write(signature)
 
@@ -3944,7 +5764,8 @@ class Avb(object):
   def make_atx_unlock_credential(self, output, intermediate_key_certificate,
                                  unlock_key_certificate, challenge_path,
                                  unlock_key_path, signing_helper,
-                                 signing_helper_with_files):
+                                 signing_helper_with_files,
+                                 signing_helper_persistent=None):
     """Implements the 'make_atx_unlock_credential' command.
 
     Android Things unlock credentials can be used to authorize the unlock of AVB
@@ -3968,6 +5789,8 @@ class Avb(object):
       unlock_key_path: [optional] A PEM file path with the unlock private key.
       signing_helper: Program which signs a hash and returns the signature.
       signing_helper_with_files: Same as signing_helper but uses files instead.
+      signing_helper_persistent: Program which is started once and signs
+        all hashes.
 
     Raises:
       AvbError: If an argument is incorrect or an error occurs during signing.
@@ -3990,8 +5813,10 @@ class Avb(object):
     if challenge_path and unlock_key_path:
       rsa_key = RSAPublicKey(unlock_key_path)
       algorithm_name = 'SHA512_RSA4096'
-      signature = rsa_key.sign(algorithm_name, challenge, signing_helper,
-                               signing_helper_with_files)
+      signature = rsa_key.sign(
+          algorithm_name, challenge, signing_helper,
+          signing_helper_with_files,
+          signing_helper_persistent=signing_helper_persistent)
       output.write(signature)
 
 
@@ -4035,11 +5860,281 @@ def calc_hash_level_offsets(image_size, block_size, digest_size):
 # See system/extras/libfec/include/fec/io.h for these definitions.
 FEC_FOOTER_FORMAT = '<LLLLLQ32s'
 FEC_MAGIC = 0xfecfecfe
+FEC_VERSION = 0
+FEC_BLOCKSIZE = 4096
+FEC_RSM = 255
+
+# Maximum number of codewords encoded at a time by FecEncoder.
+FEC_WINDOW_SIZE = 1024 * 1024
+
+
+class FecEncoder(object):
+  """Reed-Solomon encoder producing the same output as libfec.
+
+  libfec uses RS(255, 255 - num_roots) codes over GF(2^8) with the
+  field polynomial 0x11d, first consecutive root 0 and primitive
+  element 1. The input is interleaved so consecutive bytes of a
+  codeword are |rounds| * FEC_BLOCKSIZE bytes apart, where |rounds| is
+  the number of codewords per byte position divided by FEC_BLOCKSIZE.
+
+  Instead of encoding one codeword at a time, the encoder runs the
+  shift register of all codewords in a window in parallel: byte
+  position j of consecutive codewords is a contiguous stripe of the
+  input, so each step is a table lookup with bytes.translate() and an
+  XOR of large integers.
+
+  Attributes:
+    num_roots: Number of parity bytes per codeword.
+    rs_n: Number of data bytes per codeword.
+  """
+
+  GF_POLY = 0x11d
+
+  def __init__(self, num_roots):
+    """Initializes the encoder.
+
+    Arguments:
+      num_roots: Number of parity bytes per codeword.
+
+    Raises:
+      ValueError: If |num_roots| is out of range.
+    """
+    if not 0 < num_roots < FEC_RSM:
+      raise ValueError('Invalid number of FEC roots: {}'.format(num_roots))
+    self.num_roots = num_roots
+    self.rs_n = FEC_RSM - num_roots
+
+    # Log and anti-log tables for GF(2^8).
+    self._alpha_to = alpha_to = [0] * 256
+    self._index_of = index_of = [0] * 256
+    x = 1
+    for i in range(255):
+      alpha_to[i] = x
+      index_of[x] = i
+      x <<= 1
+      if x & 0x100:
+        x ^= self.GF_POLY
+
+    def gf_mul(a, b):
+      if a == 0 or b == 0:
+        return 0
+      return alpha_to[(index_of[a] + index_of[b]) % 255]
+
+    # Generator polynomial with roots alpha^0 ... alpha^(num_roots - 1),
+    # lowest coefficient first.
+    genpoly = [1]
+    for i in range(num_roots):
+      root = alpha_to[i]
+      genpoly = [a ^ gf_mul(b, root)
+                 for a, b in zip([0] + genpoly, genpoly + [0])]
+
+    # After a data byte the shift register is updated with
+    #   reg[k] = reg[k + 1] ^ feedback * genpoly[num_roots - 1 - k]
+    # so precompute multiplication tables for these coefficients.
+    self._mul_tables = []
+    for k in range(num_roots):
+      coeff = genpoly[num_roots - 1 - k]
+      self._mul_tables.append(bytes(gf_mul(v, coeff) for v in range(256)))
+
+  def get_rounds(self, inp_size):
+    """Returns the number of rounds for input of the given size."""
+    num_blocks = (inp_size + FEC_BLOCKSIZE - 1) // FEC_BLOCKSIZE
+    return (num_blocks + self.rs_n - 1) // self.rs_n
+
+  def encode(self, read_stripe, inp_size, jobs=1, streaming=False):
+    """Encodes data.
+
+    With more than one job, the windows of codewords are distributed
+    round-robin over forked worker processes. Each worker writes its
+    parity bytes into its own regions of a shared memory mapping, so the
+    result is the same as when encoding in a single process.
+
+    In streaming mode all windows are encoded side by side in this
+    process. |read_stripe| is then called for consecutive ranges covering
+    the input exactly once in ascending order, so the input is read
+    sequentially, at the cost of keeping |num_roots| stripes of shift
+    register state in memory.
+
+    Arguments:
+      read_stripe: Function taking an offset and a size and returning the
+          input data at that offset as a bytes-like object. Data missing
+          at the end is treated as zeroes. With more than one job it is
+          called from several processes at once.
+      inp_size: Size of the input.
+      jobs: Number of processes to use or 0 to use one per CPU. Ignored
+          in streaming mode.
+      streaming: Whether to read the input sequentially.
+
+    Returns:
+      The parity bytes, without the libfec header, as a bytearray.
+
+    Raises:
+      ValueError: If a worker process failed.
+    """
+    if jobs == 0:
+      jobs = os.cpu_count() or 1
+    num_codewords = self.get_rounds(inp_size) * FEC_BLOCKSIZE
+    fec_size = num_codewords * self.num_roots
+    if streaming:
+      fec = bytearray(fec_size)
+      self._encode_stripes(read_stripe, inp_size, num_codewords, fec)
+      return fec
+
+    window_size = min(FEC_WINDOW_SIZE, round_to_multiple(
+        -(-num_codewords // jobs), FEC_BLOCKSIZE))
+    fec = bytearray(fec_size)
+    self.encode_groups(read_stripe, inp_size,
+                       range(0, num_codewords, window_size), fec,
+                       window_size, jobs)
+    return fec
+
+  def encode_groups(self, read_stripe, inp_size, starts, output,
+                    group_size=FEC_BLOCKSIZE, jobs=1):
+    """Encodes some groups of consecutive codewords.
+
+    This is used to update the parity bytes of changed input or to
+    encode the input in several steps. The input block at |offset| holds
+    a symbol of the codeword at |offset| modulo |rounds| * FEC_BLOCKSIZE.
+
+    With more than one job, the groups are distributed round-robin over
+    forked worker processes, see encode().
+
+    Arguments:
+      read_stripe: Function to read input, see encode().
+      inp_size: Size of the input.
+      starts: Index of the first codeword of each group to encode,
+          multiples of FEC_BLOCKSIZE.
+      output: Writable buffer of the parity bytes of all codewords, as
+          returned by encode(). Only those of the groups are written.
+      group_size: Number of codewords in each group, a multiple of
+          FEC_BLOCKSIZE.
+      jobs: Number of processes to use.
+
+    Raises:
+      ValueError: If a worker process failed.
+    """
+    num_codewords = self.get_rounds(inp_size) * FEC_BLOCKSIZE
+    starts = list(starts)
+    if jobs == 1 or len(starts) == 1 or not hasattr(os, 'fork'):
+      self._encode_windows(read_stripe, inp_size, num_codewords, group_size,
+                           starts, output)
+      return
+
+    shared = mmap.mmap(-1, len(output))
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=self._encode_windows,
+                               args=(read_stripe, inp_size, num_codewords,
+                                     group_size, starts[n::jobs], shared))
+               for n in range(min(jobs, len(starts)))]
+    for worker in workers:
+      worker.start()
+    for worker in workers:
+      worker.join()
+    try:
+      if any(worker.exitcode != 0 for worker in workers):
+        raise ValueError('FEC encoding worker process failed.')
+      for start in starts:
+        end = min(start + group_size, num_codewords) * self.num_roots
+        output[start * self.num_roots:end] = shared[start * self.num_roots:
+                                                    end]
+    finally:
+      shared.close()
+
+  def _encode_windows(self, read_stripe, inp_size, num_codewords,
+                      window_size, starts, output):
+    """Encodes windows of codewords.
+
+    Arguments:
+      read_stripe: Function to read input, see encode().
+      inp_size: Size of the input.
+      num_codewords: Total number of codewords.
+      window_size: Number of codewords encoded at a time.
+      starts: Index of the first codeword of each window to encode.
+      output: Writable buffer the parity bytes are written to.
+    """
+    for start in starts:
+      size = min(window_size, num_codewords - start)
+      reg = [0] * self.num_roots
+      for j in range(self.rs_n):
+        offset = j * num_codewords + start
+        data = b''
+        if offset < inp_size:
+          data = read_stripe(offset, min(size, inp_size - offset))
+        reg = self._encode_step(reg, data, size)
+      self._store_parity(reg, start, size, output)
+
+  def _encode_stripes(self, read_stripe, inp_size, num_codewords, output):
+    """Encodes all codewords, reading the input in order.
+
+    Each stripe is split into windows of |FEC_WINDOW_SIZE| codewords with
+    shift registers of their own, which keeps the integers small enough
+    to be cache friendly.
+
+    Arguments:
+      read_stripe: Function to read input, see encode().
+      inp_size: Size of the input.
+      num_codewords: Total number of codewords.
+      output: Writable buffer the parity bytes are written to.
+    """
+    starts = range(0, num_codewords, FEC_WINDOW_SIZE)
+    regs = [[0] * self.num_roots for _ in starts]
+    for j in range(self.rs_n):
+      for n, start in enumerate(starts):
+        size = min(FEC_WINDOW_SIZE, num_codewords - start)
+        offset = j * num_codewords + start
+        data = b''
+        if offset < inp_size:
+          data = read_stripe(offset, min(size, inp_size - offset))
+        regs[n] = self._encode_step(regs[n], data, size)
+    for n, start in enumerate(starts):
+      self._store_parity(regs[n], start,
+                         min(FEC_WINDOW_SIZE, num_codewords - start), output)
+
+  def _encode_step(self, reg, data, size):
+    """Feeds one data byte of each codeword in a window to the encoder.
+
+    Arguments:
+      reg: The shift registers of the window, one integer per root.
+      data: The data bytes, missing ones at the end are zeroes.
+      size: The number of codewords in the window.
+
+    Returns:
+      The new shift registers.
+    """
+    feedback = int.from_bytes(data, 'little') ^ reg[0]
+    if feedback == 0:
+      return reg[1:] + [0]
+    feedback = feedback.to_bytes(size, 'little')
+    reg = list(reg)
+    for k in range(self.num_roots - 1):
+      reg[k] = reg[k + 1] ^ int.from_bytes(
+          feedback.translate(self._mul_tables[k]), 'little')
+    reg[-1] = int.from_bytes(feedback.translate(self._mul_tables[-1]),
+                             'little')
+    return reg
+
+  def _store_parity(self, reg, start, size, output):
+    """Writes the parity bytes of a window of codewords.
+
+    Arguments:
+      reg: The final shift registers of the window.
+      start: Index of the first codeword of the window.
+      size: The number of codewords in the window.
+      output: Writable buffer the parity bytes are written to.
+    """
+    # Parity bytes of a codeword are stored next to each other.
+    window = bytearray(size * self.num_roots)
+    for k in range(self.num_roots):
+      window[k::self.num_roots] = reg[k].to_bytes(size, 'little')
+    output[start * self.num_roots:(start + size) * self.num_roots] = window
 
 
 def calc_fec_data_size(image_size, num_roots):
   """Calculates how much space FEC data will take.
 
+  This is the same as fec_ecc_get_size() in libfec and includes the
+  block with the libfec header.
+
   Arguments:
     image_size: The size of the image.
     num_roots: Number of roots.
@@ -4049,58 +6144,845 @@ def calc_fec_data_size(image_size, num_roots):
     and with the requested number of FEC roots.
 
   Raises:
-    ValueError: If output from the 'fec' tool is invalid.
+    ValueError: If |num_roots| is out of range.
   """
-  p = subprocess.Popen(
-      ['fec', '--print-fec-size', str(image_size), '--roots', str(num_roots)],
-      stdout=subprocess.PIPE,
-      stderr=subprocess.PIPE)
-  (pout, perr) = p.communicate()
-  retcode = p.wait()
-  if retcode != 0:
-    raise ValueError('Error invoking fec: {}'.format(perr))
-  return int(pout)
-
-
-def generate_fec_data(image_filename, num_roots):
+  rounds = FecEncoder(num_roots).get_rounds(image_size)
+  return rounds * num_roots * FEC_BLOCKSIZE + FEC_BLOCKSIZE
+
+
+def generate_fec_data(image, num_roots, jobs=1, inp_size=None,
+                      hash_tree=None, checkpoint=None):
   """Generate FEC codes for an image.
 
+  Like 'fec --encode' this encodes the unsparsified data of Android
+  sparse images.
+
   Arguments:
-    image_filename: The filename of the image.
+    image: The image, as an ImageHandler.
     num_roots: Number of roots.
+    jobs: Number of processes to use or 0 to use one per CPU.
+    inp_size: Number of bytes from the start of the image to encode or
+      None to encode the whole image.
+    hash_tree: None or data to encode as if it followed these bytes,
+      e.g. a hash tree which isn't written to the image yet.
+    checkpoint: None or a HashtreeCheckpoint to record progress in and
+      to skip windows of codewords already encoded.
 
   Returns:
-    The FEC data blob as bytes.
+    The FEC data blob as a bytearray, without the libfec header.
 
   Raises:
-    ValueError: If calling the 'fec' tool failed or the output is invalid.
+    ValueError: If |num_roots| is out of range or encoding failed.
   """
-  with tempfile.NamedTemporaryFile() as fec_tmpfile:
+  if jobs == 0:
+    jobs = os.cpu_count() or 1
+  # Bytes read by worker processes, to add them to |image.bytes_read|.
+  # Without worker processes there's nothing to share, and the 'fork'
+  # start method may not even be available.
+  pid = os.getpid()
+  worker_bytes_read = None
+  if jobs > 1 and hasattr(os, 'fork'):
+    worker_bytes_read = multiprocessing.get_context('fork').Value('Q', 0)
+  if inp_size is None:
+    inp_size = image.image_size
+  image_size = inp_size
+  if hash_tree is not None:
+    inp_size += len(hash_tree)
+
+  def read_stripe(offset, size):
+    # Uses positional reads only so it's safe to call from several
+    # processes sharing the file descriptor.
+    data_size = max(min(size, image_size - offset), 0)
+    data = b''
+    if data_size:
+      bytes_read = image.bytes_read
+      data = join_extents(image.iter_extents(offset, data_size), offset,
+                          data_size)
+      if os.getpid() != pid:
+        with worker_bytes_read.get_lock():
+          worker_bytes_read.value += image.bytes_read - bytes_read
+    if data_size == size:
+      return data
+    tree_offset = offset + data_size - image_size
+    return bytes(data) + hash_tree[tree_offset:tree_offset + size - data_size]
+
+  # Pending writes must hit the file before worker processes are forked.
+  image.flush()
+  encoder = FecEncoder(num_roots)
+  if checkpoint is None:
+    fec_data = encoder.encode(read_stripe, inp_size, jobs)
+  else:
+    # Windows are encoded a few at a time so progress can be saved.
+    fec_data = checkpoint.fec
+    starts = [n * FEC_WINDOW_SIZE for n, done in enumerate(checkpoint.encoded)
+              if not done]
+    for n in range(0, len(starts), jobs):
+      encoder.encode_groups(read_stripe, inp_size, starts[n:n + jobs],
+                            fec_data, FEC_WINDOW_SIZE, jobs)
+      for start in starts[n:n + jobs]:
+        checkpoint.encoded[start // FEC_WINDOW_SIZE] = 1
+      checkpoint.save()
+  if worker_bytes_read is not None:
+    image.bytes_read += worker_bytes_read.value
+  return fec_data
+
+
+def update_fec_data(image, num_roots, fec_data, offsets, inp_size=None):
+  """Updates FEC codes for changed blocks of an image.
+
+  Only the codewords going through the changed blocks are encoded
+  again. Each block of FEC_BLOCKSIZE bytes holds one symbol of
+  FEC_BLOCKSIZE consecutive codewords, so every changed block costs
+  reading the blocks at the same offset modulo the stripe size.
+
+  Arguments:
+    image: The image, as an ImageHandler.
+    num_roots: Number of roots.
+    fec_data: The FEC data from before the change, as a bytearray
+      without the libfec header. It is updated in place.
+    offsets: Offsets of the changed blocks in the encoded data,
+      multiples of FEC_BLOCKSIZE.
+    inp_size: Number of bytes from the start of the image to encode or
+      None to encode the whole image.
+
+  Returns:
+    The updated FEC data.
+
+  Raises:
+    ValueError: If |num_roots| is out of range.
+  """
+  def read_stripe(offset, size):
+    return join_extents(image.iter_extents(offset, size), offset, size)
+
+  if inp_size is None:
+    inp_size = image.image_size
+  encoder = FecEncoder(num_roots)
+  num_codewords = encoder.get_rounds(inp_size) * FEC_BLOCKSIZE
+  starts = sorted(set(offset % num_codewords for offset in offsets))
+  encoder.encode_groups(read_stripe, inp_size, starts, fec_data)
+  return fec_data
+
+
+def count_bad_fec_codewords(fec_data, fec_ondisk, num_roots):
+  """Counts codewords whose parity bytes differ.
+
+  Arguments:
+    fec_data: The expected parity bytes, e.g. from generate_fec_data().
+    fec_ondisk: The stored parity bytes.
+    num_roots: Number of roots.
+
+  Returns:
+    The number of codewords with parity bytes different from the
+    expected ones.
+  """
+  if fec_data == fec_ondisk:
+    return 0
+  if len(fec_data) != len(fec_ondisk):
+    return len(fec_data) // num_roots
+  fec_data = memoryview(fec_data)
+  fec_ondisk = memoryview(fec_ondisk)
+  num_bad = 0
+  # Compare windows first so only damaged windows are compared bytewise.
+  window_size = FEC_BLOCKSIZE * num_roots
+  for offset in range(0, len(fec_data), window_size):
+    expected = fec_data[offset:offset + window_size]
+    stored = fec_ondisk[offset:offset + window_size]
+    if expected == stored:
+      continue
+    for pos in range(0, len(expected), num_roots):
+      if expected[pos:pos + num_roots] != stored[pos:pos + num_roots]:
+        num_bad += 1
+  return num_bad
+
+
+class FecDecoder(FecEncoder):
+  """Reed-Solomon erasure decoder for data encoded by FecEncoder.
+
+  Erasures are codeword positions whose symbols are known to be wrong,
+  e.g. because the hashtree says so. Up to |num_roots| erasures per
+  codeword can be corrected, twice as many as errors at unknown
+  positions. Like the encoder, this works on the symbols of many
+  codewords at once.
+  """
+
+  def __init__(self, num_roots):
+    """Initializes the decoder.
+
+    Arguments:
+      num_roots: Number of parity bytes per codeword.
+
+    Raises:
+      ValueError: If |num_roots| is out of range.
+    """
+    super().__init__(num_roots)
+    self._tables = {}
+
+  def _gf_mul(self, a, b):
+    if a == 0 or b == 0:
+      return 0
+    return self._alpha_to[(self._index_of[a] + self._index_of[b]) % 255]
+
+  def _gf_inv(self, a):
+    return self._alpha_to[(255 - self._index_of[a]) % 255]
+
+  def _get_mul_table(self, coeff):
+    table = self._tables.get(coeff)
+    if table is None:
+      table = bytes(self._gf_mul(v, coeff) for v in range(256))
+      self._tables[coeff] = table
+    return table
+
+  def decode_erasures(self, symbols, erasures, size):
+    """Recovers erased symbols of a group of codewords.
+
+    Arguments:
+      symbols: List of FEC_RSM bytes-like objects, one for every position
+          in the codewords, i.e. the |rs_n| data bytes followed by the
+          |num_roots| parity bytes. Each holds the symbols of |size|
+          consecutive codewords at that position, missing ones at the end
+          are zeroes. Symbols at erased positions are ignored.
+      erasures: List of erased positions.
+      size: The number of codewords.
+
+    Returns:
+      A list with the recovered symbols at each erased position as bytes.
+
+    Raises:
+      ValueError: If there are more erasures than roots.
+    """
+    num_erasures = len(erasures)
+    if num_erasures > self.num_roots:
+      raise ValueError('Too many erasures: {}'.format(num_erasures))
+    erased = set(erasures)
+
+    # The codeword polynomial has the first symbol as the highest
+    # coefficient, so syndrome i is the sum of symbol m times
+    # alpha^(i * (FEC_RSM - 1 - m)) over all positions m. With the erased
+    # symbols left out it is the sum over the erased values instead.
+    syndromes = []
+    for i in range(num_erasures):
+      syndrome = 0
+      for m, data in enumerate(symbols):
+        if m in erased or not data:
+          continue
+        coeff = self._alpha_to[(i * (FEC_RSM - 1 - m)) % 255]
+        syndrome ^= int.from_bytes(
+            bytes(data).translate(self._get_mul_table(coeff)), 'little')
+      syndromes.append(syndrome.to_bytes(size, 'little'))
+
+    # Solve the Vandermonde system
+    #   sum_k x_k * X_k^i = syndrome_i  with  X_k = alpha^(FEC_RSM - 1 - e_k)
+    # by inverting its matrix with Gauss-Jordan elimination.
+    locators = [self._alpha_to[(FEC_RSM - 1 - e) % 255] for e in erasures]
+    matrix = [[1] * num_erasures]
+    for i in range(1, num_erasures):
+      matrix.append([self._gf_mul(a, b) for a, b in zip(matrix[-1],
+                                                          locators)])
+    inverse = [[int(i == k) for k in range(num_erasures)]
+               for i in range(num_erasures)]
+    for col in range(num_erasures):
+      pivot = next(r for r in range(col, num_erasures) if matrix[r][col])
+      matrix[col], matrix[pivot] = matrix[pivot], matrix[col]
+      inverse[col], inverse[pivot] = inverse[pivot], inverse[col]
+      scale = self._gf_inv(matrix[col][col])
+      matrix[col] = [self._gf_mul(v, scale) for v in matrix[col]]
+      inverse[col] = [self._gf_mul(v, scale) for v in inverse[col]]
+      for r in range(num_erasures):
+        factor = matrix[r][col]
+        if r != col and factor:
+          matrix[r] = [a ^ self._gf_mul(factor, b)
+                       for a, b in zip(matrix[r], matrix[col])]
+          inverse[r] = [a ^ self._gf_mul(factor, b)
+                        for a, b in zip(inverse[r], inverse[col])]
+
+    # Row i of the system is for syndrome i and column k for erasure k,
+    # so erasure k is row k of the inverse applied to the syndromes.
+    values = []
+    for k in range(num_erasures):
+      value = 0
+      for i in range(num_erasures):
+        if inverse[k][i]:
+          value ^= int.from_bytes(
+              syndromes[i].translate(self._get_mul_table(inverse[k][i])),
+              'little')
+      values.append(value.to_bytes(size, 'little'))
+    return values
+
+
+def repair_fec_blocks(fd, inp_size, fec_offset, num_roots, blocks):
+  """Rewrites erased blocks of FEC-protected data from FEC data.
+
+  Only the codewords going through the erased blocks are decoded. Each
+  block of FEC_BLOCKSIZE bytes holds one symbol of FEC_BLOCKSIZE
+  consecutive codewords, so all blocks at the same offset modulo the
+  stripe size are decoded together.
+
+  Arguments:
+    fd: File descriptor of the image, open for reading and writing.
+    inp_size: Size of the data protected by FEC, starting at offset 0.
+    fec_offset: Offset of the parity bytes.
+    num_roots: Number of roots.
+    blocks: Offsets of the erased blocks, multiples of FEC_BLOCKSIZE.
+
+  Returns:
+    A list with the offsets of blocks which can't be repaired because
+    there are more erasures than roots in their codewords. If it's not
+    empty, nothing was written.
+  """
+  decoder = FecDecoder(num_roots)
+  num_codewords = decoder.get_rounds(inp_size) * FEC_BLOCKSIZE
+  groups = {}
+  for offset in blocks:
+    groups.setdefault(offset % num_codewords, []).append(
+        offset // num_codewords)
+
+  failed = []
+  for start, erasures in sorted(groups.items()):
+    if len(erasures) > num_roots:
+      failed.extend(j * num_codewords + start for j in erasures)
+  if failed:
+    return failed
+
+  for start, erasures in sorted(groups.items()):
+    symbols = []
+    for j in range(decoder.rs_n):
+      offset = j * num_codewords + start
+      if j in erasures or offset >= inp_size:
+        symbols.append(b'')
+      else:
+        symbols.append(os.pread(fd, min(FEC_BLOCKSIZE, inp_size - offset),
+                                offset))
+    parity = os.pread(fd, FEC_BLOCKSIZE * num_roots,
+                      fec_offset + start * num_roots)
+    for k in range(num_roots):
+      symbols.append(parity[k::num_roots])
+    values = decoder.decode_erasures(symbols, erasures, FEC_BLOCKSIZE)
+    for j, value in zip(erasures, values):
+      offset = j * num_codewords + start
+      os.pwrite(fd, value[:inp_size - offset], offset)
+  return []
+
+
+def join_extents(extents, offset, size):
+  """Assembles extents from ImageHandler.iter_extents() into data.
+
+  Arguments:
+    extents: The extents, covering at most |size| bytes from |offset|.
+    offset: The offset of the first extent.
+    size: The size of the range.
+
+  Returns:
+    The data as a bytes-like object. It is empty if the range only
+    contains zeroes and the data of a single raw extent is returned
+    without copying it.
+  """
+  data = None
+  for (extent_type, extent_offset, extent_size, extent_data) in extents:
+    if extent_size == size:
+      if extent_type == ImageHandler.EXTENT_RAW:
+        return extent_data
+      if extent_type == ImageHandler.EXTENT_ZERO:
+        return b''
+    if data is None:
+      data = bytearray(size)
+    pos = extent_offset - offset
+    if extent_type == ImageHandler.EXTENT_RAW:
+      data[pos:pos + extent_size] = extent_data
+    elif extent_type == ImageHandler.EXTENT_FILL:
+      data[pos:pos + extent_size] = (
+          extent_data * (extent_size // 4 + 1))[:extent_size]
+  return data or b''
+
+
+def update_hasher_from_extents(hasher, extents):
+  """Hashes extents from ImageHandler.iter_extents() in order.
+
+  Runs of FILL and zero data are fed to the hasher from a buffer with
+  the repeated pattern, so they're neither read nor expanded in memory.
+
+  Arguments:
+    hasher: The hasher to update.
+    extents: The extents to hash.
+  """
+  pattern_buffers = {}
+  for (extent_type, _, extent_size, data) in extents:
+    if extent_type == ImageHandler.EXTENT_RAW:
+      hasher.update(data)
+      continue
+    if extent_type == ImageHandler.EXTENT_FILL:
+      pattern = data
+    else:
+      pattern = b'\0\0\0\0'
+    buf = pattern_buffers.get(pattern)
+    if buf is None:
+      if len(pattern_buffers) >= ImageHandler.MAX_PATTERN_BUFFERS:
+        pattern_buffers.clear()
+      buf = memoryview(pattern * (ImageHandler.MAX_RAW_EXTENT_SIZE // 4))
+      pattern_buffers[pattern] = buf
+    for _ in range(extent_size // len(buf)):
+      hasher.update(buf)
+    hasher.update(buf[:extent_size % len(buf)])
+
+
+def generate_hash_tree_and_fec_data(image, block_size, hash_alg_name, salt,
+                                    digest_padding, hash_level_offsets,
+                                    tree_size, num_roots):
+  """Generates the hash tree and FEC codes for an image in one pass.
+
+  This gives the same result as generate_hash_tree() followed by
+  appending the hash tree, padded to the block size of the image, and
+  generate_fec_data(), but the image is read only once. FEC stripes are
+  encoded in order (see FecEncoder.encode()) so the data blocks are
+  hashed as they are read for the FEC encoder. Once the encoder reaches
+  the end of the data, the upper levels of the tree are generated and
+  the tree is encoded from memory.
+
+  Arguments:
+    image: The image, as an ImageHandler. Its size must be larger than
+      |block_size|.
+    block_size: The block size, e.g. 4096.
+    hash_alg_name: The hash algorithm, e.g. 'sha256' or 'sha1'.
+    salt: The salt to use.
+    digest_padding: The padding for each digest.
+    hash_level_offsets: The offsets from calc_hash_level_offsets().
+    tree_size: The size of the tree, in number of bytes.
+    num_roots: Number of roots.
+
+  Returns:
+    A tuple with the top-level hash as bytes, the hash tree padded to a
+    multiple of the block size of the image as a bytearray and the FEC
+    data blob without the libfec header as a bytearray.
+
+  Raises:
+    ValueError: If |num_roots| is out of range.
+  """
+  image_size = image.image_size
+  assert image_size > block_size
+  hash_tree = bytearray(round_to_multiple(tree_size, image.block_size))
+  tree_view = memoryview(hash_tree)
+  salted_hasher = create_avb_hashtree_hasher(hash_alg_name, salt)
+  data_block_hasher = DataBlockHasher(
+      block_size, salted_hasher, digest_padding,
+      get_hash_tree_level(hash_tree, image_size, block_size, salted_hasher,
+                          digest_padding, hash_level_offsets))
+  root_digest = None
+
+  def hash_extents(extents):
+    for extent in extents:
+      data_block_hasher.update(extent[0], extent[2], extent[3])
+      yield extent
+
+  def read_stripe(offset, size):
+    nonlocal root_digest
+    data_size = max(min(size, image_size - offset), 0)
+    if data_size:
+      data = join_extents(
+          hash_extents(image.iter_extents(offset, data_size,
+                                          HASH_WINDOW_SIZE)),
+          offset, data_size)
+      if data_size == size:
+        return data
+    # All data has been read, so the tree can be completed.
+    if root_digest is None:
+      data_block_hasher.finish()
+      root_digest = complete_hash_tree(
+          hash_tree, image_size, block_size, salted_hasher, digest_padding,
+          hash_level_offsets)
+    tree_offset = offset + data_size - image_size
+    tree_data = tree_view[tree_offset:tree_offset + size - data_size]
+    if not data_size:
+      return tree_data
+    stripe = bytearray(size)
+    stripe[:len(data)] = data
+    stripe[data_size:] = tree_data
+    return stripe
+
+  fec_data = FecEncoder(num_roots).encode(
+      read_stripe, image_size + len(hash_tree), streaming=True)
+  assert root_digest is not None
+  return root_digest, hash_tree, fec_data
+
+
+def encode_fec_header(fec_data, num_roots, inp_size):
+  """Encodes the libfec header for FEC data.
+
+  'fec --encode' writes this header at the start and at the end of a
+  FEC_BLOCKSIZE block following the parity bytes.
+
+  Arguments:
+    fec_data: The parity bytes from generate_fec_data().
+    num_roots: Number of roots.
+    inp_size: Size of the encoded input. libfec stores it rounded up to
+      a multiple of FEC_BLOCKSIZE.
+
+  Returns:
+    The header as bytes.
+  """
+  return struct.pack(FEC_FOOTER_FORMAT, FEC_MAGIC, FEC_VERSION,
+                     struct.calcsize(FEC_FOOTER_FORMAT), num_roots,
+                     len(fec_data), round_to_multiple(inp_size, FEC_BLOCKSIZE),
+                     hashlib.sha256(fec_data).digest())
+
+
+# Size of the ranges of an image hashed by each task when hashing data
+# blocks with several threads.
+HASH_JOB_SIZE = 32 * 1024 * 1024
+
+# Size of the windows raw data is read in when hashing data blocks.
+HASH_WINDOW_SIZE = 4 * 1024 * 1024
+
+
+# Minimum number of seconds between writes of a HashtreeCheckpoint.
+CHECKPOINT_INTERVAL = 30
+
+
+class HashtreeCheckpoint(object):
+  """Progress of generating a hash tree and FEC data, kept in a file.
+
+  Data blocks are hashed in ranges of |HASH_JOB_SIZE| bytes and FEC
+  data is encoded in windows of |FEC_WINDOW_SIZE| codewords. The file
+  records which ranges and windows are done together with the tree and
+  FEC data generated so far. It's written at most every
+  |CHECKPOINT_INTERVAL| seconds and replaced atomically.
+
+  Like the chunk index cache of ImageHandler, a checkpoint is only
+  loaded if it was written for a file with the same size, modification
+  time, inode and device as the image. All parameters the result
+  depends on have to match as well, otherwise it's discarded.
+
+  Attributes:
+    path: The path of the checkpoint file.
+    original_image_size: The size of the image before it was padded to
+      a multiple of the block size.
+    tree: The hash tree, as a bytearray.
+    hashed: A bytearray with a non-zero byte for each range of data
+      blocks already hashed.
+    fec: The FEC data, as a bytearray.
+    encoded: A bytearray with a non-zero byte for each window of
+      codewords already encoded.
+  """
+
+  MAGIC = b'AVBCKPT\0'
+  VERSION = 1
+  HEADER_FORMAT = ('<8s'  # magic
+                   'L'    # version
+                   'QQQQ'  # size, mtime_ns, inode and device of the image
+                   'Q'    # image size
+                   'L'    # block size
+                   '32s'  # hash algorithm
+                   'L'    # salt length
+                   'Q'    # tree size
+                   'L'    # FEC number of roots
+                   'Q'    # FEC size
+                   'Q'    # hashing range size
+                   'Q')   # FEC window size
+
+  def __init__(self, path, image, original_image_size, block_size,
+               hash_algorithm, salt, tree_size, num_roots):
+    """Initializes an empty checkpoint.
+
+    Arguments:
+      path: The path of the checkpoint file.
+      image: The image, as an ImageHandler. It must not be modified while
+        the checkpoint is in use.
+      original_image_size: The size of the image before it was padded.
+      block_size: The block size, e.g. 4096.
+      hash_algorithm: The hash algorithm, e.g. 'sha256' or 'sha1'.
+      salt: The salt.
+      tree_size: The size of the hash tree.
+      num_roots: Number of roots for FEC or 0 if no FEC data is
+        generated.
+    """
+    self.path = path
+    self.original_image_size = original_image_size
+    image.flush()
+    st = os.stat(image.filename)
+    fec_size = 0
+    num_windows = 0
+    if num_roots:
+      inp_size = image.image_size + round_to_multiple(tree_size,
+                                                      image.block_size)
+      fec_size = calc_fec_data_size(inp_size, num_roots) - FEC_BLOCKSIZE
+      num_windows = -(-fec_size // num_roots // FEC_WINDOW_SIZE)
+    job_size = round_to_multiple(HASH_JOB_SIZE, block_size)
+    self._header = struct.pack(
+        self.HEADER_FORMAT, self.MAGIC, self.VERSION, st.st_size,
+        st.st_mtime_ns, st.st_ino, st.st_dev, image.image_size, block_size,
+        hash_algorithm.encode('ascii'), len(salt), tree_size, num_roots,
+        fec_size, job_size, FEC_WINDOW_SIZE) + salt
+    self.tree = bytearray(tree_size)
+    self.hashed = bytearray(-(-image.image_size // job_size))
+    self.fec = bytearray(fec_size)
+    self.encoded = bytearray(num_windows)
+    self._last_save = time.monotonic()
+
+  def load(self):
+    """Loads the progress from the checkpoint file.
+
+    Returns:
+      True if the progress was loaded, False if there's no checkpoint
+      file or it doesn't match.
+    """
+    fields = (self.hashed, self.tree, self.encoded, self.fec)
     try:
-      subprocess.check_call(
-          ['fec', '--encode', '--roots', str(num_roots), image_filename,
-           fec_tmpfile.name],
-          stderr=open(os.devnull, 'wb'))
-    except subprocess.CalledProcessError as e:
-      raise ValueError('Execution of \'fec\' tool failed: {}.'
-                       .format(e)) from e
-    fec_data = fec_tmpfile.read()
-
-  footer_size = struct.calcsize(FEC_FOOTER_FORMAT)
-  footer_data = fec_data[-footer_size:]
-  (magic, _, _, num_roots, fec_size, _, _) = struct.unpack(FEC_FOOTER_FORMAT,
-                                                           footer_data)
-  if magic != FEC_MAGIC:
-    raise ValueError('Unexpected magic in FEC footer')
-  return fec_data[0:fec_size]
+      with open(self.path, 'rb') as f:
+        if (os.fstat(f.fileno()).st_size !=
+            len(self._header) + 8 + sum(len(field) for field in fields) or
+            f.read(len(self._header)) != self._header):
+          return False
+        (self.original_image_size,) = struct.unpack('<Q', f.read(8))
+        for field in fields:
+          f.readinto(field)
+    except OSError:
+      return False
+    return True
+
+  def save(self, force=False):
+    """Writes the progress to the checkpoint file.
+
+    Arguments:
+      force: If False, nothing is written unless the file was last
+        written at least |CHECKPOINT_INTERVAL| seconds ago.
+    """
+    if not force and time.monotonic() - self._last_save < CHECKPOINT_INTERVAL:
+      return
+    tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+      f.write(self._header)
+      f.write(struct.pack('<Q', self.original_image_size))
+      for field in (self.hashed, self.tree, self.encoded, self.fec):
+        f.write(field)
+    os.replace(tmp_path, self.path)
+    self._last_save = time.monotonic()
+
+  @classmethod
+  def read_salt(cls, path):
+    """Reads the salt from a checkpoint file.
+
+    Arguments:
+      path: The path of the checkpoint file.
+
+    Returns:
+      The salt as a hexadecimal string or None if there's no valid
+      checkpoint file.
+    """
+    header_size = struct.calcsize(cls.HEADER_FORMAT)
+    try:
+      with open(path, 'rb') as f:
+        header = f.read(header_size)
+        (magic, version, _, _, _, _, _, _, _, salt_len, _, _, _, _,
+         _) = struct.unpack(cls.HEADER_FORMAT, header)
+        salt = f.read(salt_len)
+    except (OSError, struct.error):
+      return None
+    if magic != cls.MAGIC or version != cls.VERSION or len(salt) != salt_len:
+      return None
+    return salt.hex()
+
+  def remove(self):
+    """Removes the checkpoint file, if it exists."""
+    try:
+      os.remove(self.path)
+    except FileNotFoundError:
+      pass
+
+
+def hash_image_blocks(image, image_size, block_size, hasher, digest_padding,
+                      output, jobs=1, checkpoint=None):
+  """Hashes the data blocks of an image for the lowest hashtree level.
+
+  With more than one job, the image is split into ranges of
+  |HASH_JOB_SIZE| bytes that are hashed by a pool of threads. hashlib
+  releases the GIL while hashing so this scales with the number of
+  CPUs. With a checkpoint, the image is always split into such ranges
+  and ranges hashed before are skipped.
+
+  Arguments:
+    image: The image, as an ImageHandler.
+    image_size: The size of the image.
+    block_size: The block size, e.g. 4096.
+    hasher: A hasher already updated with the salt. It is copied for
+      each block and not modified itself.
+    digest_padding: The padding for each digest.
+    output: A writable memoryview the digests are written to, one every
+      digest size plus |digest_padding| bytes. Padding is left as is.
+    jobs: Number of threads to use or 0 to use one per CPU.
+    checkpoint: None or a HashtreeCheckpoint to record progress in.
+  """
+  if jobs == 0:
+    jobs = os.cpu_count() or 1
+  if checkpoint is None and (jobs == 1 or image_size <= HASH_JOB_SIZE):
+    hash_image_range(image, 0, image_size, block_size, hasher,
+                     digest_padding, output)
+    return
+
+  job_size = round_to_multiple(HASH_JOB_SIZE, block_size)
+  entry_size = hasher.digest_size + digest_padding
+  offsets = range(0, image_size, job_size)
+  if checkpoint is not None:
+    offsets = [offset for offset in offsets
+               if not checkpoint.hashed[offset // job_size]]
+  with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+    futures = [executor.submit(hash_image_range, image, offset,
+                               min(job_size, image_size - offset),
+                               block_size, hasher, digest_padding,
+                               output[offset // block_size * entry_size:])
+               for offset in offsets]
+    for offset, future in zip(offsets, futures):
+      future.result()
+      if checkpoint is not None:
+        checkpoint.hashed[offset // job_size] = 1
+        checkpoint.save()
+
+
+def hash_image_range(image, offset, size, block_size, hasher, digest_padding,
+                     output):
+  """Hashes the data blocks in a range of an image.
+
+  Raw data is read in windows of |HASH_WINDOW_SIZE| bytes. Runs of FILL
+  and DONT_CARE data are taken from the sparse chunk table via
+  ImageHandler.iter_extents(), see DataBlockHasher.
+
+  Arguments:
+    image: The image, as an ImageHandler.
+    offset: The offset of the range, must be a multiple of |block_size|.
+    size: The size of the range.
+    block_size: The block size, e.g. 4096.
+    hasher: A hasher already updated with the salt. It is copied for
+      each block and not modified itself.
+    digest_padding: The padding for each digest.
+    output: A writable memoryview the digests are written to, one every
+      digest size plus |digest_padding| bytes. A short last block is
+      hashed as if padded with zeroes.
+  """
+  block_hasher = DataBlockHasher(block_size, hasher, digest_padding, output)
+  for (extent_type, _, extent_size, data) in image.iter_extents(
+      offset, size, HASH_WINDOW_SIZE):
+    block_hasher.update(extent_type, extent_size, data)
+  block_hasher.finish()
+
+
+class DataBlockHasher(object):
+  """Hashes consecutive data blocks fed as extents.
+
+  Extents are as returned by ImageHandler.iter_extents() and don't need
+  to be aligned to blocks. Each block is hashed with a copy of the
+  pre-salted hasher, so the salt is only hashed once. Every distinct
+  FILL pattern is only hashed once and its digest is repeated for the
+  whole run.
+  """
+
+  def __init__(self, block_size, hasher, digest_padding, output):
+    """Initializes the hasher.
+
+    Arguments:
+      block_size: The block size, e.g. 4096.
+      hasher: A hasher already updated with the salt. It is copied for
+        each block and not modified itself.
+      digest_padding: The padding for each digest.
+      output: A writable memoryview the digests are written to, one every
+        digest size plus |digest_padding| bytes. Padding is left as is.
+    """
+    self._block_size = block_size
+    self._hasher = hasher
+    self._digest_size = hasher.digest_size
+    self._entry_size = hasher.digest_size + digest_padding
+    self._output = output
+    self._out_pos = 0
+    self._pattern_digests = {}
+    # Data of a block which spans several extents.
+    self._partial = bytearray()
+
+  def _hash_block(self, data):
+    block_hasher = self._hasher.copy()
+    block_hasher.update(data)
+    return block_hasher.digest()
+
+  def update(self, extent_type, extent_size, data):
+    """Hashes the next extent of data.
+
+    Arguments:
+      extent_type: One of the ImageHandler.EXTENT_* types.
+      extent_size: The size of the extent.
+      data: The data as returned by ImageHandler.iter_extents().
+    """
+    block_size = self._block_size
+    digest_size = self._digest_size
+    entry_size = self._entry_size
+    output = self._output
+    partial = self._partial
+    if extent_type == ImageHandler.EXTENT_RAW:
+      pattern = None
+    elif extent_type == ImageHandler.EXTENT_FILL:
+      pattern = data
+    else:
+      pattern = b'\0\0\0\0'
+    pos = 0
+
+    if partial:
+      num_bytes = min(block_size - len(partial), extent_size)
+      if pattern is None:
+        partial.extend(data[:num_bytes])
+      else:
+        partial.extend((pattern * (num_bytes // 4 + 1))[:num_bytes])
+      pos = num_bytes
+      if len(partial) == block_size:
+        output[self._out_pos:self._out_pos + digest_size] = (
+            self._hash_block(partial))
+        self._out_pos += entry_size
+        partial.clear()
+
+    num_blocks = (extent_size - pos) // block_size
+    end = pos + num_blocks * block_size
+    out_pos = self._out_pos
+    if pattern is None:
+      hasher = self._hasher
+      for block_offset in range(pos, end, block_size):
+        block_hasher = hasher.copy()
+        block_hasher.update(data[block_offset:block_offset + block_size])
+        output[out_pos:out_pos + digest_size] = block_hasher.digest()
+        out_pos += entry_size
+      partial.extend(data[end:extent_size])
+    else:
+      phase = pos % 4
+      pattern = pattern[phase:] + pattern[:phase]
+      if num_blocks:
+        digest = self._pattern_digests.get(pattern)
+        if digest is None:
+          digest = self._hash_block(pattern * (block_size // 4))
+          self._pattern_digests[pattern] = digest
+        # Replicate the digest by repeatedly doubling the filled part
+        # of the output instead of building the whole run in memory.
+        run_size = num_blocks * entry_size
+        output[out_pos:out_pos + digest_size] = digest
+        filled = entry_size
+        while filled < run_size:
+          num_bytes = min(filled, run_size - filled)
+          output[out_pos + filled:out_pos + filled + num_bytes] = (
+              output[out_pos:out_pos + num_bytes])
+          filled += num_bytes
+        out_pos += run_size
+      num_bytes = extent_size - end
+      partial.extend((pattern * (num_bytes // 4 + 1))[:num_bytes])
+    self._out_pos = out_pos
+
+  def finish(self):
+    """Hashes the last block, padding it with zeroes if it's short."""
+    if self._partial:
+      self._partial.extend(b'\0' * (self._block_size - len(self._partial)))
+      self._output[self._out_pos:self._out_pos + self._digest_size] = (
+          self._hash_block(self._partial))
+      self._out_pos += self._entry_size
+      self._partial.clear()
 
 
 def generate_hash_tree(image, image_size, block_size, hash_alg_name, salt,
-                       digest_padding, hash_level_offsets, tree_size):
+                       digest_padding, hash_level_offsets, tree_size, jobs=1,
+                       checkpoint=None):
   """Generates a Merkle-tree for a file.
 
   Arguments:
-    image: The image, as a file.
+    image: The image, as an ImageHandler.
     image_size: The size of the image.
     block_size: The block size, e.g. 4096.
     hash_alg_name: The hash algorithm, e.g. 'sha256' or 'sha1'.
@@ -4108,62 +6990,828 @@ def generate_hash_tree(image, image_size, block_size, hash_alg_name, salt,
     digest_padding: The padding for each digest.
     hash_level_offsets: The offsets from calc_hash_level_offsets().
     tree_size: The size of the tree, in number of bytes.
+    jobs: Number of threads to hash data blocks with or 0 to use one per
+      CPU.
+    checkpoint: None or a HashtreeCheckpoint to record progress in and
+      to take the digests of data blocks hashed before from.
 
   Returns:
     A tuple where the first element is the top-level hash as bytes and the
-    second element is the hash-tree as bytes.
+    second element is the hash-tree as a bytearray. All levels are
+    written in place into this single buffer.
   """
-  hash_ret = bytearray(tree_size)
-  hash_src_offset = 0
-  hash_src_size = image_size
-  level_num = 0
+  if checkpoint is not None:
+    hash_ret = checkpoint.tree
+  else:
+    hash_ret = bytearray(tree_size)
+  # All blocks are hashed with copies of this pre-salted hasher.
+  salted_hasher = create_avb_hashtree_hasher(hash_alg_name, salt)
 
   # If there is only one block, returns the top-level hash directly.
-  if hash_src_size == block_size:
-    hasher = create_avb_hashtree_hasher(hash_alg_name, salt)
+  if image_size == block_size:
+    hasher = salted_hasher.copy()
     image.seek(0)
-    hasher.update(image.read(block_size))
-    return hasher.digest(), bytes(hash_ret)
+    hasher.update(image.read_view(block_size))
+    return hasher.digest(), hash_ret
+
+  # Only read from the file for the first level - for subsequent
+  # levels, access the tree we're building.
+  level_output = get_hash_tree_level(hash_ret, image_size, block_size,
+                                     salted_hasher, digest_padding,
+                                     hash_level_offsets)
+  hash_image_blocks(image, image_size, block_size, salted_hasher,
+                    digest_padding, level_output, jobs, checkpoint)
+  root_digest = complete_hash_tree(hash_ret, image_size, block_size,
+                                   salted_hasher, digest_padding,
+                                   hash_level_offsets)
+  return root_digest, hash_ret
+
+
+def get_hash_tree_level(tree, image_size, block_size, hasher, digest_padding,
+                        hash_level_offsets, level_num=0):
+  """Returns where a level of a hash tree is stored in the tree.
 
-  while hash_src_size > block_size:
-    level_output_list = []
-    remaining = hash_src_size
-    while remaining > 0:
-      hasher = create_avb_hashtree_hasher(hash_alg_name, salt)
-      # Only read from the file for the first level - for subsequent
-      # levels, access the array we're building.
-      if level_num == 0:
-        image.seek(hash_src_offset + hash_src_size - remaining)
-        data = image.read(min(remaining, block_size))
-      else:
-        offset = hash_level_offsets[level_num - 1] + hash_src_size - remaining
-        data = hash_ret[offset:offset + block_size]
-      hasher.update(data)
+  Arguments:
+    tree: The hash tree, as a bytearray.
+    image_size: The size of the image.
+    block_size: The block size, e.g. 4096.
+    hasher: A hasher for the hash algorithm of the tree.
+    digest_padding: The padding for each digest.
+    hash_level_offsets: The offsets from calc_hash_level_offsets().
+    level_num: The level, 0 being the one with the digests of the data
+      blocks.
 
-      remaining -= len(data)
-      if len(data) < block_size:
-        hasher.update(b'\0' * (block_size - len(data)))
-      level_output_list.append(hasher.digest())
-      if digest_padding > 0:
-        level_output_list.append(b'\0' * digest_padding)
+  Returns:
+    A writable memoryview of the level, including its padding.
+  """
+  entry_size = hasher.digest_size + digest_padding
+  hash_src_size = image_size
+  for _ in range(level_num + 1):
+    num_blocks = (hash_src_size + block_size - 1) // block_size
+    hash_src_size = round_to_multiple(num_blocks * entry_size, block_size)
+  offset = hash_level_offsets[level_num]
+  return memoryview(tree)[offset:offset + hash_src_size]
 
-    level_output = b''.join(level_output_list)
 
-    padding_needed = (round_to_multiple(
-        len(level_output), block_size) - len(level_output))
-    level_output += b'\0' * padding_needed
+def complete_hash_tree(tree, image_size, block_size, hasher, digest_padding,
+                       hash_level_offsets):
+  """Generates the upper levels of a hash tree.
+
+  Arguments:
+    tree: The hash tree, as a bytearray, with the digests of the data
+      blocks already in place. It must contain at least one level.
+    image_size: The size of the image.
+    block_size: The block size, e.g. 4096.
+    hasher: A hasher already updated with the salt. It is copied for
+      each block and not modified itself.
+    digest_padding: The padding for each digest.
+    hash_level_offsets: The offsets from calc_hash_level_offsets().
 
-    # Copy level-output into resulting tree.
+  Returns:
+    The top-level hash as bytes.
+  """
+  tree = memoryview(tree)
+  entry_size = hasher.digest_size + digest_padding
+
+  # Each level is written directly into its place in the tree. As levels
+  # are padded to a multiple of the block size, only the data blocks can
+  # have a short last block.
+  num_blocks = (image_size + block_size - 1) // block_size
+  hash_src_size = round_to_multiple(num_blocks * entry_size, block_size)
+  level_input = tree[hash_level_offsets[0]:
+                     hash_level_offsets[0] + hash_src_size]
+  level_num = 1
+  while hash_src_size > block_size:
+    num_blocks = (hash_src_size + block_size - 1) // block_size
+    level_size = round_to_multiple(num_blocks * entry_size, block_size)
     offset = hash_level_offsets[level_num]
-    hash_ret[offset:offset + len(level_output)] = level_output
+    level_output = tree[offset:offset + level_size]
+
+    out_pos = 0
+    for block_offset in range(0, hash_src_size, block_size):
+      block_hasher = hasher.copy()
+      block_hasher.update(level_input[block_offset:block_offset + block_size])
+      level_output[out_pos:out_pos + hasher.digest_size] = (
+          block_hasher.digest())
+      out_pos += entry_size
 
     # Continue on to the next level.
-    hash_src_size = len(level_output)
+    level_input = level_output
+    hash_src_size = level_size
     level_num += 1
 
+  root_hasher = hasher.copy()
+  root_hasher.update(level_input)
+  return root_hasher.digest()
+
+
+def update_hash_tree(image, tree, image_size, block_size, hasher,
+                     digest_padding, hash_level_offsets, changed_blocks):
+  """Updates a hash tree for changed data blocks.
+
+  Only the digests of the changed data blocks and of the tree blocks
+  above them are computed again, which gives the same tree as
+  generate_hash_tree() for the changed image.
+
+  Arguments:
+    image: The image, as an ImageHandler.
+    tree: The hash tree from before the change, as a bytearray. It is
+      updated in place and must contain at least one level.
+    image_size: The size of the image.
+    block_size: The block size, e.g. 4096.
+    hasher: A hasher already updated with the salt. It is copied for
+      each block and not modified itself.
+    digest_padding: The padding for each digest.
+    hash_level_offsets: The offsets from calc_hash_level_offsets().
+    changed_blocks: A sorted list of the indexes of the changed data
+      blocks.
+
+  Returns:
+    A tuple with the top-level hash as bytes and a sorted list of the
+    offsets of the changed blocks of the tree.
+  """
+  entry_size = hasher.digest_size + digest_padding
+  level = get_hash_tree_level(tree, image_size, block_size, hasher,
+                              digest_padding, hash_level_offsets)
+  for first, count in get_ranges(changed_blocks):
+    offset = first * block_size
+    hash_image_range(image, offset,
+                     min(count * block_size, image_size - offset), block_size,
+                     hasher, digest_padding,
+                     level[first * entry_size:(first + count) * entry_size])
+
+  changed_tree_blocks = []
+  changed = sorted(set(n * entry_size // block_size for n in changed_blocks))
+  for level_num in range(len(hash_level_offsets)):
+    changed_tree_blocks.extend(hash_level_offsets[level_num] + n * block_size
+                               for n in changed)
+    if level_num == len(hash_level_offsets) - 1:
+      break
+    parent = get_hash_tree_level(tree, image_size, block_size, hasher,
+                                 digest_padding, hash_level_offsets,
+                                 level_num + 1)
+    for n in changed:
+      block_hasher = hasher.copy()
+      block_hasher.update(level[n * block_size:(n + 1) * block_size])
+      parent[n * entry_size:n * entry_size + hasher.digest_size] = (
+          block_hasher.digest())
+    level = parent
+    changed = sorted(set(n * entry_size // block_size for n in changed))
+
+  root_hasher = hasher.copy()
+  root_hasher.update(level)
+  return root_hasher.digest(), sorted(changed_tree_blocks)
+
+
+def find_changed_blocks(image, previous, size, block_size):
+  """Compares the data of two images block by block.
+
+  Arguments:
+    image: The image, as an ImageHandler.
+    previous: The image to compare with, as an ImageHandler.
+    size: Number of bytes from the start of the images to compare.
+    block_size: The block size, e.g. 4096.
+
+  Returns:
+    A sorted list of the indexes of the blocks which differ.
+  """
+  changed_blocks = []
+  window_size = round_to_multiple(HASH_WINDOW_SIZE, block_size)
+  for offset in range(0, size, window_size):
+    num_bytes = min(window_size, size - offset)
+    image.seek(offset)
+    data = image.read(num_bytes)
+    previous.seek(offset)
+    previous_data = previous.read(num_bytes)
+    if data == previous_data:
+      continue
+    for pos in range(0, num_bytes, block_size):
+      if data[pos:pos + block_size] != previous_data[pos:pos + block_size]:
+        changed_blocks.append((offset + pos) // block_size)
+  return changed_blocks
+
+
+def check_hash_tree(tree, image_size, block_size, hasher, digest_padding,
+                    hash_level_offsets, root_digest):
+  """Checks the blocks of a hash tree top-down.
+
+  Each block is checked against its digest in the level above, the top
+  level against |root_digest|. Blocks below a corrupted block can't be
+  checked.
+
+  Arguments:
+    tree: The stored hash tree. It must contain at least one level.
+    image_size: The size of the image.
+    block_size: The block size, e.g. 4096.
+    hasher: A hasher already updated with the salt. It is copied for
+      each block and not modified itself.
+    digest_padding: The padding for each digest.
+    hash_level_offsets: The offsets from calc_hash_level_offsets().
+    root_digest: The trusted top-level hash or None to trust the top
+      level of the tree.
+
+  Returns:
+    A tuple with a list telling for every block of the lowest level
+    whether it's intact, corrupted or can't be checked (True, False or
+    None), a list of the offsets of corrupted blocks in the tree and
+    the number of blocks which couldn't be checked.
+  """
+  tree = memoryview(tree)
+  digest_size = hasher.digest_size
+  entry_size = digest_size + digest_padding
+
+  def hash_block(data):
+    block_hasher = hasher.copy()
+    block_hasher.update(data)
+    return block_hasher.digest()
+
+  level_sizes = []
+  hash_src_size = image_size
+  while hash_src_size > block_size:
+    num_blocks = (hash_src_size + block_size - 1) // block_size
+    hash_src_size = round_to_multiple(num_blocks * entry_size, block_size)
+    level_sizes.append(hash_src_size)
+
+  # For every block of each level, whether it's intact, corrupted or
+  # can't be checked (True, False or None).
+  top = len(level_sizes) - 1
+  intact = [True]
+  if root_digest is not None:
+    top_data = tree[hash_level_offsets[top]:
+                    hash_level_offsets[top] + level_sizes[top]]
+    intact = [hash_block(top_data) == root_digest]
+  bad_tree_blocks = [] if intact[0] else [hash_level_offsets[top]]
+  num_unchecked = 0
+  for level_num in range(top, 0, -1):
+    parent = tree[hash_level_offsets[level_num]:]
+    level = tree[hash_level_offsets[level_num - 1]:]
+    level_intact = []
+    for block_num in range(level_sizes[level_num - 1] // block_size):
+      entry = block_num * entry_size
+      if not intact[entry // block_size]:
+        level_intact.append(None)
+        num_unchecked += 1
+        continue
+      digest = hash_block(
+          level[block_num * block_size:(block_num + 1) * block_size])
+      level_intact.append(digest == parent[entry:entry + digest_size])
+      if not level_intact[-1]:
+        bad_tree_blocks.append(hash_level_offsets[level_num - 1] +
+                               block_num * block_size)
+    intact = level_intact
+  return intact, bad_tree_blocks, num_unchecked
+
+
+def compare_data_digests(level, data_digests, first_block, num_blocks,
+                         block_size, digest_size, digest_padding, intact):
+  """Compares digests of data blocks with the lowest level of a tree.
+
+  Digests are compared all at once and, if that fails, a whole tree
+  block at a time, so only tree blocks with mismatches are compared
+  digest by digest.
+
+  Arguments:
+    level: The lowest level of the stored hash tree.
+    data_digests: The digests of the data blocks as a bytearray, laid out
+      like |level| but starting with the digest of block |first_block|.
+    first_block: Index of the first data block, must be a multiple of
+      the number of digests per tree block.
+    num_blocks: Number of data blocks to compare.
+    block_size: The block size, e.g. 4096.
+    digest_size: The size of each digest.
+    digest_padding: The padding for each digest.
+    intact: The list from check_hash_tree() telling which tree blocks of
+      |level| can be trusted.
+
+  Returns:
+    A tuple with a list of the indexes of data blocks with mismatching
+    digests and the number of data blocks which couldn't be checked.
+  """
+  level = memoryview(level)
+  entry_size = digest_size + digest_padding
+  entries_per_block = block_size // entry_size
+  start = first_block * entry_size
+  end = start + num_blocks * entry_size
+  # Comparing a bytearray with a memoryview is a lot faster than
+  # comparing two memoryviews.
+  if (all(intact[first_block // entries_per_block:
+                 -(-(first_block + num_blocks) // entries_per_block)]) and
+      data_digests[:end - start] == level[start:end]):
+    return [], 0
+
+  bad_blocks = []
+  num_unchecked = 0
+  for first in range(first_block, first_block + num_blocks,
+                     entries_per_block):
+    count = min(entries_per_block, first_block + num_blocks - first)
+    if not intact[first // entries_per_block]:
+      num_unchecked += count
+      continue
+    start = first * entry_size
+    end = start + count * entry_size
+    digests = data_digests[start - first_block * entry_size:
+                           end - first_block * entry_size]
+    if digests == level[start:end]:
+      continue
+    for block_num in range(count):
+      entry = block_num * entry_size
+      if (digests[entry:entry + digest_size] !=
+          level[start + entry:start + entry + digest_size]):
+        bad_blocks.append(first + block_num)
+  return bad_blocks, num_unchecked
+
+
+def get_ranges(numbers):
+  """Groups sorted integers into ranges of consecutive integers.
+
+  Arguments:
+    numbers: A sorted list of integers.
+
+  Returns:
+    A list of tuples with the first integer and the length of each range.
+  """
+  ranges = []
+  for number in numbers:
+    if ranges and ranges[-1][0] + ranges[-1][1] == number:
+      ranges[-1][1] += 1
+    else:
+      ranges.append([number, 1])
+  return [tuple(r) for r in ranges]
+
+
+class HashtreeVerifyOptions(object):
+  """Options for verifying hashtree descriptors.
+
+  They're passed to the verify() method of all descriptors but only
+  used by AvbHashtreeDescriptor.
+
+  Attributes:
+    jobs: Number of threads to hash data blocks with or 0 to use one
+      thread per CPU.
+    check_fec: If True, also check that FEC data matches the image.
+    fail_fast: If True, stop verifying a hashtree at the first corrupted
+      block.
+    bad_block_report: If not None, a list a dict with the corrupted
+      blocks of each verified hashtree is appended to.
+    sample: If not None, a BlockSample telling which data blocks of a
+      hashtree to check.
+  """
+
+  def __init__(self, jobs=1, check_fec=False, fail_fast=False,
+               bad_block_report=None, sample=None):
+    """Initializes the options, see the class attributes."""
+    self.jobs = jobs
+    self.check_fec = check_fec
+    self.fail_fast = fail_fast
+    self.bad_block_report = bad_block_report
+    self.sample = sample
+
+
+class BlockSample(object):
+  """A seeded random sample of the data blocks of an image.
+
+  Attributes:
+    size: Number of data blocks to sample or None.
+    fraction: Fraction of the data blocks to sample if |size| is None.
+    seed: The seed the blocks are picked with.
+  """
+
+  def __init__(self, size=None, fraction=None, seed=None):
+    """Initializes a sample.
+
+    Arguments:
+      size: Number of data blocks to sample or None.
+      fraction: Fraction of the data blocks to sample if |size| is None,
+        between 0 and 1.
+      seed: The seed to pick blocks with or None to pick a random one.
+
+    Raises:
+      AvbError: If the size or fraction is out of range.
+    """
+    if size is not None and size < 1:
+      raise AvbError('Sample size must be at least 1.')
+    if size is None and not 0 < fraction <= 1:
+      raise AvbError('Sample fraction must be larger than 0 and at most 1.')
+    if seed is None:
+      seed = int.from_bytes(os.urandom(4), 'big')
+    self.size = size
+    self.fraction = fraction
+    self.seed = seed
+
+  def pick(self, num_blocks):
+    """Picks the blocks to check.
+
+    The same seed always picks the same blocks out of |num_blocks|.
+
+    Arguments:
+      num_blocks: The number of data blocks of the image.
+
+    Returns:
+      A sorted list of the indexes of the picked blocks.
+    """
+    if self.size is not None:
+      count = min(self.size, num_blocks)
+    else:
+      count = max(1, math.ceil(num_blocks * self.fraction))
+    return sorted(random.Random(self.seed).sample(range(num_blocks), count))
+
+
+def verify_hash_tree(image, image_size, block_size, hash_alg_name, salt,
+                     digest_padding, hash_level_offsets, tree, root_digest,
+                     fail_fast=False, jobs=1, sample_blocks=None):
+  """Verifies an image against a stored hash tree.
+
+  The stored tree is checked top-down first, see check_hash_tree(). The
+  data blocks are then hashed in windows of about |HASH_JOB_SIZE| bytes
+  and each window is compared with the stored tree as soon as it's
+  hashed, so the digests of all data blocks are never held in memory.
+  With |sample_blocks| only those data blocks are read and hashed, the
+  whole tree is still checked.
+
+  Arguments:
+    image: The image, as an ImageHandler.
+    image_size: The size of the image, must be larger than |block_size|.
+    block_size: The block size, e.g. 4096.
+    hash_alg_name: The hash algorithm, e.g. 'sha256' or 'sha1'.
+    salt: The salt to use.
+    digest_padding: The padding for each digest.
+    hash_level_offsets: The offsets from calc_hash_level_offsets().
+    tree: The stored hash tree.
+    root_digest: The trusted top-level hash or None to trust the top
+      level of the tree.
+    fail_fast: If True, stop at the first corrupted block.
+    jobs: Number of threads to hash data blocks with or 0 to use one per
+      CPU.
+    sample_blocks: None to check all data blocks or a sorted list of the
+      indexes of the data blocks to check.
+
+  Returns:
+    A tuple with a list of the indexes of corrupted data blocks, a list
+    of the offsets of corrupted blocks in the tree, the number of blocks
+    which couldn't be checked and whether all blocks were looked at,
+    which is only False if |fail_fast| stopped verification early.
+  """
   hasher = create_avb_hashtree_hasher(hash_alg_name, salt)
-  hasher.update(level_output)
-  return hasher.digest(), bytes(hash_ret)
+  entry_size = hasher.digest_size + digest_padding
+  intact, bad_tree_blocks, num_unchecked = check_hash_tree(
+      tree, image_size, block_size, hasher, digest_padding,
+      hash_level_offsets, root_digest)
+  if fail_fast and bad_tree_blocks:
+    return [], bad_tree_blocks, num_unchecked, False
+
+  level = memoryview(tree)[hash_level_offsets[0]:]
+  entries_per_block = block_size // entry_size
+  num_data_blocks = (image_size + block_size - 1) // block_size
+  if sample_blocks is not None:
+    return verify_sample_blocks(image, image_size, block_size, hasher,
+                                digest_padding, level, intact, sample_blocks,
+                                bad_tree_blocks, num_unchecked, fail_fast)
+  window_blocks = round_to_multiple(
+      max(HASH_JOB_SIZE // block_size, 1), entries_per_block)
+
+  def hash_window(first_block):
+    offset = first_block * block_size
+    size = min(window_blocks * block_size, image_size - offset)
+    digests = bytearray((size + block_size - 1) // block_size * entry_size)
+    hash_image_range(image, offset, size, block_size, hasher, digest_padding,
+                     memoryview(digests))
+    return digests
+
+  # Windows below corrupted tree blocks can't be checked, so they aren't
+  # hashed at all.
+  windows = []
+  for first_block in range(0, num_data_blocks, window_blocks):
+    count = min(window_blocks, num_data_blocks - first_block)
+    tree_blocks = intact[first_block // entries_per_block:
+                         -(-(first_block + count) // entries_per_block)]
+    if any(tree_blocks):
+      windows.append((first_block, count))
+    else:
+      num_unchecked += count
+
+  bad_data_blocks = []
+  if jobs == 0:
+    jobs = os.cpu_count() or 1
+  with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+    # Only a few windows are hashed ahead to bound memory usage.
+    pending = collections.deque()
+    next_window = 0
+    for first_block, count in windows:
+      while next_window < len(windows) and len(pending) < 2 * jobs:
+        pending.append(executor.submit(hash_window, windows[next_window][0]))
+        next_window += 1
+      bad_blocks, num_unchecked_data = compare_data_digests(
+          level, pending.popleft().result(), first_block, count, block_size,
+          hasher.digest_size, digest_padding, intact)
+      bad_data_blocks.extend(bad_blocks)
+      num_unchecked += num_unchecked_data
+      if fail_fast and bad_blocks:
+        for future in pending:
+          future.cancel()
+        return bad_data_blocks, bad_tree_blocks, num_unchecked, False
+  return bad_data_blocks, bad_tree_blocks, num_unchecked, True
+
+
+def verify_sample_blocks(image, image_size, block_size, hasher,
+                         digest_padding, level, intact, sample_blocks,
+                         bad_tree_blocks, num_unchecked, fail_fast):
+  """Checks some data blocks against the lowest level of a hash tree.
+
+  This finishes verify_hash_tree() for a sample of the data blocks.
+
+  Arguments:
+    image: The image, as an ImageHandler.
+    image_size: The size of the image.
+    block_size: The block size, e.g. 4096.
+    hasher: A hasher already updated with the salt.
+    digest_padding: The padding for each digest.
+    level: The lowest level of the stored hash tree.
+    intact: The list from check_hash_tree().
+    sample_blocks: A sorted list of the indexes of the data blocks to
+      check.
+    bad_tree_blocks: The offsets of corrupted blocks in the tree.
+    num_unchecked: Number of blocks which couldn't be checked so far.
+    fail_fast: If True, stop at the first corrupted block.
+
+  Returns:
+    The same tuple as verify_hash_tree().
+  """
+  digest_size = hasher.digest_size
+  entry_size = digest_size + digest_padding
+  entries_per_block = block_size // entry_size
+  bad_data_blocks = []
+  for block_num in sample_blocks:
+    if not intact[block_num // entries_per_block]:
+      num_unchecked += 1
+      continue
+    offset = block_num * block_size
+    image.seek(offset)
+    data = image.read_view(min(block_size, image_size - offset))
+    block_hasher = hasher.copy()
+    block_hasher.update(data)
+    if len(data) < block_size:
+      block_hasher.update(b'\0' * (block_size - len(data)))
+    entry = block_num * entry_size
+    if block_hasher.digest() != level[entry:entry + digest_size]:
+      bad_data_blocks.append(block_num)
+      if fail_fast:
+        return bad_data_blocks, bad_tree_blocks, num_unchecked, False
+  return bad_data_blocks, bad_tree_blocks, num_unchecked, True
+
+
+def find_corrupt_hashtree_blocks(tree, data_digests, image_size, block_size,
+                                 hasher, digest_padding, hash_level_offsets,
+                                 root_digest):
+  """Uses a hash tree to locate corrupted blocks.
+
+  The tree is checked top-down starting with |root_digest|, so blocks
+  of the tree itself can be corrupted as well. Blocks below a corrupted
+  block of the tree can't be checked until it's repaired.
+
+  Arguments:
+    tree: The stored hash tree.
+    data_digests: The digests of the data blocks as they are now, laid
+      out like the lowest level of the tree.
+    image_size: The size of the image.
+    block_size: The block size, e.g. 4096.
+    hasher: A hasher already updated with the salt. It is copied for
+      each block and not modified itself.
+    digest_padding: The padding for each digest.
+    hash_level_offsets: The offsets from calc_hash_level_offsets().
+    root_digest: The trusted top-level hash.
+
+  Returns:
+    A tuple with a list of the indexes of corrupted data blocks, a list
+    of the offsets of corrupted blocks in the tree and the number of
+    blocks which couldn't be checked.
+  """
+  digest_size = hasher.digest_size
+  if image_size <= block_size:
+    if data_digests[:digest_size] != root_digest:
+      return [0], [], 0
+    return [], [], 0
+
+  intact, bad_tree_blocks, num_unchecked = check_hash_tree(
+      tree, image_size, block_size, hasher, digest_padding,
+      hash_level_offsets, root_digest)
+  num_data_blocks = (image_size + block_size - 1) // block_size
+  bad_data_blocks, num_unchecked_data = compare_data_digests(
+      memoryview(tree)[hash_level_offsets[0]:], data_digests, 0,
+      num_data_blocks, block_size, digest_size, digest_padding, intact)
+  return bad_data_blocks, bad_tree_blocks, num_unchecked + num_unchecked_data
+
+
+# Number of verified hash tree blocks VerifiedImageReader keeps by default.
+VERIFIED_TREE_CACHE_BLOCKS = 1024
+
+
+class VerifiedImageReader(object):
+  """Reads data from an image, verifying it against its hash tree on demand.
+
+  Nothing is verified up front. Every data block is checked against its
+  digest in the lowest level of the stored hash tree when it's read and
+  every block of the tree on its path up to the root digest is checked
+  the first time it's needed, like dm-verity does. Verified blocks of
+  the tree are kept in an LRU cache so a random read only hashes the data
+  block and the blocks of its path which aren't cached, at most one per
+  level.
+
+  Data blocks are hashed again every time they are read, except for the
+  last one, since they are read from the image again as well.
+
+  Attributes:
+    image_size: Size of the verified data.
+    block_size: The data block size.
+    tree_cache_size: Maximum number of verified tree blocks kept.
+    num_hashed_blocks: Number of data and tree blocks hashed so far.
+  """
+
+  def __init__(self, image, ht_desc, root_digest=None,
+               tree_cache_size=VERIFIED_TREE_CACHE_BLOCKS):
+    """Loads the hash tree of an image.
+
+    Arguments:
+      image: The image containing the data and the hash tree, as an
+        ImageHandler.
+      ht_desc: The AvbHashtreeDescriptor of the data.
+      root_digest: The trusted top-level hash or None to use the one in
+        |ht_desc|.
+      tree_cache_size: Maximum number of verified tree blocks kept.
+
+    Raises:
+      AvbError: If there's no root digest or no usable hash tree.
+    """
+    self._image = image
+    self.image_size = ht_desc.image_size
+    self.block_size = ht_desc.data_block_size
+    self.tree_cache_size = tree_cache_size
+    self.num_hashed_blocks = 0
+    self._root_digest = root_digest or ht_desc.root_digest
+    if not self._root_digest:
+      raise AvbError('Hashtree descriptor has no root digest.')
+    self._hasher = create_avb_hashtree_hasher(ht_desc.hash_algorithm,
+                                              ht_desc.salt)
+    self._digest_size = self._hasher.digest_size
+    self._entry_size = round_to_pow2(self._digest_size)
+    (self._hash_level_offsets, tree_size) = calc_hash_level_offsets(
+        self.image_size, self.block_size, self._entry_size)
+    image.seek(ht_desc.tree_offset)
+    self._tree = image.read_view(ht_desc.tree_size)
+    if self._tree[0:8] == b'ZeRoHaSH':
+      raise AvbError('Hashtree of {} is zeroed.'.format(image.filename))
+    if len(self._tree) != tree_size:
+      raise AvbError('Hashtree of {} has {} bytes, expected {}.'
+                     .format(image.filename, len(self._tree), tree_size))
+    self._tree_cache = collections.OrderedDict()
+    self._last_block = (None, None)
+    self._file_pos = 0
+
+  def _hash_block(self, data):
+    block_hasher = self._hasher.copy()
+    block_hasher.update(data)
+    self.num_hashed_blocks += 1
+    return block_hasher.digest()
+
+  def _get_tree_block(self, level_num, block_num):
+    """Returns a verified block of the hash tree.
+
+    Arguments:
+      level_num: The level of the block, 0 being the lowest.
+      block_num: Index of the block in its level.
+
+    Returns:
+      The block as bytes.
+
+    Raises:
+      AvbError: If the block or one above it doesn't match.
+    """
+    key = (level_num, block_num)
+    data = self._tree_cache.get(key)
+    if data is not None:
+      self._tree_cache.move_to_end(key)
+      return data
+
+    offset = self._hash_level_offsets[level_num] + block_num * self.block_size
+    # The block is copied so it can't change after it's been verified.
+    data = bytes(self._tree[offset:offset + self.block_size])
+    if level_num == len(self._hash_level_offsets) - 1:
+      expected_digest = self._root_digest
+    else:
+      entry = block_num * self._entry_size
+      parent = self._get_tree_block(level_num + 1, entry // self.block_size)
+      entry %= self.block_size
+      expected_digest = parent[entry:entry + self._digest_size]
+    if self._hash_block(data) != expected_digest:
+      raise AvbError('Hashtree block at offset {} of {} is corrupted.'
+                     .format(offset, self._image.filename))
+
+    self._tree_cache[key] = data
+    if len(self._tree_cache) > self.tree_cache_size:
+      self._tree_cache.popitem(last=False)
+    return data
+
+  def _check_block(self, block_num, data):
+    """Checks a data block against the hash tree.
+
+    Arguments:
+      block_num: Index of the data block.
+      data: The data of the block, padded with zeroes if it's short.
+
+    Raises:
+      AvbError: If the block doesn't match.
+    """
+    if not self._hash_level_offsets:
+      expected_digest = self._root_digest
+    else:
+      entry = block_num * self._entry_size
+      level = self._get_tree_block(0, entry // self.block_size)
+      entry %= self.block_size
+      expected_digest = level[entry:entry + self._digest_size]
+    if self._hash_block(data) != expected_digest:
+      raise AvbError('Data block {} of {} does not match the hashtree.'
+                     .format(block_num, self._image.filename))
+
+  def read_block(self, block_num):
+    """Reads and verifies a single data block.
+
+    Arguments:
+      block_num: Index of the data block.
+
+    Returns:
+      The data of the block as bytes, padded with zeroes if it's the
+      short last block.
+
+    Raises:
+      AvbError: If the block or the hash tree is corrupted.
+    """
+    if self._last_block[0] == block_num:
+      return self._last_block[1]
+    if not 0 <= block_num * self.block_size < self.image_size:
+      raise AvbError('Block {} is outside of the verified data.'
+                     .format(block_num))
+    data = bytearray(self.block_size)
+    self._image.seek(block_num * self.block_size)
+    self._image.readinto(memoryview(data)[
+        :min(self.block_size, self.image_size - block_num * self.block_size)])
+    data = bytes(data)
+    self._check_block(block_num, data)
+    self._last_block = (block_num, data)
+    return data
+
+  def seek(self, offset):
+    """Sets the cursor position for reading verified data.
+
+    Arguments:
+      offset: Offset to seek to from the beginning of the data.
+
+    Raises:
+      RuntimeError: If the given offset is negative.
+    """
+    if offset < 0:
+      raise RuntimeError('Seeking with negative offset: {}'.format(offset))
+    self._file_pos = offset
+
+  def tell(self):
+    """Returns the cursor position for reading verified data."""
+    return self._file_pos
+
+  def read(self, size):
+    """Reads and verifies data.
+
+    All blocks overlapping the requested range are verified. Fewer than
+    |size| bytes are returned if the end of the data is reached. The
+    cursor is advanced by the number of bytes read.
+
+    Arguments:
+      size: Number of bytes to read.
+
+    Returns:
+      The data as bytes.
+
+    Raises:
+      AvbError: If any of the blocks or the hash tree is corrupted.
+    """
+    block_size = self.block_size
+    start = self._file_pos
+    end = min(start + size, self.image_size)
+    if start >= end:
+      return b''
+    first_block = start // block_size
+    last_block = (end - 1) // block_size
+    if first_block == last_block:
+      data = self.read_block(first_block)
+    else:
+      data = bytearray((last_block - first_block + 1) * block_size)
+      self._image.seek(first_block * block_size)
+      self._image.readinto(memoryview(data)[
+          :min(len(data), self.image_size - first_block * block_size)])
+      for block_num in range(first_block, last_block + 1):
+        offset = (block_num - first_block) * block_size
+        self._check_block(block_num,
+                          memoryview(data)[offset:offset + block_size])
+    self._file_pos = end
+    offset = start - first_block * block_size
+    return bytes(data[offset:offset + end - start])
 
 
 class AvbTool(object):
@@ -4187,16 +7835,25 @@ class AvbTool(object):
                             help='Path to RSA private key file',
                             metavar='KEY',
                             required=False)
-    sub_parser.add_argument('--signing_helper',
-                            help='Path to helper used for signing',
-                            metavar='APP',
-                            default=None,
-                            required=False)
-    sub_parser.add_argument('--signing_helper_with_files',
-                            help='Path to helper used for signing using files',
-                            metavar='APP',
-                            default=None,
-                            required=False)
+    signing_helper_group = sub_parser.add_mutually_exclusive_group()
+    signing_helper_group.add_argument('--signing_helper',
+                                      help='Path to helper used for signing',
+                                      metavar='APP',
+                                      default=None,
+                                      required=False)
+    signing_helper_group.add_argument('--signing_helper_with_files',
+                                      help=('Path to helper used for signing '
+                                            'using files'),
+                                      metavar='APP',
+                                      default=None,
+                                      required=False)
+    signing_helper_group.add_argument('--signing_helper_persistent',
+                                      help=('Path to helper started once and '
+                                            'used for all signing requests '
+                                            'over stdin/stdout'),
+                                      metavar='APP',
+                                      default=None,
+                                      required=False)
     sub_parser.add_argument('--public_key_metadata',
                             help='Path to public key metadata file',
                             metavar='KEY_METADATA',
@@ -4461,6 +8118,35 @@ class AvbTool(object):
     sub_parser.add_argument('--check_at_most_once',
                             action='store_true',
                             help='Set to verify data block only once')
+    sub_parser.add_argument('--jobs',
+                            help=('Number of threads to hash data blocks and '
+                                  'processes to generate FEC with, 0 for one '
+                                  'per CPU (default: 1)'),
+                            type=parse_number,
+                            default=1)
+    sub_parser.add_argument('--previous_image',
+                            help=('Update the hashtree and FEC data of IMAGE '
+                                  'instead of generating them, IMAGE must '
+                                  'only differ in some data blocks'),
+                            metavar='IMAGE',
+                            type=argparse.FileType('rb'))
+    sub_parser.add_argument('--checkpoint',
+                            help=('Save the progress of generating the '
+                                  'hashtree and FEC data to FILE'),
+                            metavar='FILE')
+    sub_parser.add_argument('--resume',
+                            help=('Continue from the progress saved with '
+                                  '--checkpoint, if it matches the image and '
+                                  'options'),
+                            action='store_true')
+    sub_parser.add_argument('--changed_blocks',
+                            help=('Update the hashtree and FEC data for '
+                                  'these changed data blocks, e.g. "3,10-20", '
+                                  'instead of generating them. Without '
+                                  '--previous_image the footer of the image '
+                                  'itself is updated'),
+                            metavar='BLOCKS',
+                            type=parse_block_ranges)
     self._add_common_args(sub_parser)
     self._add_common_footer_args(sub_parser)
     sub_parser.set_defaults(func=self.add_hashtree_footer)
@@ -4484,6 +8170,20 @@ class AvbTool(object):
                             required=True)
     sub_parser.set_defaults(func=self.zero_hashtree)
 
+    sub_parser = subparsers.add_parser(
+        'repair_image',
+        help='Repair corrupted blocks of an image using FEC data.')
+    sub_parser.add_argument('--image',
+                            help='Image with a footer',
+                            type=argparse.FileType('rb+'),
+                            required=True)
+    sub_parser.add_argument('--jobs',
+                            help=('Number of threads to hash data blocks '
+                                  'with, 0 for one per CPU (default: 1)'),
+                            type=parse_number,
+                            default=1)
+    sub_parser.set_defaults(func=self.repair_image)
+
     sub_parser = subparsers.add_parser(
         'extract_vbmeta_image',
         help='Extracts vbmeta from an image with a footer.')
@@ -4555,6 +8255,38 @@ class AvbTool(object):
         '--accept_zeroed_hashtree',
         help=('Accept images where the hashtree or FEC data is zeroed out'),
         action='store_true')
+    sub_parser.add_argument(
+        '--check_fec',
+        help=('Also check that FEC data matches the image'),
+        action='store_true')
+    sub_parser.add_argument(
+        '--fail_fast',
+        help=('Stop verifying a hashtree at the first corrupted block'),
+        action='store_true')
+    sub_parser.add_argument('--bad_block_report',
+                            help=('Write corrupted blocks of hashtrees to '
+                                  'file as JSON'),
+                            type=argparse.FileType('wt'))
+    sample_group = sub_parser.add_mutually_exclusive_group()
+    sample_group.add_argument('--sample',
+                              help=('Only check NUMBER randomly picked data '
+                                    'blocks of each hashtree'),
+                              metavar='NUMBER',
+                              type=parse_number)
+    sample_group.add_argument('--sample_fraction',
+                              help=('Only check FRACTION of the data blocks '
+                                    'of each hashtree, picked randomly'),
+                              metavar='FRACTION',
+                              type=float)
+    sub_parser.add_argument('--sample_seed',
+                            help=('Seed to pick sampled data blocks with '
+                                  '(default: random)'),
+                            type=parse_number)
+    sub_parser.add_argument('--jobs',
+                            help=('Number of threads to hash data blocks '
+                                  'with, 0 for one per CPU (default: 1)'),
+                            type=parse_number,
+                            default=1)
     sub_parser.set_defaults(func=self.verify_image)
 
     sub_parser = subparsers.add_parser(
@@ -4651,16 +8383,25 @@ class AvbTool(object):
     sub_parser.add_argument('--authority_key',
                             help='Path to authority RSA private key file',
                             required=False)
-    sub_parser.add_argument('--signing_helper',
-                            help='Path to helper used for signing',
-                            metavar='APP',
-                            default=None,
-                            required=False)
-    sub_parser.add_argument('--signing_helper_with_files',
-                            help='Path to helper used for signing using files',
-                            metavar='APP',
-                            default=None,
-                            required=False)
+    signing_helper_group = sub_parser.add_mutually_exclusive_group()
+    signing_helper_group.add_argument('--signing_helper',
+                                      help='Path to helper used for signing',
+                                      metavar='APP',
+                                      default=None,
+                                      required=False)
+    signing_helper_group.add_argument('--signing_helper_with_files',
+                                      help=('Path to helper used for signing '
+                                            'using files'),
+                                      metavar='APP',
+                                      default=None,
+                                      required=False)
+    signing_helper_group.add_argument('--signing_helper_persistent',
+                                      help=('Path to helper started once and '
+                                            'used for all signing requests '
+                                            'over stdin/stdout'),
+                                      metavar='APP',
+                                      default=None,
+                                      required=False)
     sub_parser.set_defaults(func=self.make_atx_certificate)
 
     sub_parser = subparsers.add_parser(
@@ -4722,16 +8463,25 @@ class AvbTool(object):
                             help='Path to unlock key (optional). Must be '
                                  'provided if using --challenge.',
                             required=False)
-    sub_parser.add_argument('--signing_helper',
-                            help='Path to helper used for signing',
-                            metavar='APP',
-                            default=None,
-                            required=False)
-    sub_parser.add_argument('--signing_helper_with_files',
-                            help='Path to helper used for signing using files',
-                            metavar='APP',
-                            default=None,
-                            required=False)
+    signing_helper_group = sub_parser.add_mutually_exclusive_group()
+    signing_helper_group.add_argument('--signing_helper',
+                                      help='Path to helper used for signing',
+                                      metavar='APP',
+                                      default=None,
+                                      required=False)
+    signing_helper_group.add_argument('--signing_helper_with_files',
+                                      help=('Path to helper used for signing '
+                                            'using files'),
+                                      metavar='APP',
+                                      default=None,
+                                      required=False)
+    signing_helper_group.add_argument('--signing_helper_persistent',
+                                      help=('Path to helper started once and '
+                                            'used for all signing requests '
+                                            'over stdin/stdout'),
+                                      metavar='APP',
+                                      default=None,
+                                      required=False)
     sub_parser.set_defaults(func=self.make_atx_unlock_credential)
 
     args = parser.parse_args(argv[1:])
@@ -4775,7 +8525,8 @@ class AvbTool(object):
                                args.internal_release_string,
                                args.append_to_release_string,
                                args.print_required_libavb_version,
-                               args.padding_size)
+                               args.padding_size,
+                               args.signing_helper_persistent)
 
   def append_vbmeta_image(self, args):
     """Implements the 'append_vbmeta_image' sub-command."""
@@ -4805,7 +8556,8 @@ class AvbTool(object):
                              args.do_not_append_vbmeta_image,
                              args.print_required_libavb_version,
                              args.use_persistent_digest,
-                             args.do_not_use_ab)
+                             args.do_not_use_ab,
+                             args.signing_helper_persistent)
 
   def add_hashtree_footer(self, args):
     """Implements the 'add_hashtree_footer' sub-command."""
@@ -4842,7 +8594,13 @@ class AvbTool(object):
         args.use_persistent_digest,
         args.do_not_use_ab,
         args.no_hashtree,
-        args.check_at_most_once)
+        args.check_at_most_once,
+        args.jobs,
+        args.previous_image.name if args.previous_image else None,
+        args.changed_blocks,
+        args.checkpoint,
+        args.resume,
+        args.signing_helper_persistent)
 
   def erase_footer(self, args):
     """Implements the 'erase_footer' sub-command."""
@@ -4852,6 +8610,10 @@ class AvbTool(object):
     """Implements the 'zero_hashtree' sub-command."""
     self.avb.zero_hashtree(args.image.name)
 
+  def repair_image(self, args):
+    """Implements the 'repair_image' sub-command."""
+    self.avb.repair_image(args.image.name, args.jobs)
+
   def extract_vbmeta_image(self, args):
     """Implements the 'extract_vbmeta_image' sub-command."""
     self.avb.extract_vbmeta_image(args.output, args.image.name,
@@ -4874,7 +8636,10 @@ class AvbTool(object):
     self.avb.verify_image(args.image.name, args.key,
                           args.expected_chain_partition,
                           args.follow_chain_partitions,
-                          args.accept_zeroed_hashtree)
+                          args.accept_zeroed_hashtree,
+                          args.jobs, args.check_fec, args.fail_fast,
+                          args.bad_block_report, args.sample,
+                          args.sample_fraction, args.sample_seed)
 
   def print_partition_digests(self, args):
     """Implements the 'print_partition_digests' sub-command."""
@@ -4899,7 +8664,8 @@ class AvbTool(object):
                                   args.subject_is_intermediate_authority,
                                   args.usage,
                                   args.signing_helper,
-                                  args.signing_helper_with_files)
+                                  args.signing_helper_with_files,
+                                  args.signing_helper_persistent)
 
   def make_atx_permanent_attributes(self, args):
     """Implements the 'make_atx_permanent_attributes' sub-command."""
@@ -4922,7 +8688,8 @@ class AvbTool(object):
         args.challenge,
         args.unlock_key,
         args.signing_helper,
-        args.signing_helper_with_files)
+        args.signing_helper_with_files,
+        args.signing_helper_persistent)
 
 
 if __name__ == '__main__':
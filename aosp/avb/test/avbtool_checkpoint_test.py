@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+# Copyright 2026, The Android Open Source Project
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Tests resuming add_hashtree_footer from a checkpoint."""
+
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from avbtool_test_util import generate_test_data
+from avbtool_test_util import load_avbtool
+from avbtool_test_util import read_file
+from avbtool_test_util import write_file
+
+# Exit status of a run killed after some checkpoint saves.
+KILLED = 77
+
+# The image ends with a partial block, so it's padded before the first
+# checkpoint is saved.
+IMAGE_SIZE = 3 * 1024 * 1024 + 5000
+
+SALT = '00112233445566778899aabbccddeeff'
+
+# Small ranges and windows, so the image is hashed in 13 ranges and FEC
+# data is encoded in 4 windows, with a checkpoint saved after each.
+HASH_JOB_SIZE = 256 * 1024
+FEC_WINDOW_SIZE = 4096
+
+
+class CheckpointTest(unittest.TestCase):
+  """Tests that runs resumed from a checkpoint give the same image."""
+
+  def setUp(self):
+    self.avbtool = load_avbtool()
+    self.saved_globals = {name: getattr(self.avbtool, name)
+                          for name in ('CHECKPOINT_INTERVAL', 'HASH_JOB_SIZE',
+                                       'FEC_WINDOW_SIZE')}
+    self.avbtool.CHECKPOINT_INTERVAL = 0
+    self.avbtool.HASH_JOB_SIZE = HASH_JOB_SIZE
+    self.avbtool.FEC_WINDOW_SIZE = FEC_WINDOW_SIZE
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.base = write_file(self._path('base.img'),
+                           generate_test_data(IMAGE_SIZE, 'checkpoint'))
+    self.checkpoint = self._path('hashtree.ckpt')
+
+  def tearDown(self):
+    for name, value in self.saved_globals.items():
+      setattr(self.avbtool, name, value)
+    self.temp_dir.cleanup()
+
+  def _path(self, name):
+    return os.path.join(self.temp_dir.name, name)
+
+  def _args(self, image, *args):
+    return ['avbtool', 'add_hashtree_footer', '--image', image,
+            '--partition_name', 'system',
+            '--partition_size', str(16 * 1024 * 1024)] + list(args)
+
+  def _run(self, image, *args):
+    """Runs add_hashtree_footer and returns what it printed."""
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+      self.avbtool.AvbTool().run(self._args(image, *args))
+    return output.getvalue()
+
+  def _run_killed(self, num_saves, image, *args):
+    """Runs add_hashtree_footer, killing it after |num_saves| saves.
+
+    Returns:
+      The exit status of the run, KILLED if it was killed.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+      status = 0
+      try:
+        save = self.avbtool.HashtreeCheckpoint.save
+        saves = [0]
+
+        def save_and_die(checkpoint, force=False):
+          save(checkpoint, force)
+          saves[0] += 1
+          if saves[0] == num_saves:
+            os._exit(KILLED)  # pylint: disable=protected-access
+
+        self.avbtool.HashtreeCheckpoint.save = save_and_die
+        with contextlib.redirect_stdout(io.StringIO()):
+          self.avbtool.AvbTool().run(self._args(image, *args))
+      except BaseException:  # pylint: disable=broad-except
+        status = 1
+      os._exit(status)  # pylint: disable=protected-access
+    (_, status) = os.waitpid(pid, 0)
+    return os.waitstatus_to_exitcode(status)
+
+  def _reference(self, *args):
+    """Returns the image made by a run without a checkpoint."""
+    image = self._path('reference.img')
+    shutil.copy(self.base, image)
+    self._run(image, '--salt', SALT, *args)
+    return read_file(image)
+
+  def _kill_and_resume(self, num_saves, *args):
+    """Kills a run and resumes it, returning the output of the resumed run."""
+    image = self._path('system.img')
+    shutil.copy(self.base, image)
+    self.assertEqual(self._run_killed(num_saves, image, '--checkpoint',
+                                      self.checkpoint, *args), KILLED)
+    self.assertTrue(os.path.exists(self.checkpoint))
+    return self._run(image, '--checkpoint', self.checkpoint, '--resume', *args)
+
+  def _check_resume(self, *args):
+    reference = self._reference(*args)
+    # Kill while hashing, right before FEC data is encoded and while
+    # encoding it.
+    for num_saves in (1, 7, 14, 16):
+      with self.subTest(num_saves=num_saves):
+        output = self._kill_and_resume(num_saves, '--salt', SALT, *args)
+        self.assertIn('Resuming from checkpoint', output)
+        self.assertFalse(os.path.exists(self.checkpoint))
+        self.assertEqual(read_file(self._path('system.img')), reference)
+
+  def test_resume(self):
+    self._check_resume()
+
+  def test_resume_with_jobs(self):
+    self._check_resume('--jobs', '3')
+
+  def test_resume_with_many_roots(self):
+    self._check_resume('--fec_num_roots', '24')
+
+  def test_resume_without_fec(self):
+    reference = self._reference('--do_not_generate_fec')
+    output = self._kill_and_resume(7, '--salt', SALT, '--do_not_generate_fec')
+    self.assertIn('Resuming from checkpoint', output)
+    self.assertEqual(read_file(self._path('system.img')), reference)
+
+  def test_resume_uses_salt_of_checkpoint(self):
+    image = self._path('system.img')
+    shutil.copy(self.base, image)
+    self.assertEqual(self._run_killed(5, image, '--checkpoint',
+                                      self.checkpoint), KILLED)
+    salt = self.avbtool.HashtreeCheckpoint.read_salt(self.checkpoint)
+    self.assertIsNotNone(salt)
+    output = self._run(image, '--checkpoint', self.checkpoint, '--resume')
+    self.assertIn('Resuming from checkpoint', output)
+    shutil.copy(self.base, self._path('reference.img'))
+    self._run(self._path('reference.img'), '--salt', salt)
+    self.assertEqual(read_file(image), read_file(self._path('reference.img')))
+
+  def _check_discarded(self, touch_image, *args):
+    """Checks that a checkpoint is discarded and the result is still valid.
+
+    Arguments:
+      touch_image: Function called with the path of the image after the
+        run was killed.
+      args: Arguments for the resumed run.
+    """
+    image = self._path('system.img')
+    shutil.copy(self.base, image)
+    self.assertEqual(self._run_killed(5, image, '--salt', SALT,
+                                      '--checkpoint', self.checkpoint),
+                     KILLED)
+    touch_image(image)
+    output = self._run(image, '--checkpoint', self.checkpoint, '--resume',
+                       *args)
+    self.assertNotIn('Resuming from checkpoint', output)
+    self.assertFalse(os.path.exists(self.checkpoint))
+    self.avbtool.Avb().verify_image(image, None, None, False, False,
+                                    check_fec=True)
+
+  def _no_change(self, image):
+    del image  # Unused.
+
+  def test_discard_on_modified_image(self):
+    def touch_image(image):
+      with open(image, 'r+b') as f:
+        f.write(b'changed!')
+    self._check_discarded(touch_image, '--salt', SALT)
+
+  def test_discard_on_mtime(self):
+    def touch_image(image):
+      st = os.stat(image)
+      os.utime(image, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    self._check_discarded(touch_image, '--salt', SALT)
+
+  def test_discard_on_size(self):
+    def touch_image(image):
+      with open(image, 'ab') as f:
+        f.write(b'\0' * 4096)
+    self._check_discarded(touch_image, '--salt', SALT)
+
+  def test_discard_on_salt(self):
+    self._check_discarded(self._no_change, '--salt', SALT[::-1])
+
+  def test_discard_on_roots(self):
+    self._check_discarded(self._no_change, '--salt', SALT,
+                          '--fec_num_roots', '4')
+
+  def test_discard_on_hash_algorithm(self):
+    self._check_discarded(self._no_change, '--salt', SALT,
+                          '--hash_algorithm', 'sha512')
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=2)
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+
+# Copyright 2026, The Android Open Source Project
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Tests reading images with holes and iterating over their extents."""
+
+import contextlib
+import io
+import itertools
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from avbtool_test_util import BLOCK_SIZE
+from avbtool_test_util import CHUNK_TYPE_DONT_CARE
+from avbtool_test_util import CHUNK_TYPE_FILL
+from avbtool_test_util import CHUNK_TYPE_RAW
+from avbtool_test_util import build_sparse_image
+from avbtool_test_util import generate_test_data
+from avbtool_test_util import load_avbtool
+from avbtool_test_util import read_file
+from avbtool_test_util import write_file
+
+# Regions of the holey test image as (first block, number of blocks,
+# data). Blocks not covered are holes, including the last three which
+# are only added by extending the file.
+HOLEY_REGIONS = [(0, 2, 'random'), (6, 1, 'zero'), (7, 1, 'random'),
+                 (16, 1, 'random')]
+HOLEY_NUM_BLOCKS = 20
+
+PARTITION_SIZE = 1024 * 1024
+
+SALT = '00112233445566778899aabbccddeeff'
+
+
+def write_holey_image(path):
+  """Writes the holey test image.
+
+  Holes are made by seeking past the end of the file, so this is used
+  instead of copying the file which might fill them in.
+
+  Returns:
+    The data of the image as bytes.
+  """
+  data = bytearray(HOLEY_NUM_BLOCKS * BLOCK_SIZE)
+  with open(path, 'wb') as f:
+    for (block, num_blocks, kind) in HOLEY_REGIONS:
+      if kind == 'random':
+        region = generate_test_data(num_blocks * BLOCK_SIZE,
+                                    'holey-{}'.format(block))
+      else:
+        region = bytes(num_blocks * BLOCK_SIZE)
+      f.seek(block * BLOCK_SIZE)
+      f.write(region)
+      data[block * BLOCK_SIZE:(block + num_blocks) * BLOCK_SIZE] = region
+    f.truncate(len(data))
+  return bytes(data)
+
+
+def merge_extents(extents):
+  """Merges adjacent RAW and ZERO extents returned by iter_extents().
+
+  Returns:
+    A list of (type, offset, size) tuples and the data of all extents
+    expanded, as bytes.
+  """
+  avbtool = load_avbtool()
+  merged = []
+  data = bytearray()
+  for (extent_type, offset, size, extent_data) in extents:
+    if extent_type == avbtool.ImageHandler.EXTENT_RAW:
+      data += extent_data
+    elif extent_type == avbtool.ImageHandler.EXTENT_FILL:
+      data += (extent_data * (size // 4 + 1))[:size]
+    else:
+      data += bytes(size)
+    if (merged and extent_type != avbtool.ImageHandler.EXTENT_FILL and
+        merged[-1][0] == extent_type and
+        merged[-1][1] + merged[-1][2] == offset):
+      merged[-1] = (extent_type, merged[-1][1], merged[-1][2] + size)
+    else:
+      merged.append((extent_type, offset, size))
+  return merged, bytes(data)
+
+
+class ExtentsTest(unittest.TestCase):
+  """Tests that holes and sparse chunks are reported and read correctly."""
+
+  def setUp(self):
+    self.avbtool = load_avbtool()
+    self.saved_globals = {name: getattr(self.avbtool, name)
+                          for name in ('AVB_IMAGE_MMAP',
+                                       'AVB_IMAGE_SEEK_HOLES')}
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.holey_path = self._path('system.img')
+    self.holey_data = write_holey_image(self.holey_path)
+
+  def tearDown(self):
+    for name, value in self.saved_globals.items():
+      setattr(self.avbtool, name, value)
+    self.temp_dir.cleanup()
+
+  def _path(self, name):
+    return os.path.join(self.temp_dir.name, name)
+
+  def _skip_without_holes(self):
+    fd = os.open(self.holey_path, os.O_RDONLY)
+    try:
+      if (not hasattr(os, 'SEEK_HOLE') or
+          os.lseek(fd, 0, os.SEEK_HOLE) == len(self.holey_data)):
+        self.skipTest('File system does not report holes')
+    finally:
+      os.close(fd)
+
+  def _holey_extents(self):
+    """Returns the merged extents of the holey image with holes found."""
+    raw = self.avbtool.ImageHandler.EXTENT_RAW
+    zero = self.avbtool.ImageHandler.EXTENT_ZERO
+    return [(raw, 0, 2 * BLOCK_SIZE),
+            (zero, 2 * BLOCK_SIZE, 4 * BLOCK_SIZE),
+            (raw, 6 * BLOCK_SIZE, 2 * BLOCK_SIZE),
+            (zero, 8 * BLOCK_SIZE, 8 * BLOCK_SIZE),
+            (raw, 16 * BLOCK_SIZE, BLOCK_SIZE),
+            (zero, 17 * BLOCK_SIZE, 3 * BLOCK_SIZE)]
+
+  def test_holey_extents(self):
+    self._skip_without_holes()
+    raw = self.avbtool.ImageHandler.EXTENT_RAW
+    for use_mmap in (False, True):
+      with self.subTest(use_mmap=use_mmap):
+        image = self.avbtool.ImageHandler(self.holey_path, read_only=True,
+                                          use_mmap=use_mmap, seek_holes=True)
+        (extents, data) = merge_extents(
+            image.iter_extents(0, image.image_size + 100))
+        self.assertEqual(extents, self._holey_extents())
+        self.assertEqual(data, self.holey_data)
+        # Only the blocks with data are read.
+        self.assertEqual(image.bytes_read, 5 * BLOCK_SIZE)
+
+        # A range starting and ending in holes and split into small raw
+        # extents.
+        (extents, data) = merge_extents(
+            image.iter_extents(3 * BLOCK_SIZE + 5, 14 * BLOCK_SIZE,
+                               max_raw_size=1000))
+        self.assertEqual(extents, [
+            (self.avbtool.ImageHandler.EXTENT_ZERO, 3 * BLOCK_SIZE + 5,
+             3 * BLOCK_SIZE - 5),
+            (raw, 6 * BLOCK_SIZE, 2 * BLOCK_SIZE),
+            (self.avbtool.ImageHandler.EXTENT_ZERO, 8 * BLOCK_SIZE,
+             8 * BLOCK_SIZE),
+            (raw, 16 * BLOCK_SIZE, BLOCK_SIZE),
+            (self.avbtool.ImageHandler.EXTENT_ZERO, 17 * BLOCK_SIZE, 5)])
+        self.assertEqual(data, self.holey_data[3 * BLOCK_SIZE + 5:
+                                               17 * BLOCK_SIZE + 5])
+
+        # Without looking for holes everything is raw data.
+        image = self.avbtool.ImageHandler(self.holey_path, read_only=True,
+                                          use_mmap=use_mmap, seek_holes=False)
+        (extents, data) = merge_extents(image.iter_extents(
+            0, image.image_size))
+        self.assertEqual(extents, [(raw, 0, len(self.holey_data))])
+        self.assertEqual(data, self.holey_data)
+
+  def test_holey_reads(self):
+    for (use_mmap, seek_holes) in itertools.product((False, True),
+                                                    (False, True)):
+      with self.subTest(use_mmap=use_mmap, seek_holes=seek_holes):
+        image = self.avbtool.ImageHandler(self.holey_path, read_only=True,
+                                          use_mmap=use_mmap,
+                                          seek_holes=seek_holes)
+        # Reads crossing the boundaries between holes and data.
+        for (offset, size) in ((0, len(self.holey_data)),
+                               (BLOCK_SIZE + 7, 3 * BLOCK_SIZE),
+                               (5 * BLOCK_SIZE - 1, BLOCK_SIZE + 2),
+                               (16 * BLOCK_SIZE + 10, 10 * BLOCK_SIZE)):
+          expected = self.holey_data[offset:offset + size]
+          image.seek(offset)
+          self.assertEqual(image.read(size), expected)
+          buf = bytearray(size)
+          image.seek(offset)
+          self.assertEqual(image.readinto(buf), len(expected))
+          self.assertEqual(bytes(buf[:len(expected)]), expected)
+          self.assertEqual(image.tell(), offset + len(expected))
+          image.seek(offset)
+          self.assertEqual(bytes(image.read_view(size)), expected)
+
+  def test_sparse_extents(self):
+    (sparse_data, unsparsified) = build_sparse_image(
+        [(CHUNK_TYPE_RAW, 3, None),
+         (CHUNK_TYPE_FILL, 2, b'\x12\x34\x56\x78'),
+         (CHUNK_TYPE_DONT_CARE, 4, None),
+         (CHUNK_TYPE_RAW, 1, None),
+         (CHUNK_TYPE_FILL, 2, b'\0\0\0\0'),
+         (CHUNK_TYPE_DONT_CARE, 1, None),
+         (CHUNK_TYPE_RAW, 2, None)], 'extents')
+    path = write_file(self._path('sparse.img'), sparse_data)
+    image = self.avbtool.ImageHandler(path, read_only=True,
+                                      index_cache_dir='')
+    raw = self.avbtool.ImageHandler.EXTENT_RAW
+    fill = self.avbtool.ImageHandler.EXTENT_FILL
+    zero = self.avbtool.ImageHandler.EXTENT_ZERO
+    extents = list(image.iter_extents(0, image.image_size))
+    self.assertEqual(extents[1][0:3], (fill, 3 * BLOCK_SIZE, 2 * BLOCK_SIZE))
+    self.assertEqual(extents[1][3], b'\x12\x34\x56\x78')
+    (merged, data) = merge_extents(extents)
+    self.assertEqual(merged, [(raw, 0, 3 * BLOCK_SIZE),
+                              (fill, 3 * BLOCK_SIZE, 2 * BLOCK_SIZE),
+                              (zero, 5 * BLOCK_SIZE, 4 * BLOCK_SIZE),
+                              (raw, 9 * BLOCK_SIZE, BLOCK_SIZE),
+                              (zero, 10 * BLOCK_SIZE, 3 * BLOCK_SIZE),
+                              (raw, 13 * BLOCK_SIZE, 2 * BLOCK_SIZE)])
+    self.assertEqual(data, unsparsified)
+    # FILL and DONT_CARE data isn't read.
+    self.assertEqual(image.bytes_read, 6 * BLOCK_SIZE)
+
+    # The pattern of a FILL extent starting inside a chunk is rotated.
+    extents = list(image.iter_extents(3 * BLOCK_SIZE + 1, BLOCK_SIZE))
+    self.assertEqual(extents, [(fill, 3 * BLOCK_SIZE + 1, BLOCK_SIZE,
+                                b'\x34\x56\x78\x12')])
+    (_, data) = merge_extents(image.iter_extents(2 * BLOCK_SIZE - 3,
+                                                 9 * BLOCK_SIZE))
+    self.assertEqual(data, unsparsified[2 * BLOCK_SIZE - 3:
+                                        11 * BLOCK_SIZE - 3])
+
+  def test_concurrent_first_use(self):
+    self._skip_without_holes()
+    image = self.avbtool.ImageHandler(self.holey_path, read_only=True,
+                                      use_mmap=True, seek_holes=True)
+    mmap_calls = []
+    find_calls = []
+    real_mmap = self.avbtool.mmap.mmap
+    # pylint: disable=protected-access
+    real_find_data_ranges = image._find_data_ranges
+
+    def slow_mmap(*args, **kwargs):
+      mmap_calls.append(args)
+      time.sleep(0.05)
+      return real_mmap(*args, **kwargs)
+
+    def slow_find_data_ranges():
+      find_calls.append(threading.get_ident())
+      time.sleep(0.05)
+      real_find_data_ranges()
+
+    image._find_data_ranges = slow_find_data_ranges
+    barrier = threading.Barrier(8)
+    results = [None] * 8
+
+    def read(n):
+      barrier.wait()
+      results[n] = merge_extents(image.iter_extents(0, image.image_size))
+
+    with mock.patch.object(self.avbtool.mmap, 'mmap', slow_mmap):
+      threads = [threading.Thread(target=read, args=(n,)) for n in range(8)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+    # The image is mapped and its holes are looked for only once, and
+    # every thread sees the complete result.
+    self.assertEqual(len(mmap_calls), 1)
+    self.assertEqual(len(find_calls), 1)
+    for result in results:
+      self.assertEqual(result, (self._holey_extents(), self.holey_data))
+
+  def _add_hashtree_footer(self, image):
+    with contextlib.redirect_stdout(io.StringIO()):
+      self.avbtool.AvbTool().run(
+          ['avbtool', 'add_hashtree_footer', '--image', image,
+           '--partition_name', 'system',
+           '--partition_size', str(PARTITION_SIZE), '--salt', SALT])
+    return read_file(image)
+
+  def test_hashtree_footer(self):
+    reference = self._add_hashtree_footer(
+        write_file(self._path('dense.img'), self.holey_data))
+    for (use_mmap, seek_holes) in itertools.product((False, True),
+                                                    (False, True)):
+      with self.subTest(use_mmap=use_mmap, seek_holes=seek_holes):
+        self.avbtool.AVB_IMAGE_MMAP = use_mmap
+        self.avbtool.AVB_IMAGE_SEEK_HOLES = seek_holes
+        write_holey_image(self.holey_path)
+        self.assertEqual(self._add_hashtree_footer(self.holey_path),
+                         reference)
+        self.avbtool.Avb().verify_image(self.holey_path, None, None, False,
+                                        False, check_fec=True)
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=2)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+# Copyright 2026, The Android Open Source Project
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Tests the FEC encoder of avbtool against 'fec --encode'.
+
+The files in data/ named fec_<blocks>_blocks_<roots>_roots.fec.gz are
+the gzipped output of
+
+  fec --encode --roots <roots> <input> <output>
+
+for the input returned by _generate_input() with the same number of
+blocks.
+"""
+
+import gzip
+import os
+import struct
+import tempfile
+import unittest
+from unittest import mock
+
+from avbtool_test_util import TEST_DATA_DIR
+from avbtool_test_util import generate_test_data
+from avbtool_test_util import load_avbtool
+from avbtool_test_util import write_file
+
+# (Number of blocks, number of roots) of the stored vectors.
+VECTORS = [(1, 2), (1, 24), (3, 2), (3, 24), (260, 2), (260, 24)]
+
+
+def _generate_input(num_blocks):
+  """Generates the input of the stored vectors for |num_blocks|."""
+  zero_blocks = {1: (), 3: (1,),
+                 260: tuple(range(0, 260, 7)) + tuple(range(100, 140))}
+  return generate_test_data(num_blocks * 4096, 'fec-{}'.format(num_blocks),
+                            zero_blocks[num_blocks])
+
+
+def _read_vector(num_blocks, num_roots):
+  """Reads the stored output of 'fec --encode'."""
+  path = os.path.join(TEST_DATA_DIR, 'fec_{}_blocks_{}_roots.fec.gz'
+                      .format(num_blocks, num_roots))
+  with gzip.open(path, 'rb') as f:
+    return f.read()
+
+
+class FecEncoderTest(unittest.TestCase):
+  """Tests that FEC data is byte-identical to the one of 'fec --encode'."""
+
+  def setUp(self):
+    self.avbtool = load_avbtool()
+    self.temp_dir = tempfile.TemporaryDirectory()
+
+  def tearDown(self):
+    self.temp_dir.cleanup()
+
+  def _encode(self, data, num_roots, jobs):
+    """Encodes |data| like add_hashtree_footer and returns 'fec' output."""
+    path = write_file(os.path.join(self.temp_dir.name, 'input.img'), data)
+    image = self.avbtool.ImageHandler(path, read_only=True)
+    fec_data = self.avbtool.generate_fec_data(image, num_roots, jobs)
+    return self._with_header(fec_data, num_roots, len(data))
+
+  def _with_header(self, fec_data, num_roots, inp_size):
+    """Appends the FEC_BLOCKSIZE block with the libfec header."""
+    header = self.avbtool.encode_fec_header(fec_data, num_roots, inp_size)
+    padding = b'\0' * (self.avbtool.FEC_BLOCKSIZE - 2 * len(header))
+    return bytes(fec_data) + header + padding + header
+
+  def test_calc_fec_data_size(self):
+    for (num_blocks, num_roots) in VECTORS:
+      with self.subTest(num_blocks=num_blocks, num_roots=num_roots):
+        self.assertEqual(
+            self.avbtool.calc_fec_data_size(num_blocks * 4096, num_roots),
+            len(_read_vector(num_blocks, num_roots)))
+
+  def test_single_process(self):
+    for (num_blocks, num_roots) in VECTORS:
+      with self.subTest(num_blocks=num_blocks, num_roots=num_roots):
+        self.assertEqual(self._encode(_generate_input(num_blocks),
+                                      num_roots, 1),
+                         _read_vector(num_blocks, num_roots))
+
+  def test_several_processes(self):
+    for (num_blocks, num_roots) in VECTORS:
+      with self.subTest(num_blocks=num_blocks, num_roots=num_roots):
+        self.assertEqual(self._encode(_generate_input(num_blocks),
+                                      num_roots, 3),
+                         _read_vector(num_blocks, num_roots))
+
+  def test_single_process_without_fork(self):
+    # Platforms without os.fork() have no 'fork' start method, which
+    # must not matter when no worker processes are used.
+    def no_fork(method=None):
+      raise ValueError('cannot find context for {!r}'.format(method))
+
+    with mock.patch.object(self.avbtool.multiprocessing, 'get_context',
+                           no_fork):
+      for (num_blocks, num_roots) in VECTORS:
+        with self.subTest(num_blocks=num_blocks, num_roots=num_roots):
+          data = _generate_input(num_blocks)
+          path = write_file(os.path.join(self.temp_dir.name, 'input.img'),
+                            data)
+          image = self.avbtool.ImageHandler(path, read_only=True)
+          fec_data = self.avbtool.generate_fec_data(image, num_roots, 1)
+          self.assertEqual(self._with_header(fec_data, num_roots, len(data)),
+                           _read_vector(num_blocks, num_roots))
+          self.assertEqual(image.bytes_read, len(data))
+
+  def test_streaming(self):
+    for (num_blocks, num_roots) in VECTORS:
+      with self.subTest(num_blocks=num_blocks, num_roots=num_roots):
+        data = _generate_input(num_blocks)
+
+        def read_stripe(offset, size, data=data):
+          return data[offset:offset + size]
+
+        fec_data = self.avbtool.FecEncoder(num_roots).encode(
+            read_stripe, len(data), streaming=True)
+        self.assertEqual(self._with_header(fec_data, num_roots, len(data)),
+                         _read_vector(num_blocks, num_roots))
+
+  def test_header(self):
+    vector = _read_vector(3, 24)
+    header_size = struct.calcsize(self.avbtool.FEC_FOOTER_FORMAT)
+    (magic, version, size, num_roots, fec_size, inp_size,
+     _) = struct.unpack(self.avbtool.FEC_FOOTER_FORMAT,
+                        vector[-header_size:])
+    self.assertEqual(magic, self.avbtool.FEC_MAGIC)
+    self.assertEqual(version, self.avbtool.FEC_VERSION)
+    self.assertEqual(size, header_size)
+    self.assertEqual(num_roots, 24)
+    self.assertEqual(fec_size, len(vector) - self.avbtool.FEC_BLOCKSIZE)
+    self.assertEqual(inp_size, 3 * 4096)
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=2)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+# Copyright 2026, The Android Open Source Project
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Tests updating hashtrees and FEC data for changed blocks."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from avbtool_test_util import KEY_DIR
+from avbtool_test_util import generate_test_data
+from avbtool_test_util import read_file
+from avbtool_test_util import run_avbtool
+from avbtool_test_util import write_file
+
+BLOCK_SIZE = 4096
+
+# The image ends with a partial block, so its last block is also in the
+# last, partial FEC stripe.
+IMAGE_SIZE = 3000 * BLOCK_SIZE + 100
+
+PARTITION_SIZE = 16 * 1024 * 1024
+
+SALT = '0011223344556677'
+
+
+class IncrementalUpdateTest(unittest.TestCase):
+  """Tests that incremental updates give the same image as a full rebuild."""
+
+  def setUp(self):
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.data = generate_test_data(IMAGE_SIZE, 'incremental')
+
+  def tearDown(self):
+    self.temp_dir.cleanup()
+
+  def _path(self, name):
+    return os.path.join(self.temp_dir.name, name)
+
+  def _add_hashtree_footer(self, image, *args):
+    result = run_avbtool('add_hashtree_footer', '--image', image,
+                         '--partition_name', 'system',
+                         '--partition_size', PARTITION_SIZE,
+                         '--algorithm', 'SHA256_RSA2048',
+                         '--key', os.path.join(KEY_DIR,
+                                               'testkey_rsa2048.pem'),
+                         '--salt', SALT, *args)
+    self.assertEqual(result.returncode, 0, result.stderr)
+    return read_file(image)
+
+  def _patch(self, blocks):
+    """Returns the data with one byte changed in each of |blocks|."""
+    data = bytearray(self.data)
+    for block in blocks:
+      offset = min(block * BLOCK_SIZE + 17, IMAGE_SIZE - 1)
+      data[offset] ^= 0x5a
+    return data
+
+  def _check(self, blocks, *args):
+    previous = self._add_hashtree_footer(
+        write_file(self._path('previous.img'), self.data), *args)
+    new_data = self._patch(blocks)
+    full = self._add_hashtree_footer(
+        write_file(self._path('full.img'), new_data), *args)
+    self.assertNotEqual(previous, full)
+    block_list = ','.join(str(block) for block in blocks)
+
+    # Blocks found by comparing with the previous image.
+    updated = self._add_hashtree_footer(
+        write_file(self._path('new.img'), new_data),
+        '--previous_image', self._path('previous.img'), *args)
+    self.assertEqual(updated, full)
+
+    # Blocks given explicitly, with the previous image.
+    updated = self._add_hashtree_footer(
+        write_file(self._path('new.img'), new_data),
+        '--previous_image', self._path('previous.img'),
+        '--changed_blocks', block_list, *args)
+    self.assertEqual(updated, full)
+
+    # Blocks given explicitly, updating the footer of the image itself.
+    shutil.copy(self._path('previous.img'), self._path('in_place.img'))
+    with open(self._path('in_place.img'), 'r+b') as f:
+      f.write(new_data)
+    updated = self._add_hashtree_footer(
+        self._path('in_place.img'), '--changed_blocks', block_list, *args)
+    self.assertEqual(updated, full)
+
+  def test_default_roots(self):
+    self._check([3, 400, IMAGE_SIZE // BLOCK_SIZE])
+
+  def test_many_roots(self):
+    self._check([0, 999, IMAGE_SIZE // BLOCK_SIZE], '--fec_num_roots', '24')
+
+  def test_without_fec(self):
+    self._check([3, 400, IMAGE_SIZE // BLOCK_SIZE],
+                '--do_not_generate_fec')
+
+  def test_sha512(self):
+    self._check([1, 2, 3], '--hash_algorithm', 'sha512')
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=2)
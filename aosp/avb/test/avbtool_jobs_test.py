@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# Copyright 2026, The Android Open Source Project
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Tests the --jobs option of avbtool."""
+
+import os
+import tempfile
+import unittest
+
+from avbtool_test_util import generate_test_data
+from avbtool_test_util import load_avbtool
+from avbtool_test_util import read_file
+from avbtool_test_util import run_avbtool
+from avbtool_test_util import write_file
+
+
+class JobsTest(unittest.TestCase):
+  """Tests that invalid numbers of jobs are rejected."""
+
+  def setUp(self):
+    self.avbtool = load_avbtool()
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.image = write_file(os.path.join(self.temp_dir.name, 'system.img'),
+                            generate_test_data(64 * 4096, 'jobs'))
+
+  def tearDown(self):
+    self.temp_dir.cleanup()
+
+  def _add_hashtree_footer(self, *args):
+    return run_avbtool('add_hashtree_footer', '--image', self.image,
+                       '--partition_name', 'system',
+                       '--partition_size', 1024 * 1024, *args)
+
+  def _assert_rejected(self, result):
+    self.assertEqual(result.returncode, 1)
+    self.assertIn('Number of jobs must be 0 or greater', result.stderr)
+    self.assertNotIn('Traceback', result.stderr)
+
+  def test_add_hashtree_footer(self):
+    data = read_file(self.image)
+    self._assert_rejected(self._add_hashtree_footer('--jobs', '-1'))
+    self.assertEqual(read_file(self.image), data)
+
+  def test_verify_image(self):
+    self.assertEqual(self._add_hashtree_footer().returncode, 0)
+    self._assert_rejected(run_avbtool('verify_image', '--image', self.image,
+                                      '--jobs', '-2'))
+    self.assertEqual(run_avbtool('verify_image', '--image', self.image,
+                                 '--jobs', '0').returncode, 0)
+
+  def test_repair_image(self):
+    self.assertEqual(self._add_hashtree_footer().returncode, 0)
+    self._assert_rejected(run_avbtool('repair_image', '--image', self.image,
+                                      '--jobs', '-1'))
+
+  def test_library(self):
+    avb = self.avbtool.Avb()
+    with self.assertRaises(self.avbtool.AvbError):
+      avb.verify_image(self.image, None, None, False, False, jobs=-1)
+    with self.assertRaises(self.avbtool.AvbError):
+      avb.repair_image(self.image, jobs=-1)
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=2)
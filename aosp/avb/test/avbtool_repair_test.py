@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+# Copyright 2026, The Android Open Source Project
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Tests repairing images from FEC data and checking FEC data."""
+
+import contextlib
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from avbtool_test_util import BLOCK_SIZE
+from avbtool_test_util import TEST_DATA_DIR
+from avbtool_test_util import generate_test_data
+from avbtool_test_util import load_avbtool
+from avbtool_test_util import read_file
+from avbtool_test_util import run_avbtool
+from avbtool_test_util import write_file
+
+# The hashtree has 5 + 1 blocks, so with two roots the 606 blocks of data
+# and tree are encoded in 3 rounds. Blocks at the same index modulo 3 are
+# in the same codewords, at most two of them can be repaired.
+NUM_BLOCKS = 600
+NUM_ROUNDS = 3
+
+PARTITION_SIZE = 4 * 1024 * 1024
+
+SALT = '00112233445566778899aabbccddeeff'
+
+
+class RepairImageTest(unittest.TestCase):
+  """Tests repair_image and verify_image --check_fec."""
+
+  def setUp(self):
+    self.avbtool = load_avbtool()
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.reference = self._path('reference.img')
+    write_file(self.reference,
+               generate_test_data(NUM_BLOCKS * BLOCK_SIZE, 'repair'))
+    self._run('add_hashtree_footer', '--image', self.reference,
+              '--partition_name', 'system',
+              '--partition_size', str(PARTITION_SIZE), '--salt', SALT)
+    self.image = self._path('system.img')
+    shutil.copy(self.reference, self.image)
+    image = self.avbtool.ImageHandler(self.reference, read_only=True)
+    # pylint: disable=protected-access
+    (_, _, descriptors, _) = self.avbtool.Avb()._parse_image(image)
+    self.desc = [d for d in descriptors
+                 if isinstance(d, self.avbtool.AvbHashtreeDescriptor)][0]
+    self.assertEqual(self.desc.tree_offset, NUM_BLOCKS * BLOCK_SIZE)
+    self.assertEqual(self.desc.tree_size, 6 * BLOCK_SIZE)
+
+  def tearDown(self):
+    self.temp_dir.cleanup()
+
+  def _path(self, name):
+    return os.path.join(self.temp_dir.name, name)
+
+  def _run(self, *args):
+    """Runs avbtool in-process and returns what it printed."""
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+      self.avbtool.AvbTool().run(['avbtool'] + list(args))
+    return output.getvalue()
+
+  def _corrupt(self, offset, size=1):
+    """Inverts |size| bytes at |offset| of the image."""
+    with open(self.image, 'r+b') as f:
+      f.seek(offset)
+      data = f.read(size)
+      f.seek(offset)
+      f.write(bytes(b ^ 0xff for b in data))
+
+  def _corrupt_block(self, block):
+    """Corrupts a block of the data or, past the data, of the hashtree."""
+    self._corrupt(block * BLOCK_SIZE + 1000, 50)
+
+  def _verify(self, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()), \
+         contextlib.redirect_stderr(io.StringIO()):
+      self.avbtool.Avb().verify_image(self.image, None, None, False, False,
+                                      **kwargs)
+
+  def test_repair_data_blocks(self):
+    # Two blocks in the same codewords, the first and the last block.
+    for block in (0, NUM_ROUNDS, 1, 1 + NUM_ROUNDS, NUM_BLOCKS - 1):
+      self._corrupt_block(block)
+    with self.assertRaises(self.avbtool.AvbError):
+      self._verify()
+    output = self._run('repair_image', '--image', self.image)
+    self.assertIn('Found 5 corrupted data blocks and 0 corrupted hashtree '
+                  'blocks', output)
+    self.assertIn('Successfully repaired 5 blocks', output)
+    self.assertEqual(read_file(self.image), read_file(self.reference))
+    self._verify(check_fec=True)
+
+  def test_repair_hashtree_blocks(self):
+    # The top level, a block of the lowest level of the hashtree and a
+    # data block below it, which are only found once the levels above
+    # are repaired. Corrupted blocks which aren't found yet mustn't be
+    # in the same codewords as the repaired ones.
+    for jobs in (1, 3):
+      with self.subTest(jobs=jobs):
+        shutil.copy(self.reference, self.image)
+        for block in (NUM_BLOCKS, NUM_BLOCKS + 2, 130):
+          self._corrupt_block(block)
+        output = self._run('repair_image', '--image', self.image,
+                           '--jobs', str(jobs))
+        self.assertIn('Found 0 corrupted data blocks and 1 corrupted hashtree '
+                      'blocks, 605 blocks not checked yet', output)
+        self.assertIn('Found 0 corrupted data blocks and 1 corrupted hashtree '
+                      'blocks, 128 blocks not checked yet', output)
+        self.assertIn('Found 1 corrupted data blocks and 0 corrupted '
+                      'hashtree blocks, 0 blocks not checked yet', output)
+        self.assertIn('Successfully repaired 3 blocks', output)
+        self.assertEqual(read_file(self.image), read_file(self.reference))
+        self._verify(check_fec=True)
+
+  def test_intact(self):
+    output = self._run('repair_image', '--image', self.image)
+    self.assertIn('No corrupted blocks found', output)
+    self.assertEqual(read_file(self.image), read_file(self.reference))
+
+  def test_too_many_corrupted_blocks(self):
+    # Three blocks in the same codewords, with two roots. The others
+    # could be repaired but nothing is written.
+    for block in (2, 2 + NUM_ROUNDS, 2 + 5 * NUM_ROUNDS, 7, 100):
+      self._corrupt_block(block)
+    corrupted = read_file(self.image)
+    result = run_avbtool('repair_image', '--image', self.image)
+    self.assertEqual(result.returncode, 1)
+    self.assertIn('Too many corrupted blocks to repair 3 blocks', result.stderr)
+    self.assertNotIn('Traceback', result.stderr)
+    self.assertEqual(read_file(self.image), corrupted)
+
+  def test_check_fec(self):
+    self._verify(check_fec=True)
+    # Damage the parity bytes of 3 codewords, which only --check_fec
+    # notices.
+    self._corrupt(self.desc.fec_offset + 3 * 4096 + 10, 6)
+    self._verify()
+    result = run_avbtool('verify_image', '--image', self.image, '--check_fec')
+    self.assertEqual(result.returncode, 1)
+    self.assertIn('FEC data of {} is invalid for 3 codewords'
+                  .format(self.image), result.stderr)
+    result = run_avbtool('verify_image', '--image', self.image)
+    self.assertEqual(result.returncode, 0, result.stderr)
+
+  def test_damaged_fec_data(self):
+    # A data block can't be repaired from damaged parity bytes of its
+    # codewords, which is noticed with the hashtree. Only one parity byte
+    # of each codeword is damaged as inverting both would cancel out when
+    # decoding a single erasure.
+    self._corrupt_block(9)
+    for codeword in range(1000, 1050):
+      self._corrupt(self.desc.fec_offset + 2 * codeword)
+    with self.assertRaisesRegex(self.avbtool.AvbError,
+                                'Repaired blocks still don\'t match'), \
+         contextlib.redirect_stdout(io.StringIO()):
+      self.avbtool.Avb().repair_image(self.image)
+
+
+class FecDecoderTest(unittest.TestCase):
+  """Tests decoding the stored 'fec --encode' output."""
+
+  def setUp(self):
+    self.avbtool = load_avbtool()
+    self.temp_dir = tempfile.TemporaryDirectory()
+
+  def tearDown(self):
+    self.temp_dir.cleanup()
+
+  def _repair(self, num_roots, blocks):
+    """Erases and repairs blocks of the input of a stored vector.
+
+    Returns:
+      The blocks which couldn't be repaired, whether the data was
+      restored and whether it was left unchanged.
+    """
+    inp = bytes(generate_test_data(
+        260 * BLOCK_SIZE, 'fec-260',
+        tuple(range(0, 260, 7)) + tuple(range(100, 140))))
+    path = os.path.join(TEST_DATA_DIR,
+                        'fec_260_blocks_{}_roots.fec.gz'.format(num_roots))
+    with gzip.open(path, 'rb') as f:
+      fec_data = f.read()[:-self.avbtool.FEC_BLOCKSIZE]
+    data = bytearray(inp + fec_data)
+    for block in blocks:
+      data[block * BLOCK_SIZE:(block + 1) * BLOCK_SIZE] = (
+          generate_test_data(BLOCK_SIZE, 'erased-{}'.format(block)))
+    erased = bytes(data)
+    image = write_file(os.path.join(self.temp_dir.name, 'image'), data)
+    fd = os.open(image, os.O_RDWR)
+    try:
+      failed = self.avbtool.repair_fec_blocks(
+          fd, len(inp), len(inp), num_roots,
+          [block * BLOCK_SIZE for block in blocks])
+    finally:
+      os.close(fd)
+    repaired = read_file(image)
+    return failed, repaired == inp + fec_data, repaired == erased
+
+  def test_erasures(self):
+    # With 2 roots the 260 blocks are encoded in 2 rounds, with 24 in 2
+    # as well, so even and odd blocks are in different codewords.
+    for (num_roots, blocks) in (
+        (2, [0, 1, 258, 259]),
+        (2, [100, 102]),
+        (24, list(range(0, 48, 2)) + [1, 3, 259]),
+        (24, list(range(200, 248)))):
+      with self.subTest(num_roots=num_roots, blocks=blocks):
+        self.assertEqual(self._repair(num_roots, blocks), ([], True, False))
+
+  def test_too_many_erasures(self):
+    for (num_roots, blocks) in ((2, [0, 2, 4, 1]),
+                                (24, list(range(0, 50, 2)) + [7])):
+      with self.subTest(num_roots=num_roots):
+        (failed, _, unchanged) = self._repair(num_roots, blocks)
+        self.assertEqual(sorted(failed),
+                         [block * BLOCK_SIZE for block in blocks
+                          if block % 2 == 0])
+        self.assertTrue(unchanged)
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=2)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+# Copyright 2026, The Android Open Source Project
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Stand-in for a persistent signing helper, used with avbtool.
+
+Use it as
+
+  avbtool add_hash_footer ... \\
+      --signing_helper_persistent test/avbtool_signing_helper_persistent.py
+
+It serves signing requests until its stdin is closed. Every message is a
+sequence of fields, each a 32-bit big-endian length followed by that many
+bytes. A request is (algorithm name, key path, padding and digest) and a
+response is (status, payload) where the payload is the signature if the
+status is 'OK' and an error message otherwise. Data is signed in-process
+with the RSA code of avbtool, so openssl isn't needed.
+
+If the environment variable SIGNING_HELPER_PERSISTENT_LOG is set, a line
+is appended to the file it names when the helper starts and for every
+request, so callers can check that the helper is reused. If
+SIGNING_HELPER_PERSISTENT_DIE_AT is set to N, the helper exits in the
+middle of its reply to the N-th request, to test how callers handle a
+helper which dies.
+"""
+
+import os
+import struct
+import sys
+
+from avbtool_test_util import load_avbtool
+
+
+def read_field(f):
+  """Reads a length-prefixed field, returning None at end of input."""
+  header = f.read(4)
+  if not header:
+    return None
+  if len(header) != 4:
+    raise IOError('Truncated request')
+  (length,) = struct.unpack('!I', header)
+  field = f.read(length)
+  if len(field) != length:
+    raise IOError('Truncated request')
+  return field
+
+
+def write_fields(f, *fields):
+  """Writes length-prefixed fields and flushes |f|."""
+  for field in fields:
+    f.write(struct.pack('!I', len(field)))
+    f.write(field)
+  f.flush()
+
+
+def log(message):
+  """Appends |message| to the log file, if one is configured."""
+  path = os.environ.get('SIGNING_HELPER_PERSISTENT_LOG')
+  if path:
+    with open(path, 'a') as f:
+      f.write('{} {}\n'.format(os.getpid(), message))
+
+
+def sign(avbtool, key_path, data):
+  """Signs |data| with the private key at |key_path|.
+
+  Arguments:
+    avbtool: The avbtool module.
+    key_path: The path of the private key.
+    data: The padding and digest to sign.
+
+  Returns:
+    The signature as bytes.
+
+  Raises:
+    AvbError: If the key can't be loaded or the data can't be signed.
+  """
+  key = avbtool.RSAPublicKey(key_path)
+  if key._private_numbers is None:  # pylint: disable=protected-access
+    raise avbtool.AvbError('No private key in {}'.format(key_path))
+  return key._sign_raw(data)  # pylint: disable=protected-access
+
+
+def main():
+  avbtool = load_avbtool()
+  stdin = sys.stdin.buffer
+  stdout = sys.stdout.buffer
+  die_at = int(os.environ.get('SIGNING_HELPER_PERSISTENT_DIE_AT', '0'))
+  num_requests = 0
+  log('start')
+  while True:
+    algorithm_name = read_field(stdin)
+    if algorithm_name is None:
+      break
+    key_path = read_field(stdin)
+    data = read_field(stdin)
+    if key_path is None or data is None:
+      raise IOError('Truncated request')
+    num_requests += 1
+    log('sign {} {}'.format(algorithm_name.decode('utf-8'),
+                            key_path.decode('utf-8')))
+    if num_requests == die_at:
+      stdout.write(struct.pack('!I', 2) + b'O')
+      stdout.flush()
+      log('die')
+      return 1
+    try:
+      signature = sign(avbtool, key_path.decode('utf-8'), data)
+    except avbtool.AvbError as e:
+      write_fields(stdout, b'ERROR', str(e).encode('utf-8'))
+      continue
+    write_fields(stdout, b'OK', signature)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
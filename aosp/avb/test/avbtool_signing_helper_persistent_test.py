@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+# Copyright 2026, The Android Open Source Project
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Tests the persistent signing helper protocol of avbtool."""
+
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from avbtool_test_util import KEY_DIR
+from avbtool_test_util import TEST_DIR
+from avbtool_test_util import generate_test_data
+from avbtool_test_util import load_avbtool
+from avbtool_test_util import read_file
+from avbtool_test_util import run_avbtool
+from avbtool_test_util import write_file
+
+HELPER = os.path.join(TEST_DIR, 'avbtool_signing_helper_persistent.py')
+
+KEY = os.path.join(KEY_DIR, 'testkey_rsa4096.pem')
+
+PUBLIC_KEY = os.path.join(KEY_DIR, 'testkey_rsa4096_pub.pem')
+
+SALT = '0123456789abcdef'
+
+
+class PersistentSigningHelperTest(unittest.TestCase):
+  """Tests signing with a helper started once."""
+
+  def setUp(self):
+    self.avbtool = load_avbtool()
+    # Helpers inherit the environment when they're started, so every
+    # test starts its own.
+    self.avbtool.PersistentSigningHelper.close_all()
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.log = self._path('helper.log')
+    self.saved_environ = dict(os.environ)
+    os.environ['SIGNING_HELPER_PERSISTENT_LOG'] = self.log
+    self.image = write_file(self._path('boot.img'),
+                            generate_test_data(3 * 4096 + 10, 'helper'))
+    self.footer_image = self._path('boot_with_footer.img')
+    self._add_hash_footer(self.footer_image)
+
+  def tearDown(self):
+    self.avbtool.PersistentSigningHelper.close_all()
+    os.environ.clear()
+    os.environ.update(self.saved_environ)
+    self.temp_dir.cleanup()
+
+  def _path(self, name):
+    return os.path.join(self.temp_dir.name, name)
+
+  def _log_lines(self, kind):
+    """Returns the (pid, message) pairs of a kind logged by helpers."""
+    if not os.path.exists(self.log):
+      return []
+    with open(self.log) as f:
+      lines = [line.split(' ', 1) for line in f.read().splitlines()]
+    return [(pid, message) for (pid, message) in lines
+            if message.split(' ')[0] == kind]
+
+  def _run(self, *args):
+    with contextlib.redirect_stdout(io.StringIO()):
+      self.avbtool.AvbTool().run(['avbtool'] + list(args))
+
+  def _make_vbmeta_image(self, output, *args):
+    self._run('make_vbmeta_image', '--output', output,
+              '--algorithm', 'SHA256_RSA4096', '--key', KEY,
+              '--include_descriptors_from_image', self.footer_image, *args)
+    return read_file(output)
+
+  def _add_hash_footer(self, image, *args):
+    shutil.copy(self.image, image)
+    self._run('add_hash_footer', '--image', image, '--partition_name', 'boot',
+              '--partition_size', str(256 * 1024), '--salt', SALT,
+              '--algorithm', 'SHA512_RSA4096', '--key', KEY, *args)
+    return read_file(image)
+
+  def test_same_signatures(self):
+    for n in range(3):
+      self.assertEqual(
+          self._make_vbmeta_image(self._path('vbmeta{}.img'.format(n)),
+                                  '--signing_helper_persistent', HELPER),
+          self._make_vbmeta_image(self._path('vbmeta.img')))
+      self.assertEqual(
+          self._add_hash_footer(self._path('boot{}.img'.format(n)),
+                                '--signing_helper_persistent', HELPER),
+          self._add_hash_footer(self._path('boot.img.ref')))
+    self.assertEqual(len(self._log_lines('start')), 1)
+    self.assertEqual(len(self._log_lines('sign')), 6)
+
+  def test_same_signatures_in_process(self):
+    key = self.avbtool.RSAPublicKey(KEY)
+    for n in range(5):
+      data = 'data {}'.format(n).encode('ascii')
+      self.assertEqual(
+          key.sign('SHA256_RSA4096', data, signing_helper_persistent=HELPER),
+          key.sign('SHA256_RSA4096', data, in_process=True))
+    self.assertEqual(len(self._log_lines('start')), 1)
+
+  def test_command(self):
+    output = self._path('vbmeta.img')
+    result = run_avbtool('make_vbmeta_image', '--output', output,
+                         '--algorithm', 'SHA256_RSA4096', '--key', KEY,
+                         '--include_descriptors_from_image',
+                         self.footer_image,
+                         '--signing_helper_persistent', HELPER)
+    self.assertEqual(result.returncode, 0, result.stderr)
+    self.assertEqual(read_file(output),
+                     self._make_vbmeta_image(self._path('reference.img')))
+    self.assertEqual(len(self._log_lines('start')), 1)
+
+  def test_error_status(self):
+    # pylint: disable=protected-access
+    helpers = self.avbtool.PersistentSigningHelper._helpers
+    key = self.avbtool.RSAPublicKey(PUBLIC_KEY)
+    with self.assertRaisesRegex(self.avbtool.AvbError, 'No private key'):
+      key.sign('SHA256_RSA4096', b'data', signing_helper_persistent=HELPER)
+    # The helper is still used after reporting an error.
+    self.assertIn(HELPER, helpers)
+    self.assertEqual(
+        self._make_vbmeta_image(self._path('vbmeta.img'),
+                                '--signing_helper_persistent', HELPER),
+        self._make_vbmeta_image(self._path('reference.img')))
+    self.assertEqual(len(self._log_lines('start')), 1)
+
+  def test_helper_dies(self):
+    os.environ['SIGNING_HELPER_PERSISTENT_DIE_AT'] = '2'
+    key = self.avbtool.RSAPublicKey(KEY)
+    # pylint: disable=protected-access
+    helpers = self.avbtool.PersistentSigningHelper._helpers
+    key.sign('SHA256_RSA4096', b'first', signing_helper_persistent=HELPER)
+    with self.assertRaisesRegex(self.avbtool.AvbError, 'Error signing'):
+      key.sign('SHA256_RSA4096', b'second', signing_helper_persistent=HELPER)
+    self.assertNotIn(HELPER, helpers)
+    self.assertEqual(len(self._log_lines('die')), 1)
+    # The next request starts a new helper.
+    self.assertEqual(
+        key.sign('SHA256_RSA4096', b'third', signing_helper_persistent=HELPER),
+        key.sign('SHA256_RSA4096', b'third', in_process=True))
+    self.assertIn(HELPER, helpers)
+    starts = self._log_lines('start')
+    self.assertEqual(len(starts), 2)
+    self.assertNotEqual(starts[0][0], starts[1][0])
+
+  def test_helper_missing(self):
+    key = self.avbtool.RSAPublicKey(KEY)
+    with self.assertRaisesRegex(self.avbtool.AvbError,
+                                'Error starting signing helper'):
+      key.sign('SHA256_RSA4096', b'data',
+               signing_helper_persistent=self._path('missing'))
+
+  def test_several_helpers(self):
+    key = self.avbtool.RSAPublicKey(KEY)
+    with self.assertRaises(self.avbtool.AvbError):
+      key.sign('SHA256_RSA4096', b'data', signing_helper=HELPER,
+               signing_helper_persistent=HELPER)
+    result = run_avbtool('make_vbmeta_image', '--output',
+                         self._path('vbmeta.img'),
+                         '--algorithm', 'SHA256_RSA4096', '--key', KEY,
+                         '--signing_helper', HELPER,
+                         '--signing_helper_persistent', HELPER)
+    self.assertEqual(result.returncode, 2)
+    self.assertIn('not allowed with argument', result.stderr)
+    self.assertEqual(self._log_lines('start'), [])
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=2)
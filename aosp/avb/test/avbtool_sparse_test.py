@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+
+# Copyright 2026, The Android Open Source Project
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Tests the chunk table ImageHandler keeps for Android sparse images."""
+
+import contextlib
+import io
+import itertools
+import os
+import struct
+import tempfile
+import unittest
+
+from avbtool_test_util import BLOCK_SIZE
+from avbtool_test_util import CHUNK_HEADER_FORMAT
+from avbtool_test_util import CHUNK_TYPE_DONT_CARE
+from avbtool_test_util import CHUNK_TYPE_FILL
+from avbtool_test_util import CHUNK_TYPE_RAW
+from avbtool_test_util import SPARSE_HEADER_FORMAT
+from avbtool_test_util import build_sparse_image
+from avbtool_test_util import generate_test_data
+from avbtool_test_util import load_avbtool
+from avbtool_test_util import read_file
+from avbtool_test_util import write_file
+
+# Chunks of the test image as (type, number of blocks, fill data).
+CHUNKS = [(CHUNK_TYPE_RAW, 3, None),
+          (CHUNK_TYPE_FILL, 2, b'\x12\x34\x56\x78'),
+          (CHUNK_TYPE_DONT_CARE, 4, None),
+          (CHUNK_TYPE_RAW, 1, None),
+          (CHUNK_TYPE_FILL, 2, b'\0\0\0\0'),
+          (CHUNK_TYPE_DONT_CARE, 1, None),
+          (CHUNK_TYPE_RAW, 2, None)]
+
+PARTITION_SIZE = 1024 * 1024
+
+SALT = '00112233445566778899aabbccddeeff'
+
+
+class SparseImageTest(unittest.TestCase):
+  """Tests that appends and truncations keep the chunk table correct."""
+
+  def setUp(self):
+    self.avbtool = load_avbtool()
+    self.saved_index_cache = self.avbtool.AVB_SPARSE_INDEX_CACHE
+    self.avbtool.AVB_SPARSE_INDEX_CACHE = None
+    self.temp_dir = tempfile.TemporaryDirectory()
+    (self.sparse_data, self.unsparsified) = build_sparse_image(CHUNKS,
+                                                               'sparse')
+
+  def tearDown(self):
+    self.avbtool.AVB_SPARSE_INDEX_CACHE = self.saved_index_cache
+    self.temp_dir.cleanup()
+
+  def _path(self, name):
+    return os.path.join(self.temp_dir.name, name)
+
+  def _open(self, path, **kwargs):
+    """Opens an image, scanning its chunks unless told otherwise."""
+    kwargs.setdefault('index_cache_dir', '')
+    return self.avbtool.ImageHandler(path, **kwargs)
+
+  def _unsparsify(self, path):
+    """Returns the unsparsified data of the image at |path|."""
+    image = self._open(path, read_only=True)
+    self.assertTrue(image.is_sparse)
+    image.seek(0)
+    return image.read(image.image_size)
+
+  def _chunk_table(self, image):
+    """Returns the chunk table of |image| as comparable values."""
+    # pylint: disable=protected-access
+    return (list(image._chunk_types), list(image._chunk_offsets),
+            list(image._chunk_output_offsets),
+            list(image._chunk_output_sizes), bytes(image._chunk_fill_data),
+            image._sparse_end, image._num_total_chunks,
+            image._num_total_blocks, image.image_size)
+
+  def _check_table_matches_scan(self, image):
+    """Checks the table of |image| is the one of a fresh scan of the file."""
+    image.flush()
+    self.assertEqual(self._chunk_table(image),
+                     self._chunk_table(self._open(image.filename,
+                                                  read_only=True)))
+
+  def _run(self, *args):
+    with contextlib.redirect_stdout(io.StringIO()):
+      self.avbtool.AvbTool().run(['avbtool'] + list(args))
+
+  def _add_footer(self, command, image, *args):
+    self._run(command, '--image', image, '--partition_name', 'system',
+              '--partition_size', str(PARTITION_SIZE), '--salt', SALT, *args)
+
+  def test_read(self):
+    path = write_file(self._path('sparse.img'), self.sparse_data)
+    self.assertEqual(self._unsparsify(path), self.unsparsified)
+
+  def test_footers_match_raw_image(self):
+    for (command, index_cache) in itertools.product(
+        ('add_hash_footer', 'add_hashtree_footer'), (None, 'cache')):
+      with self.subTest(command=command, index_cache=index_cache):
+        self.avbtool.AVB_SPARSE_INDEX_CACHE = index_cache
+        raw = write_file(self._path('raw.img'), self.unsparsified)
+        self._add_footer(command, raw)
+        sparse = write_file(self._path('sparse.img'), self.sparse_data)
+        self._add_footer(command, sparse)
+        self.assertEqual(self._unsparsify(sparse), read_file(raw))
+        # Adding the footer again replaces the old one.
+        self._add_footer(command, sparse)
+        self.assertEqual(self._unsparsify(sparse), read_file(raw))
+
+  def test_appends_and_truncations(self):
+    path = write_file(self._path('sparse.img'), self.sparse_data)
+    image = self._open(path)
+    expected = bytearray(self.unsparsified)
+    raw_data = bytes(generate_test_data(2 * BLOCK_SIZE, 'append'))
+
+    image.append_raw(raw_data)
+    expected += raw_data
+    self._check_table_matches_scan(image)
+    image.append_fill(b'\xab\xcd\xef\x01', 3 * BLOCK_SIZE)
+    expected += b'\xab\xcd\xef\x01' * (3 * BLOCK_SIZE // 4)
+    image.append_dont_care(BLOCK_SIZE)
+    expected += b'\0' * BLOCK_SIZE
+    self._check_table_matches_scan(image)
+
+    # Truncate in the middle of RAW, FILL and DONT_CARE chunks and at a
+    # chunk boundary.
+    for blocks in (20, 14, 11, 9, 3):
+      image.truncate(blocks * BLOCK_SIZE)
+      del expected[blocks * BLOCK_SIZE:]
+      self._check_table_matches_scan(image)
+      self.assertEqual(self._unsparsify(path), expected)
+
+    with image.append_transaction():
+      image.append_dont_care(2 * BLOCK_SIZE)
+      image.append_raw(raw_data)
+      image.truncate(4 * BLOCK_SIZE)
+      image.append_fill(b'\0\0\0\1', BLOCK_SIZE)
+    expected += b'\0' * BLOCK_SIZE + b'\0\0\0\1' * (BLOCK_SIZE // 4)
+    self._check_table_matches_scan(image)
+    self.assertEqual(self._unsparsify(path), expected)
+
+  def test_transaction_defers_header_update(self):
+    path = write_file(self._path('sparse.img'), self.sparse_data)
+    image = self._open(path)
+    header = read_file(path)[:struct.calcsize(SPARSE_HEADER_FORMAT)]
+    with image.append_transaction():
+      image.append_raw(b'\1' * BLOCK_SIZE)
+      image.append_dont_care(BLOCK_SIZE)
+      self.assertEqual(read_file(path)[:len(header)], header)
+    self.assertNotEqual(read_file(path)[:len(header)], header)
+    self._check_table_matches_scan(image)
+
+  def test_aborted_transaction(self):
+    path = write_file(self._path('sparse.img'), self.sparse_data)
+    image = self._open(path)
+    with self.assertRaises(RuntimeError):
+      with image.append_transaction():
+        image.truncate(5 * BLOCK_SIZE)
+        image.append_raw(b'\1' * BLOCK_SIZE)
+        raise RuntimeError('aborted')
+    # The header is written when the transaction is aborted, so the image
+    # stays consistent with the chunks written before the error.
+    self._check_table_matches_scan(image)
+    self.assertEqual(self._unsparsify(path),
+                     self.unsparsified[:5 * BLOCK_SIZE] + b'\1' * BLOCK_SIZE)
+    # The handler can still be used afterwards.
+    image.append_dont_care(BLOCK_SIZE)
+    self._check_table_matches_scan(image)
+
+  def test_scan_across_windows(self):
+    # Enough small chunks that their headers span several scan windows,
+    # with fill data and RAW chunks straddling window boundaries.
+    chunks = []
+    for n in range(3 * self.avbtool.ImageHandler.SCAN_WINDOW_SIZE // 16):
+      if n % 97 == 0:
+        chunks.append((CHUNK_TYPE_RAW, 1, None))
+      elif n % 3 == 0:
+        chunks.append((CHUNK_TYPE_DONT_CARE, 1, None))
+      else:
+        chunks.append((CHUNK_TYPE_FILL, 1, struct.pack('<I', n)))
+    (sparse_data, unsparsified) = build_sparse_image(chunks, 'windows')
+    path = write_file(self._path('sparse.img'), sparse_data)
+    image = self._open(path, read_only=True)
+    # pylint: disable=protected-access
+    self.assertEqual(list(image._chunk_types),
+                     [chunk_type for (chunk_type, _, _) in chunks])
+    self.assertEqual(bytes(image._chunk_fill_data),
+                     b''.join(fill_data or b'\0\0\0\0'
+                              for (_, _, fill_data) in chunks))
+    self.assertEqual(list(image._chunk_output_offsets),
+                     list(range(0, len(chunks) * BLOCK_SIZE, BLOCK_SIZE)))
+    self.assertEqual(image._sparse_end, len(sparse_data))
+    self.assertEqual(self._unsparsify(path), unsparsified)
+
+  def test_scan_rejects_invalid_images(self):
+    header_size = struct.calcsize(SPARSE_HEADER_FORMAT)
+    chunk_header_size = struct.calcsize(CHUNK_HEADER_FORMAT)
+    (two_chunks, _) = build_sparse_image(
+        [(CHUNK_TYPE_DONT_CARE, 1, None), (CHUNK_TYPE_FILL, 1, b'abcd')],
+        'invalid')
+
+    def with_header_field(data, field, value):
+      header = list(struct.unpack(SPARSE_HEADER_FORMAT, data[:header_size]))
+      header[field] = value
+      return struct.pack(SPARSE_HEADER_FORMAT, *header) + data[header_size:]
+
+    def with_chunk_header(data, chunk_type, total_sz):
+      return (data[:header_size] +
+              struct.pack(CHUNK_HEADER_FORMAT, chunk_type, 0, 1, total_sz) +
+              data[header_size + chunk_header_size:])
+
+    cases = {
+        'truncated chunk header': two_chunks[:-6],
+        'truncated fill data': two_chunks[:-2],
+        'extra data': two_chunks + b'junk',
+        'wrong number of blocks': with_header_field(two_chunks, 6, 3),
+        'too many chunks': with_header_field(two_chunks, 7, 3),
+        'unknown chunk type': with_chunk_header(two_chunks, 0xcac5,
+                                                chunk_header_size),
+        'DONT_CARE with data': with_chunk_header(two_chunks,
+                                                 CHUNK_TYPE_DONT_CARE,
+                                                 chunk_header_size + 4),
+        'RAW of wrong size': with_chunk_header(two_chunks, CHUNK_TYPE_RAW,
+                                               chunk_header_size + 4),
+    }
+    for name, data in cases.items():
+      with self.subTest(name=name):
+        path = write_file(self._path('invalid.img'), data)
+        with self.assertRaises(ValueError):
+          self._open(path, read_only=True)
+
+  def _open_cached(self, path, **kwargs):
+    """Opens an image with the index cache, returning it and whether it hit.
+
+    The chunk table is checked against a fresh scan of the file.
+    """
+    handler_class = self.avbtool.ImageHandler
+    hits = handler_class.index_cache_hits
+    misses = handler_class.index_cache_misses
+    image = self._open(path, index_cache_dir='cache', **kwargs)
+    self.assertEqual(handler_class.index_cache_hits +
+                     handler_class.index_cache_misses, hits + misses + 1)
+    self.assertEqual(self._chunk_table(image),
+                     self._chunk_table(self._open(path, read_only=True)))
+    return image, handler_class.index_cache_hits > hits
+
+  def _index_path(self, path):
+    # pylint: disable=protected-access
+    return self._open(path, index_cache_dir='cache',
+                      read_only=True)._index_path
+
+  def test_index_cache(self):
+    path = write_file(self._path('sparse.img'), self.sparse_data)
+    self.assertFalse(self._open_cached(path, read_only=True)[1])
+    index_path = self._index_path(path)
+    self.assertEqual(os.path.dirname(index_path), self._path('cache'))
+    self.assertTrue(os.path.exists(index_path))
+    self.assertTrue(self._open_cached(path, read_only=True)[1])
+
+    # Writes through the handler remove the index and write it again
+    # once they're flushed.
+    (image, hit) = self._open_cached(path)
+    self.assertTrue(hit)
+    with image.append_transaction():
+      image.truncate(6 * BLOCK_SIZE)
+      self.assertFalse(os.path.exists(index_path))
+      image.append_raw(b'\1' * BLOCK_SIZE)
+    self.assertTrue(os.path.exists(index_path))
+    (image, hit) = self._open_cached(path, read_only=True)
+    self.assertTrue(hit)
+    self.assertEqual(self._unsparsify(path),
+                     self.unsparsified[:6 * BLOCK_SIZE] + b'\1' * BLOCK_SIZE)
+
+  def test_stale_index_is_rebuilt(self):
+    path = write_file(self._path('sparse.img'), self.sparse_data)
+    self._open_cached(path, read_only=True)
+    index_path = self._index_path(path)
+    index_data = read_file(index_path)
+
+    def same_size_other_data():
+      (sparse_data, _) = build_sparse_image(
+          [(CHUNK_TYPE_RAW, 6, None), (CHUNK_TYPE_FILL, 3, b'xxxx'),
+           (CHUNK_TYPE_DONT_CARE, 2, None), (CHUNK_TYPE_FILL, 1, b'yyyy'),
+           (CHUNK_TYPE_DONT_CARE, 1, None), (CHUNK_TYPE_DONT_CARE, 1, None),
+           (CHUNK_TYPE_DONT_CARE, 1, None)], 'other')
+      self.assertEqual(len(sparse_data), len(self.sparse_data))
+      with open(path, 'r+b') as f:
+        f.write(sparse_data)
+
+    def other_mtime():
+      st = os.stat(path)
+      os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    def appended_by_other_handler():
+      image = self._open(path)
+      image.append_dont_care(BLOCK_SIZE)
+      image.flush()
+
+    for change in (same_size_other_data, other_mtime,
+                   appended_by_other_handler):
+      with self.subTest(change=change.__name__):
+        change()
+        # The index in the cache no longer matches the file, so the
+        # chunks are scanned and the index is written again.
+        self.assertFalse(self._open_cached(path, read_only=True)[1])
+        self.assertNotEqual(read_file(index_path), index_data)
+        index_data = read_file(index_path)
+        self.assertTrue(self._open_cached(path, read_only=True)[1])
+
+  def test_corrupted_index_is_rebuilt(self):
+    path = write_file(self._path('sparse.img'), self.sparse_data)
+    self._open_cached(path, read_only=True)
+    index_path = self._index_path(path)
+    index_data = read_file(index_path)
+    handler_class = self.avbtool.ImageHandler
+    header_size = struct.calcsize(handler_class.INDEX_HEADER_FORMAT)
+    header = list(struct.unpack(handler_class.INDEX_HEADER_FORMAT,
+                                index_data[:header_size]))
+
+    def with_header_field(field, value):
+      fields = list(header)
+      fields[field] = value
+      return (struct.pack(handler_class.INDEX_HEADER_FORMAT, *fields) +
+              index_data[header_size:])
+
+    cases = {
+        'empty': b'',
+        'truncated header': index_data[:header_size // 2],
+        'truncated table': index_data[:-3],
+        'extra data': index_data + b'\0',
+        'garbage': bytes(generate_test_data(len(index_data), 'garbage')),
+        'magic': with_header_field(0, b'NOTANIDX'),
+        'version': with_header_field(1, handler_class.INDEX_VERSION + 1),
+        'byte order': with_header_field(2, not header[2]),
+        'block size': with_header_field(7, 512),
+        'number of blocks': with_header_field(8, header[8] + 1),
+        'number of chunks': with_header_field(9, header[9] + 1),
+        'number of entries': with_header_field(10, header[10] - 1),
+    }
+    for name, data in cases.items():
+      with self.subTest(name=name):
+        write_file(index_path, data)
+        self.assertFalse(self._open_cached(path, read_only=True)[1])
+        self.assertEqual(read_file(index_path), index_data)
+        self.assertEqual(self._unsparsify(path), self.unsparsified)
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=2)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+# Copyright 2026, The Android Open Source Project
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Helpers shared by the avbtool tests."""
+
+import hashlib
+import importlib.util
+import os
+import struct
+import subprocess
+import sys
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+AVB_DIR = os.path.dirname(TEST_DIR)
+AVBTOOL = os.path.join(AVB_DIR, 'avbtool.v1.2.py')
+KEY_DIR = os.path.join(AVB_DIR, 'data')
+TEST_DATA_DIR = os.path.join(TEST_DIR, 'data')
+
+BLOCK_SIZE = 4096
+
+# Android sparse image format, see system/core/libsparse/sparse_format.h.
+SPARSE_MAGIC = 0xed26ff3a
+SPARSE_HEADER_FORMAT = '<I4H4I'
+CHUNK_HEADER_FORMAT = '<2H2I'
+CHUNK_TYPE_RAW = 0xcac1
+CHUNK_TYPE_FILL = 0xcac2
+CHUNK_TYPE_DONT_CARE = 0xcac3
+
+
+def load_avbtool():
+  """Imports avbtool as a module.
+
+  Returns:
+    The avbtool module. It's loaded once and shared by all tests.
+  """
+  module = sys.modules.get('avbtool')
+  if module is None:
+    spec = importlib.util.spec_from_file_location('avbtool', AVBTOOL)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['avbtool'] = module
+    spec.loader.exec_module(module)
+  return module
+
+
+def run_avbtool(*args, env=None):
+  """Runs avbtool as a command.
+
+  Arguments:
+    args: The command-line arguments.
+    env: None or variables to add to the environment.
+
+  Returns:
+    A subprocess.CompletedProcess with the output as text.
+  """
+  full_env = dict(os.environ)
+  if env:
+    full_env.update(env)
+  return subprocess.run([sys.executable, AVBTOOL] + [str(a) for a in args],
+                        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                        universal_newlines=True, env=full_env, check=False)
+
+
+def generate_test_data(size, seed, zero_blocks=(), block_size=4096):
+  """Generates reproducible gibberish.
+
+  Unlike the random module this gives the same bytes with every Python
+  version, so it can be checked against stored data.
+
+  Arguments:
+    size: Number of bytes to generate.
+    seed: Seed as a string.
+    zero_blocks: Numbers of blocks of |block_size| to zero.
+    block_size: Block size for |zero_blocks|.
+
+  Returns:
+    The data as a bytearray.
+  """
+  data = bytearray(hashlib.shake_256(seed.encode('utf-8')).digest(size))
+  for block in zero_blocks:
+    start = block * block_size
+    end = min(start + block_size, size)
+    data[start:end] = b'\0' * (end - start)
+  return data
+
+
+def write_file(path, data):
+  """Writes |data| to the file at |path| and returns |path|."""
+  with open(path, 'wb') as f:
+    f.write(data)
+  return path
+
+
+def read_file(path):
+  """Returns the contents of the file at |path|."""
+  with open(path, 'rb') as f:
+    return f.read()
+
+
+def build_sparse_image(chunks, seed):
+  """Builds an Android sparse image by hand.
+
+  Arguments:
+    chunks: List of (type, number of blocks, fill data) tuples.
+    seed: Seed for the data of RAW chunks.
+
+  Returns:
+    A tuple with the sparse image and the unsparsified data, as bytes.
+  """
+  body = bytearray()
+  unsparsified = bytearray()
+  for n, (chunk_type, num_blocks, fill_data) in enumerate(chunks):
+    size = num_blocks * BLOCK_SIZE
+    if chunk_type == CHUNK_TYPE_RAW:
+      data = generate_test_data(size, '{}-{}'.format(seed, n))
+      payload = data
+    elif chunk_type == CHUNK_TYPE_FILL:
+      data = fill_data * (size // 4)
+      payload = fill_data
+    else:
+      data = b'\0' * size
+      payload = b''
+    body += struct.pack(CHUNK_HEADER_FORMAT, chunk_type, 0, num_blocks,
+                        struct.calcsize(CHUNK_HEADER_FORMAT) + len(payload))
+    body += payload
+    unsparsified += data
+  header = struct.pack(SPARSE_HEADER_FORMAT, SPARSE_MAGIC, 1, 0,
+                       struct.calcsize(SPARSE_HEADER_FORMAT),
+                       struct.calcsize(CHUNK_HEADER_FORMAT), BLOCK_SIZE,
+                       len(unsparsified) // BLOCK_SIZE, len(chunks), 0)
+  return bytes(header + body), bytes(unsparsified)
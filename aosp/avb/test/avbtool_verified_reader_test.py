@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+# Copyright 2026, The Android Open Source Project
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Tests reading images verified on demand with VerifiedImageReader."""
+
+import os
+import random
+import tempfile
+import unittest
+
+from avbtool_test_util import BLOCK_SIZE
+from avbtool_test_util import KEY_DIR
+from avbtool_test_util import generate_test_data
+from avbtool_test_util import load_avbtool
+from avbtool_test_util import run_avbtool
+from avbtool_test_util import write_file
+
+# With blocks of 1024 bytes, 32 SHA-256 digests fit in a hashtree block,
+# so the tree of 1200 data blocks has three levels: 38 blocks in the
+# lowest one, 2 above and the top-level block.
+DATA_BLOCK_SIZE = 1024
+NUM_BLOCKS = 1200
+NUM_LEVELS = 3
+
+PARTITION_SIZE = 4 * 1024 * 1024
+
+KEY = os.path.join(KEY_DIR, 'testkey_rsa2048.pem')
+
+
+class VerifiedImageReaderTest(unittest.TestCase):
+  """Tests that reads return the data and fail on corrupted blocks."""
+
+  def setUp(self):
+    self.avbtool = load_avbtool()
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.data = bytes(generate_test_data(NUM_BLOCKS * DATA_BLOCK_SIZE,
+                                         'verified-reader'))
+    self.image = os.path.join(self.temp_dir.name, 'system.img')
+    write_file(self.image, self.data)
+    result = run_avbtool('add_hashtree_footer', '--image', self.image,
+                         '--partition_name', 'system',
+                         '--partition_size', str(PARTITION_SIZE),
+                         '--block_size', str(DATA_BLOCK_SIZE),
+                         '--do_not_generate_fec',
+                         '--algorithm', 'SHA256_RSA2048', '--key', KEY)
+    self.assertEqual(result.returncode, 0, result.stderr)
+    (self.level_offsets, _) = self.avbtool.calc_hash_level_offsets(
+        len(self.data), DATA_BLOCK_SIZE, 32)
+    self.assertEqual(len(self.level_offsets), NUM_LEVELS)
+
+  def tearDown(self):
+    self.temp_dir.cleanup()
+
+  def _open(self, **kwargs):
+    return self.avbtool.Avb().open_verified_image(self.image, **kwargs)
+
+  def _corrupt(self, offset):
+    with open(self.image, 'r+b') as f:
+      f.seek(offset)
+      data = f.read(1)
+      f.seek(offset)
+      f.write(bytes([data[0] ^ 0x10]))
+
+  def _corrupt_tree_block(self, level, block):
+    """Corrupts a block of the hashtree, level 0 being the lowest."""
+    self._corrupt(len(self.data) + self.level_offsets[level]
+                  + block * DATA_BLOCK_SIZE + 100)
+
+  def _read(self, reader, offset, size):
+    reader.seek(offset)
+    data = reader.read(size)
+    self.assertEqual(reader.tell(), offset + len(data))
+    return data
+
+  def test_reads(self):
+    reader = self._open(key_path=KEY)
+    self.assertEqual(reader.image_size, len(self.data))
+    self.assertEqual(reader.block_size, DATA_BLOCK_SIZE)
+    for (offset, size) in ((0, 1), (0, DATA_BLOCK_SIZE),
+                           (DATA_BLOCK_SIZE - 1, 2),
+                           (5 * DATA_BLOCK_SIZE + 17, 3 * DATA_BLOCK_SIZE),
+                           (1000, 40 * DATA_BLOCK_SIZE),
+                           (0, len(self.data)),
+                           (len(self.data) - 10, 100),
+                           (len(self.data), 1),
+                           (len(self.data) + 5000, 1)):
+      with self.subTest(offset=offset, size=size):
+        self.assertEqual(self._read(reader, offset, size),
+                         self.data[offset:offset + size])
+    self.assertEqual(reader.read_block(NUM_BLOCKS - 1),
+                     self.data[-DATA_BLOCK_SIZE:])
+    with self.assertRaisesRegex(self.avbtool.AvbError, 'outside'):
+      reader.read_block(NUM_BLOCKS)
+
+  def test_wrong_key(self):
+    with self.assertRaises(self.avbtool.AvbError):
+      self._open(key_path=os.path.join(KEY_DIR, 'testkey_rsa4096.pem'))
+
+  def test_short_last_block(self):
+    # avbtool pads images to the block size, so the tree of a short last
+    # block is generated here.
+    image_size = 40 * BLOCK_SIZE + 1000
+    data = self.data[:image_size]
+    path = os.path.join(self.temp_dir.name, 'short.img')
+    write_file(path, data)
+    (level_offsets, tree_size) = self.avbtool.calc_hash_level_offsets(
+        image_size, BLOCK_SIZE, 32)
+    (root_digest, tree) = self.avbtool.generate_hash_tree(
+        self.avbtool.ImageHandler(path, read_only=True), image_size,
+        BLOCK_SIZE, 'sha256', b'salt', 0, level_offsets, tree_size)
+    tree_offset = 41 * BLOCK_SIZE
+    with open(path, 'ab') as f:
+      f.write(bytes(tree_offset - image_size))
+      f.write(tree)
+    desc = self.avbtool.AvbHashtreeDescriptor()
+    desc.image_size = image_size
+    desc.tree_offset = tree_offset
+    desc.tree_size = tree_size
+    desc.data_block_size = BLOCK_SIZE
+    desc.hash_algorithm = 'sha256'
+    desc.salt = b'salt'
+    desc.root_digest = root_digest
+    reader = self.avbtool.VerifiedImageReader(
+        self.avbtool.ImageHandler(path, read_only=True), desc)
+    self.assertEqual(self._read(reader, 39 * BLOCK_SIZE + 10, 2 * BLOCK_SIZE),
+                     data[39 * BLOCK_SIZE + 10:])
+    self.assertEqual(self._read(reader, image_size - 1, 10), data[-1:])
+    self.assertEqual(self._read(reader, image_size, 10), b'')
+    self.assertEqual(reader.read_block(40),
+                     data[40 * BLOCK_SIZE:] + bytes(BLOCK_SIZE - 1000))
+
+  def test_corrupted_data_block(self):
+    self._corrupt(700 * DATA_BLOCK_SIZE + 5)
+    reader = self._open()
+    with self.assertRaisesRegex(self.avbtool.AvbError,
+                                'Data block 700 of .* does not match'):
+      self._read(reader, 650 * DATA_BLOCK_SIZE, 100 * DATA_BLOCK_SIZE)
+    with self.assertRaises(self.avbtool.AvbError):
+      self._read(reader, 700 * DATA_BLOCK_SIZE + 100, 1)
+    # Neighbouring blocks are still readable.
+    self.assertEqual(self._read(reader, 699 * DATA_BLOCK_SIZE,
+                                DATA_BLOCK_SIZE),
+                     self.data[699 * DATA_BLOCK_SIZE:700 * DATA_BLOCK_SIZE])
+    self.assertEqual(reader.read_block(701),
+                     self.data[701 * DATA_BLOCK_SIZE:702 * DATA_BLOCK_SIZE])
+
+  def test_corrupted_tree_block(self):
+    # The second block of the middle level covers the digests of data
+    # blocks 1024 and up.
+    self._corrupt_tree_block(1, 1)
+    for tree_cache_size in (1, 1024):
+      with self.subTest(tree_cache_size=tree_cache_size):
+        reader = self._open(tree_cache_size=tree_cache_size)
+        self.assertEqual(self._read(reader, 0, 1024 * DATA_BLOCK_SIZE),
+                         self.data[:1024 * DATA_BLOCK_SIZE])
+        with self.assertRaisesRegex(self.avbtool.AvbError,
+                                    'Hashtree block at offset {} .* is '
+                                    'corrupted'.format(
+                                        self.level_offsets[1]
+                                        + DATA_BLOCK_SIZE)):
+          reader.read_block(1100)
+        with self.assertRaises(self.avbtool.AvbError):
+          reader.read_block(1024)
+        self.assertEqual(reader.read_block(1023),
+                         self.data[1023 * DATA_BLOCK_SIZE:
+                                   1024 * DATA_BLOCK_SIZE])
+
+  def test_corrupted_top_level(self):
+    self._corrupt_tree_block(2, 0)
+    reader = self._open()
+    with self.assertRaisesRegex(self.avbtool.AvbError,
+                                'Hashtree block at offset 0 .* is corrupted'):
+      reader.read_block(0)
+
+  def test_small_tree_cache(self):
+    # Only the last block of the tree is kept, so the path of every read
+    # is verified again.
+    reader = self._open(tree_cache_size=1)
+    blocks = list(range(NUM_BLOCKS))
+    random.Random(1).shuffle(blocks)
+    for block in blocks[:300]:
+      self.assertEqual(reader.read_block(block),
+                       self.data[block * DATA_BLOCK_SIZE:
+                                 (block + 1) * DATA_BLOCK_SIZE])
+      # pylint: disable=protected-access
+      self.assertLessEqual(len(reader._tree_cache), 1)
+    self.assertEqual(self._read(reader, 0, len(self.data)), self.data)
+    # A corrupted block is still found after evictions.
+    self._corrupt(blocks[0] * DATA_BLOCK_SIZE)
+    with self.assertRaises(self.avbtool.AvbError):
+      reader.read_block(blocks[0])
+
+  def test_hashed_blocks_per_read(self):
+    for tree_cache_size in (1, 1024):
+      with self.subTest(tree_cache_size=tree_cache_size):
+        reader = self._open(tree_cache_size=tree_cache_size)
+        rng = random.Random(2)
+        for _ in range(200):
+          block = rng.randrange(NUM_BLOCKS)
+          num_hashed_blocks = reader.num_hashed_blocks
+          reader.read_block(block)
+          # The data block and at most one block per level.
+          self.assertLessEqual(reader.num_hashed_blocks - num_hashed_blocks,
+                               1 + NUM_LEVELS)
+        # With the default cache the whole tree ends up cached and only
+        # data blocks are hashed.
+        if tree_cache_size == 1024:
+          self._read(reader, 0, len(self.data))
+          num_hashed_blocks = reader.num_hashed_blocks
+          self._read(reader, 0, len(self.data))
+          self.assertEqual(reader.num_hashed_blocks - num_hashed_blocks,
+                           NUM_BLOCKS)
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=2)
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+# Copyright 2026, The Android Open Source Project
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Tests verifying hashtrees with verify_image."""
+
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from avbtool_test_util import BLOCK_SIZE
+from avbtool_test_util import generate_test_data
+from avbtool_test_util import load_avbtool
+from avbtool_test_util import run_avbtool
+from avbtool_test_util import write_file
+
+# The lowest level of the hashtree has 128 digests per block, so it has
+# five blocks for this many data blocks.
+NUM_BLOCKS = 600
+
+PARTITION_SIZE = 4 * 1024 * 1024
+
+SALT = '00112233445566778899aabbccddeeff'
+
+# Windows of 128 blocks are hashed at a time, one per block of the
+# lowest hashtree level.
+HASH_JOB_SIZE = 128 * BLOCK_SIZE
+
+
+class VerifyHashtreeTest(unittest.TestCase):
+  """Tests which corrupted blocks verify_image finds."""
+
+  def setUp(self):
+    self.avbtool = load_avbtool()
+    self.saved_hash_job_size = self.avbtool.HASH_JOB_SIZE
+    self.avbtool.HASH_JOB_SIZE = HASH_JOB_SIZE
+    self.temp_dir = tempfile.TemporaryDirectory()
+    self.reference = self._path('reference.img')
+    write_file(self.reference,
+               generate_test_data(NUM_BLOCKS * BLOCK_SIZE, 'verify'))
+    with contextlib.redirect_stdout(io.StringIO()):
+      self.avbtool.AvbTool().run(
+          ['avbtool', 'add_hashtree_footer', '--image', self.reference,
+           '--partition_name', 'system',
+           '--partition_size', str(PARTITION_SIZE), '--salt', SALT])
+    self.image = self._path('system.img')
+    shutil.copy(self.reference, self.image)
+    image = self.avbtool.ImageHandler(self.reference, read_only=True)
+    # pylint: disable=protected-access
+    (_, _, descriptors, _) = self.avbtool.Avb()._parse_image(image)
+    self.desc = [d for d in descriptors
+                 if isinstance(d, self.avbtool.AvbHashtreeDescriptor)][0]
+    digest_size = self.desc._hashtree_digest_size()
+    (self.level_offsets, _) = self.avbtool.calc_hash_level_offsets(
+        self.desc.image_size, BLOCK_SIZE,
+        self.avbtool.round_to_pow2(digest_size))
+
+  def tearDown(self):
+    self.avbtool.HASH_JOB_SIZE = self.saved_hash_job_size
+    self.temp_dir.cleanup()
+
+  def _path(self, name):
+    return os.path.join(self.temp_dir.name, name)
+
+  def _corrupt(self, offset):
+    """Flips a bit at |offset| of the image."""
+    with open(self.image, 'r+b') as f:
+      f.seek(offset)
+      byte = f.read(1)[0]
+      f.seek(offset)
+      f.write(bytes([byte ^ 0x10]))
+
+  def _corrupt_data_block(self, block):
+    self._corrupt(block * BLOCK_SIZE + 123)
+
+  def _tree_block_offset(self, level, block):
+    """Returns the offset in the image of a block of the hashtree."""
+    return (self.desc.tree_offset + self.level_offsets[level] +
+            block * BLOCK_SIZE)
+
+  def _verify(self, *args):
+    """Runs verify_image with a bad block report.
+
+    Returns:
+      The report of the hashtree descriptor and whether it verified.
+    """
+    report = io.StringIO()
+    verified = True
+    with contextlib.redirect_stdout(io.StringIO()), \
+         contextlib.redirect_stderr(io.StringIO()):
+      try:
+        self.avbtool.Avb().verify_image(self.image, None, None, False, False,
+                                        bad_block_report=report, **dict(args))
+      except self.avbtool.AvbError:
+        verified = False
+    partitions = json.loads(report.getvalue())['partitions']
+    self.assertEqual(len(partitions), 1)
+    self.assertEqual(partitions[0]['name'], 'system')
+    self.assertEqual(partitions[0]['image'], self.image)
+    self.assertEqual(partitions[0]['block_size'], BLOCK_SIZE)
+    return partitions[0], verified
+
+  def _data_range(self, first_block, num_blocks):
+    return {'first_block': first_block, 'num_blocks': num_blocks,
+            'offset': first_block * BLOCK_SIZE,
+            'size': num_blocks * BLOCK_SIZE}
+
+  def _tree_block(self, level, block):
+    return {'offset': self._tree_block_offset(level, block),
+            'size': BLOCK_SIZE}
+
+  def test_intact(self):
+    for jobs in (1, 3):
+      with self.subTest(jobs=jobs):
+        (report, verified) = self._verify(('jobs', jobs))
+        self.assertTrue(verified)
+        self.assertEqual(report['bad_data_blocks'], [])
+        self.assertEqual(report['bad_hashtree_blocks'], [])
+        self.assertEqual(report['unchecked_blocks'], 0)
+        self.assertTrue(report['complete'])
+
+  def test_bad_data_blocks(self):
+    for block in (5, 6, 7, 200, NUM_BLOCKS - 1):
+      self._corrupt_data_block(block)
+    for jobs in (1, 3):
+      with self.subTest(jobs=jobs):
+        (report, verified) = self._verify(('jobs', jobs))
+        self.assertFalse(verified)
+        self.assertEqual(report['bad_data_blocks'],
+                         [self._data_range(5, 3), self._data_range(200, 1),
+                          self._data_range(NUM_BLOCKS - 1, 1)])
+        self.assertEqual(report['bad_hashtree_blocks'], [])
+        self.assertEqual(report['unchecked_blocks'], 0)
+        self.assertTrue(report['complete'])
+
+  def test_bad_hashtree_blocks(self):
+    # The data blocks below a corrupted block of the lowest level can't
+    # be checked, not even the corrupted one among them.
+    self._corrupt(self._tree_block_offset(0, 1) + 40)
+    self._corrupt(self._tree_block_offset(0, 4) + 8)
+    self._corrupt_data_block(130)
+    self._corrupt_data_block(10)
+    (report, verified) = self._verify()
+    self.assertFalse(verified)
+    self.assertEqual(report['bad_data_blocks'], [self._data_range(10, 1)])
+    self.assertEqual(report['bad_hashtree_blocks'],
+                     [self._tree_block(0, 1), self._tree_block(0, 4)])
+    self.assertEqual(report['unchecked_blocks'], 128 + NUM_BLOCKS - 4 * 128)
+    self.assertTrue(report['complete'])
+
+  def test_bad_top_level(self):
+    # With the top level corrupted nothing below it can be checked, that
+    # is neither the five blocks of the lowest level nor any data block.
+    self._corrupt(self._tree_block_offset(1, 0))
+    (report, verified) = self._verify()
+    self.assertFalse(verified)
+    self.assertEqual(report['bad_data_blocks'], [])
+    self.assertEqual(report['bad_hashtree_blocks'], [self._tree_block(1, 0)])
+    self.assertEqual(report['unchecked_blocks'], 5 + NUM_BLOCKS)
+    self.assertTrue(report['complete'])
+
+  def test_fail_fast_on_data(self):
+    for block in (5, 200, 400):
+      self._corrupt_data_block(block)
+    for jobs in (1, 3):
+      with self.subTest(jobs=jobs):
+        (report, verified) = self._verify(('jobs', jobs), ('fail_fast', True))
+        self.assertFalse(verified)
+        # Verification stops after the window with the first bad block.
+        self.assertEqual(report['bad_data_blocks'], [self._data_range(5, 1)])
+        self.assertFalse(report['complete'])
+
+  def test_fail_fast_on_hashtree(self):
+    self._corrupt(self._tree_block_offset(0, 2))
+    self._corrupt_data_block(5)
+    (report, verified) = self._verify(('fail_fast', True))
+    self.assertFalse(verified)
+    # The tree is checked before any data is hashed.
+    self.assertEqual(report['bad_data_blocks'], [])
+    self.assertEqual(report['bad_hashtree_blocks'], [self._tree_block(0, 2)])
+    self.assertFalse(report['complete'])
+
+  def test_command(self):
+    self._corrupt_data_block(42)
+    report_path = self._path('report.json')
+    result = run_avbtool('verify_image', '--image', self.image,
+                         '--bad_block_report', report_path, '--fail_fast')
+    self.assertEqual(result.returncode, 1)
+    self.assertIn('does not match descriptor', result.stderr)
+    with open(report_path) as f:
+      partitions = json.load(f)['partitions']
+    self.assertEqual(partitions[0]['bad_data_blocks'],
+                     [self._data_range(42, 1)])
+    self.assertFalse(partitions[0]['complete'])
+
+  def test_sample_picks(self):
+    block_sample = self.avbtool.BlockSample
+    blocks = block_sample(size=10, seed=1234).pick(NUM_BLOCKS)
+    self.assertEqual(len(blocks), 10)
+    self.assertEqual(blocks, sorted(set(blocks)))
+    self.assertTrue(all(0 <= block < NUM_BLOCKS for block in blocks))
+    # The same seed picks the same blocks, another one other blocks.
+    self.assertEqual(block_sample(size=10, seed=1234).pick(NUM_BLOCKS),
+                     blocks)
+    self.assertNotEqual(block_sample(size=10, seed=1235).pick(NUM_BLOCKS),
+                        blocks)
+    self.assertEqual(
+        len(block_sample(fraction=0.05, seed=1).pick(NUM_BLOCKS)), 30)
+    self.assertEqual(
+        len(block_sample(fraction=1e-9, seed=1).pick(NUM_BLOCKS)), 1)
+    self.assertEqual(block_sample(fraction=1, seed=1).pick(NUM_BLOCKS),
+                     list(range(NUM_BLOCKS)))
+    self.assertEqual(block_sample(size=NUM_BLOCKS + 1, seed=1).pick(NUM_BLOCKS),
+                     list(range(NUM_BLOCKS)))
+    self.assertIsNotNone(block_sample(size=1).seed)
+
+  def test_sample_bounds(self):
+    for kwargs in ({'size': 0}, {'size': -3}, {'fraction': 0},
+                   {'fraction': -0.5}, {'fraction': 1.01}):
+      with self.subTest(**kwargs):
+        with self.assertRaises(self.avbtool.AvbError):
+          self.avbtool.BlockSample(**kwargs)
+    for args in (('--sample', '0'), ('--sample_fraction', '0'),
+                 ('--sample_fraction', '2')):
+      with self.subTest(args=args):
+        result = run_avbtool('verify_image', '--image', self.image, *args)
+        self.assertEqual(result.returncode, 1)
+        self.assertIn('Sample', result.stderr)
+        self.assertNotIn('Traceback', result.stderr)
+    result = run_avbtool('verify_image', '--image', self.image,
+                         '--sample', '5', '--sample_fraction', '0.5')
+    self.assertEqual(result.returncode, 2)
+    self.assertIn('not allowed with argument', result.stderr)
+
+  def test_sample_catches_corrupted_block(self):
+    sampled = self.avbtool.BlockSample(size=20, seed=77).pick(NUM_BLOCKS)
+    not_sampled = [block for block in range(NUM_BLOCKS)
+                   if block not in sampled]
+    # A corrupted block outside of the sample isn't noticed.
+    self._corrupt_data_block(not_sampled[100])
+    (report, verified) = self._verify(('sample_size', 20),
+                                      ('sample_seed', 77))
+    self.assertTrue(verified)
+    self.assertEqual(report['sampled_blocks'], 20)
+    self.assertEqual(report['sample_seed'], 77)
+    self.assertEqual(report['bad_data_blocks'], [])
+
+    self._corrupt_data_block(sampled[7])
+    for jobs in (1, 3):
+      with self.subTest(jobs=jobs):
+        (report, verified) = self._verify(('sample_size', 20),
+                                          ('sample_seed', 77), ('jobs', jobs))
+        self.assertFalse(verified)
+        self.assertEqual(report['bad_data_blocks'],
+                         [self._data_range(sampled[7], 1)])
+        self.assertTrue(report['complete'])
+
+  def test_sample_command(self):
+    sampled = self.avbtool.BlockSample(fraction=0.1, seed=5).pick(NUM_BLOCKS)
+    self._corrupt_data_block(sampled[0])
+    self._corrupt_data_block(sampled[-1])
+    reports = []
+    for n in range(2):
+      report_path = self._path('report{}.json'.format(n))
+      result = run_avbtool('verify_image', '--image', self.image,
+                           '--sample_fraction', '0.1', '--sample_seed', '5',
+                           '--bad_block_report', report_path)
+      self.assertEqual(result.returncode, 1)
+      self.assertIn('Sampling data blocks of hashtrees with seed 5',
+                    result.stdout)
+      with open(report_path) as f:
+        reports.append(json.load(f)['partitions'][0])
+    self.assertEqual(reports[0], reports[1])
+    self.assertEqual(reports[0]['sampled_blocks'], len(sampled))
+    self.assertEqual(reports[0]['bad_data_blocks'],
+                     [self._data_range(sampled[0], 1),
+                      self._data_range(sampled[-1], 1)])
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=2)
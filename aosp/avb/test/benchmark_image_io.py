@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+
+# Copyright 2026, The Android Open Source Project
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy,
+# modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Benchmarks reading raw images with the ImageHandler settings.
+
+Every avbtool command is run in a new process, since the settings are
+read from the environment when avbtool is loaded, and the best wall
+time of --repeat runs is reported. Images are read from the page cache
+after the first run.
+
+Throughput with and without mmap, see AVB_IMAGE_MMAP, on a 1 GiB image:
+
+  benchmark_image_io.py throughput --size 1024
+
+Skipping holes with and without SEEK_DATA/SEEK_HOLE, see
+AVB_IMAGE_SEEK_HOLES, on a mostly empty 8 GiB image with 4 MiB of data
+every 256 MiB:
+
+  benchmark_image_io.py holes --size 8192 --extent_size 4 --interval 256
+
+Peak RSS of hashing a 2 GiB image with the default settings and with
+AVB_IMAGE_MMAP=0, AVB_IMAGE_SEEK_HOLES=0 and AVB_IO_STATS_LOGFILE set:
+
+  benchmark_image_io.py memory --size 2048
+
+Pages of mapped images which have been read count towards the RSS as
+long as they're mapped.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from avbtool_test_util import AVBTOOL
+
+MIB = 1024 * 1024
+
+SALT = '00112233445566778899aabbccddeeff'
+
+
+def write_random_image(path, size, chunk_size=16 * MIB):
+  """Writes |size| bytes of random data to a new file."""
+  with open(path, 'wb') as f:
+    while size > 0:
+      f.write(os.urandom(min(chunk_size, size)))
+      size -= chunk_size
+
+
+def write_holey_image(path, size, extent, interval):
+  """Writes a file with data extents and holes in between.
+
+  Arguments:
+    path: The file to write.
+    size: Size of the file.
+    extent: The data of each extent as bytes.
+    interval: Distance between the starts of data extents.
+  """
+  with open(path, 'wb') as f:
+    f.truncate(size)
+    for offset in range(0, size, interval):
+      f.seek(offset)
+      f.write(extent[:size - offset])
+
+
+def info_image(path):
+  """Returns the output of 'avbtool info_image'."""
+  return subprocess.run([sys.executable, AVBTOOL, 'info_image', '--image',
+                         path], stdout=subprocess.PIPE, check=True).stdout
+
+
+def run_avbtool(args, env):
+  """Runs avbtool and measures it.
+
+  Arguments:
+    args: The command-line arguments.
+    env: Variables to add to the environment.
+
+  Returns:
+    A tuple with the wall time in seconds and the peak RSS in KiB.
+
+  Raises:
+    RuntimeError: If avbtool fails.
+  """
+  full_env = dict(os.environ)
+  full_env.update(env)
+  start = time.monotonic()
+  p = subprocess.Popen([sys.executable, AVBTOOL] + [str(a) for a in args],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                       env=full_env)
+  stderr = p.stderr.read()
+  (_, status, rusage) = os.wait4(p.pid, 0)
+  elapsed = time.monotonic() - start
+  p.returncode = os.waitstatus_to_exitcode(status)
+  p.stderr.close()
+  if p.returncode != 0:
+    raise RuntimeError('avbtool {} failed: {}'.format(
+        ' '.join(str(a) for a in args), stderr.decode(errors='replace')))
+  return elapsed, rusage.ru_maxrss
+
+
+def measure(name, data_size, configs, setup, args, repeat):
+  """Runs a command with several settings and prints the results.
+
+  Arguments:
+    name: Description of the command.
+    data_size: Number of bytes of image data the command reads.
+    configs: A list of tuples with a description and the variables to
+      add to the environment.
+    setup: None or a function called before every run, e.g. to make a
+      new copy of the image.
+    args: The avbtool command-line arguments.
+    repeat: Number of runs for each setting.
+  """
+  for (config_name, env) in configs:
+    times = []
+    peak_rss = 0
+    for _ in range(repeat):
+      if setup:
+        setup()
+      (elapsed, rss) = run_avbtool(args, env)
+      times.append(elapsed)
+      peak_rss = max(peak_rss, rss)
+    best = min(times)
+    print('{:<28} {:<24} {:8.3f} s {:9.1f} MiB/s {:9.1f} MiB RSS'.format(
+        name, config_name, best, data_size / MIB / best, peak_rss / 1024))
+    sys.stdout.flush()
+
+
+def benchmark_throughput(work_dir, args):
+  """Compares reading dense raw images with and without mmap."""
+  size = args.size * MIB
+  partition_size = size + 64 * MIB
+  configs = [('AVB_IMAGE_MMAP=1', {'AVB_IMAGE_MMAP': '1'}),
+             ('AVB_IMAGE_MMAP=0', {'AVB_IMAGE_MMAP': '0'})]
+  source = os.path.join(work_dir, 'source.img')
+  write_random_image(source, size)
+
+  system = os.path.join(work_dir, 'system.img')
+  def copy_system():
+    shutil.copyfile(source, system)
+  hashtree_args = ['add_hashtree_footer', '--image', system,
+                   '--partition_name', 'system',
+                   '--partition_size', partition_size,
+                   '--do_not_generate_fec']
+  measure('add_hashtree_footer', size, configs, copy_system, hashtree_args,
+          args.repeat)
+  copy_system()
+  run_avbtool(hashtree_args, {})
+  measure('verify_image (hashtree)', size, configs, None,
+          ['verify_image', '--image', system], args.repeat)
+
+  boot = os.path.join(work_dir, 'boot.img')
+  def copy_boot():
+    shutil.copyfile(source, boot)
+  hash_args = ['add_hash_footer', '--image', boot, '--partition_name', 'boot',
+               '--partition_size', partition_size]
+  measure('add_hash_footer', size, configs, copy_boot, hash_args, args.repeat)
+  copy_boot()
+  run_avbtool(hash_args, {})
+  measure('verify_image (hash)', size, configs, None,
+          ['verify_image', '--image', boot], args.repeat)
+
+
+def benchmark_holes(work_dir, args):
+  """Compares reading holey raw images with and without skipping holes."""
+  size = args.size * MIB
+  partition_size = size + 64 * MIB
+  configs = [('AVB_IMAGE_SEEK_HOLES=1', {'AVB_IMAGE_SEEK_HOLES': '1'}),
+             ('AVB_IMAGE_SEEK_HOLES=0', {'AVB_IMAGE_SEEK_HOLES': '0'})]
+
+  # The same data is written every time so the footers are the same.
+  extent = os.urandom(args.extent_size * MIB)
+  system = os.path.join(work_dir, 'system.img')
+  boot = os.path.join(work_dir, 'boot.img')
+  def write_system():
+    write_holey_image(system, size, extent, args.interval * MIB)
+  def write_boot():
+    write_holey_image(boot, size, extent, args.interval * MIB)
+  write_system()
+  allocated = os.stat(system).st_blocks * 512
+  print('{} MiB image with {} MiB allocated'.format(
+      args.size, allocated // MIB))
+  if allocated > size // 2:
+    print('The file system of {} doesn\'t seem to support holes'.format(
+        work_dir))
+
+  # The salt is random by default.
+  hashtree_args = ['add_hashtree_footer', '--image', system,
+                   '--partition_name', 'system',
+                   '--partition_size', partition_size,
+                   '--do_not_generate_fec', '--salt', SALT]
+  hash_args = ['add_hash_footer', '--image', boot, '--partition_name', 'boot',
+               '--partition_size', partition_size, '--salt', SALT]
+  # The footers must be the same either way.
+  for (setup, path, footer_args) in ((write_system, system, hashtree_args),
+                                     (write_boot, boot, hash_args)):
+    infos = []
+    for (_, env) in configs:
+      setup()
+      run_avbtool(footer_args, env)
+      infos.append(info_image(path))
+    if infos[0] != infos[1]:
+      raise RuntimeError('{} gives different footers'.format(footer_args[0]))
+
+  measure('add_hashtree_footer', size, configs, write_system, hashtree_args,
+          args.repeat)
+  measure('verify_image (hashtree)', size, configs, None,
+          ['verify_image', '--image', system], args.repeat)
+  measure('add_hash_footer', size, configs, write_boot, hash_args,
+          args.repeat)
+  measure('verify_image (hash)', size, configs, None,
+          ['verify_image', '--image', boot], args.repeat)
+
+
+def benchmark_memory(work_dir, args):
+  """Compares the peak RSS of hashing images with all settings."""
+  size = args.size * MIB
+  partition_size = size + 64 * MIB
+  io_stats_log = os.path.join(work_dir, 'io_stats.log')
+  configs = [('defaults', {}),
+             ('AVB_IMAGE_MMAP=0', {'AVB_IMAGE_MMAP': '0'}),
+             ('AVB_IMAGE_SEEK_HOLES=0', {'AVB_IMAGE_SEEK_HOLES': '0'}),
+             ('AVB_IO_STATS_LOGFILE', {'AVB_IO_STATS_LOGFILE': io_stats_log})]
+  source = os.path.join(work_dir, 'source.img')
+  write_random_image(source, size)
+
+  boot = os.path.join(work_dir, 'boot.img')
+  def copy_boot():
+    shutil.copyfile(source, boot)
+  hash_args = ['add_hash_footer', '--image', boot, '--partition_name', 'boot',
+               '--partition_size', partition_size]
+  measure('add_hash_footer', size, configs, copy_boot, hash_args, args.repeat)
+  measure('verify_image (hash)', size, configs, None,
+          ['verify_image', '--image', boot], args.repeat)
+
+  system = os.path.join(work_dir, 'system.img')
+  def copy_system():
+    shutil.copyfile(source, system)
+  hashtree_args = ['add_hashtree_footer', '--image', system,
+                   '--partition_name', 'system',
+                   '--partition_size', partition_size]
+  measure('add_hashtree_footer', size, configs, copy_system, hashtree_args,
+          args.repeat)
+  measure('verify_image (hashtree)', size, configs, None,
+          ['verify_image', '--image', system], args.repeat)
+
+  with open(io_stats_log) as f:
+    print('Last entries of {}:'.format(io_stats_log))
+    for line in f.readlines()[-2:]:
+      print('  ' + line.rstrip())
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--dir',
+                      help='Directory for the images, the default is the '
+                      'one for temporary files')
+  parser.add_argument('--repeat', type=int, default=3,
+                      help='Number of runs for each setting')
+  subparsers = parser.add_subparsers(dest='benchmark', required=True)
+  sub_parser = subparsers.add_parser(
+      'throughput', help='Reads dense images with and without mmap')
+  sub_parser.add_argument('--size', type=int, default=1024,
+                          help='Image size in MiB')
+  sub_parser.set_defaults(func=benchmark_throughput)
+  sub_parser = subparsers.add_parser(
+      'holes', help='Reads holey images with and without skipping holes')
+  sub_parser.add_argument('--size', type=int, default=8192,
+                          help='Image size in MiB')
+  sub_parser.add_argument('--extent_size', type=int, default=4,
+                          help='Size of each data extent in MiB')
+  sub_parser.add_argument('--interval', type=int, default=256,
+                          help='Distance between data extents in MiB')
+  sub_parser.set_defaults(func=benchmark_holes)
+  sub_parser = subparsers.add_parser(
+      'memory', help='Measures the peak RSS with all settings')
+  sub_parser.add_argument('--size', type=int, default=2048,
+                          help='Image size in MiB')
+  sub_parser.set_defaults(func=benchmark_memory)
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory(dir=args.dir) as work_dir:
+    args.func(work_dir, args)
+
+
+if __name__ == '__main__':
+  main()